@@ -1,9 +1,10 @@
-import io
 import os
+import shutil
+import tempfile
 from fastapi import FastAPI, UploadFile
 from fastapi.param_functions import Depends
 from pydantic import BaseModel
-from typing import Dict, List
+from typing import Dict, List, Optional
 from neural_search.core.search import Search
 from neural_search.core.utils import DataHandler
 from neural_search.core.tagger import QuestionAnswerTagger
@@ -13,13 +14,14 @@ INIT_TAGGER = eval(os.environ.get('INIT_TAGGER', True))
 app = FastAPI()
 
 question_tags = [
-    {'tag': 'year', 'question': 'What year was the document written?', 'confidence': 0.95},
+    {'tag': 'year', 'question': 'What year was the document written?', 'confidence': 0.95,
+     'answer_pattern': r'(?<!\d)(1[89]|20)\d{2}(?!\d)'},
     {'tag': 'who', 'question': 'Who is involved?', 'confidence': 0.5},
     {'tag': 'challenges', 'question': 'What are the main challenges?', 'confidence': 0.5},
     {'tag': 'opportunities', 'question': 'What are the main opportunities?', 'confidence': 0.5},
     {'tag': 'initiatives', 'question': 'What are the main initiatives?', 'confidence': 0.5},
 ]
-tagger = QuestionAnswerTagger(question_tags=question_tags) if INIT_TAGGER else None
+tagger = QuestionAnswerTagger(questions=question_tags) if INIT_TAGGER else None
 data_handler = DataHandler(
     ner_tagger=tagger
 )
@@ -32,8 +34,12 @@ class IndexRequest(BaseModel):
     reload: bool = False
     reload_persisted: bool = False
     tag: bool = False
+    # whether the documents of the previously indexed files missing from the upload are deleted
+    delete_missing: bool = False
     # question_tags: Dict[str, str] = question_tags
     tagging_confidence: float = 0.5
+    # whether the sentences in which a question's answer pattern does not appear are not asked
+    skip_unanswerable: bool = False
 
     class Config:
          orm_mode=True
@@ -69,6 +75,7 @@ class SearchResponse(SearchRequest):
 
 class TagsRequest(BaseModel):
     doc_ids: List[str] = []
+    top_n: Optional[int] = None
 
 @app.post('/index')
 def index_docs(request: IndexRequest = Depends()) -> None:
@@ -78,21 +85,38 @@ def index_docs(request: IndexRequest = Depends()) -> None:
     # question_tags = request.question_tags
     if request.tag and (tagger is None or
                 # tagger.questions != question_tags or
-                tagger.tagging_confidence != request.tagging_confidence):
+                tagger.tagging_confidence != request.tagging_confidence or
+                tagger.skip_unanswerable != request.skip_unanswerable):
         print('Initializing NER tagger...')
         tagger = QuestionAnswerTagger(questions=question_tags,
-                                      tagging_confidence=request.tagging_confidence)
+                                      tagging_confidence=request.tagging_confidence,
+                                      skip_unanswerable=request.skip_unanswerable)
         data_handler.ner_tagger = tagger
         search.data_handler = data_handler
 
-    print("Loading bytes")
-    file_bytes = None
-    if request.zipfile is not None:
-        file_bytes = io.BytesIO(request.zipfile.file.read())
-    print("Loading zip")
-    data = data_handler.data_to_list(file_bytes)
-    print("Indexing")
-    search.index(data, request.reload, request.reload_persisted, request.tag)
+    if request.zipfile is None:
+        data = data_handler.data_to_list(None)
+        print("Indexing")
+        search.index(data, request.reload, request.reload_persisted, request.tag,
+                     delete_missing=request.delete_missing)
+        return
+
+    print("Spooling zip")
+    # the upload is copied to disk in chunks and its members are read lazily
+    with tempfile.NamedTemporaryFile(suffix='.zip', delete=False) as spool:
+        shutil.copyfileobj(request.zipfile.file, spool, 1 << 20)
+    try:
+        try:
+            data = data_handler.open_zip(spool.name)
+        except Exception as e:
+            print('File is not a zip file. Error: ', e)
+            return
+        with data:
+            print("Indexing")
+            search.index(data, request.reload, request.reload_persisted, request.tag,
+                         delete_missing=request.delete_missing)
+    finally:
+        os.remove(spool.name)
 
 @app.post('/search')
 def search_docs(search_request: SearchRequest) -> SearchResponse:
@@ -113,7 +137,7 @@ def search_docs(search_request: SearchRequest) -> SearchResponse:
 
 @app.post('/tags')
 def get_tags(tags_request: TagsRequest) -> List[str]:
-    return search.get_tags(tags_request.doc_ids)
+    return search.get_tags(tags_request.doc_ids, tags_request.top_n)
 
 @app.on_event("shutdown")
 def shutdown_event():
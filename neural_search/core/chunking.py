@@ -0,0 +1,89 @@
+from typing import Dict, List, Tuple
+
+CHUNKING_STRATEGIES = ['sentence', 'window', 'tokens']
+
+
+def merge_tags(tags: List[Dict]) -> Dict:
+    """
+    Merge the tags of the sentences of a chunk. A tag keeps its value if all the
+    sentences having it agree, otherwise its value is the list of the distinct
+    values, in the order of the sentences.
+    """
+    merged = {}
+    for sentence_tags in tags:
+        for tag, value in sentence_tags.items():
+            values = merged.setdefault(tag, [])
+            if value not in values:
+                values.append(value)
+    return {tag: values[0] if len(values) == 1 else values for tag, values in merged.items()}
+
+
+def _window_bounds(
+    sentences: List[str], strategy: str, size: int, overlap: int, max_tokens: int
+) -> List[Tuple[int, int]]:
+    """Compute the (start, end) sentence ranges of the chunks"""
+    if strategy == 'sentence':
+        return [(i, i + 1) for i in range(len(sentences))]
+    def window_end(start: int) -> int:
+        if strategy == 'window':
+            return min(start + size, len(sentences))
+        end = start + 1
+        num_tokens = len(sentences[start].split())
+        while end < len(sentences) and num_tokens + len(sentences[end].split()) <= max_tokens:
+            num_tokens += len(sentences[end].split())
+            end += 1
+        return end
+
+    bounds = []
+    start = 0
+    while start < len(sentences):
+        end = window_end(start)
+        bounds.append((start, end))
+        if end == len(sentences):
+            break
+        # the next chunk starts `overlap` sentences before the end, unless it would
+        # not get past the end, in which case it would be a subset of this chunk
+        start = max(start + 1, end - overlap)
+        if window_end(start) <= end:
+            start = end
+    return bounds
+
+
+def chunk_sentences(
+    sentences: List[str],
+    tags: List[Dict],
+    strategy: str = 'sentence',
+    size: int = 5,
+    overlap: int = 1,
+    max_tokens: int = 128,
+) -> Tuple[List[str], List[Dict], List[int]]:
+    """
+    Group the sentences of a document into chunks.
+
+    :param sentences: the sentences of the document
+    :param tags: the tags of every sentence
+    :param strategy: 'sentence', a chunk per sentence, 'window', windows of `size`
+        sentences, or 'tokens', windows of sentences holding at most `max_tokens`
+        whitespace separated tokens (a longer sentence is a chunk of its own)
+    :param size: the number of sentences of a 'window' chunk
+    :param overlap: the number of sentences shared by consecutive 'window' and
+        'tokens' chunks
+    :param max_tokens: the token budget of a 'tokens' chunk
+    :return: the texts of the chunks, their merged tags, and the offsets of the
+        chunks in the sentences of the document joined with spaces
+    """
+    if strategy not in CHUNKING_STRATEGIES:
+        raise ValueError(f'strategy should be one of {CHUNKING_STRATEGIES}, got "{strategy}"')
+    # offset of every sentence in the sentences joined with spaces
+    offsets = []
+    position = 0
+    for sentence in sentences:
+        offsets.append(position)
+        position += len(sentence) + 1
+
+    texts, chunk_tags, chunk_offsets = [], [], []
+    for start, end in _window_bounds(sentences, strategy, size, overlap, max_tokens):
+        texts.append(' '.join(sentences[start:end]))
+        chunk_tags.append(merge_tags(tags[start:end]))
+        chunk_offsets.append(offsets[start])
+    return texts, chunk_tags, chunk_offsets
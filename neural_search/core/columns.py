@@ -0,0 +1,140 @@
+import os
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+
+class StringColumnWriter:
+    """
+    Write a column of strings to an offset-indexed binary layout.
+
+    A column `<prefix>` is made of two files: `<prefix>.data`, the utf-8 encoded
+    strings concatenated, and `<prefix>.index`, the end offset of every string in
+    the data file as little-endian int64. Both files are only appended to, so a
+    column can be extended after it has been written.
+    """
+
+    def __init__(self, prefix: str, append: bool = False):
+        """
+        :param prefix: path prefix of the column files
+        :param append: if True, strings are appended to an existing column
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+        mode = 'ab' if append else 'wb'
+        self._data = open(prefix + '.data', mode)
+        self._index = open(prefix + '.index', mode)
+        self._offset = self._data.tell()
+
+    def append(self, value: str) -> None:
+        encoded = value.encode('utf-8')
+        self._data.write(encoded)
+        self._offset += len(encoded)
+        self._index.write(np.int64(self._offset).tobytes())
+
+    def extend(self, values: Iterable[str]) -> None:
+        for value in values:
+            self.append(value)
+
+    def flush(self) -> None:
+        self._data.flush()
+        self._index.flush()
+
+    def close(self) -> None:
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StringColumn:
+    """
+    A read-only, memory-mapped column written with `StringColumnWriter`.
+
+    Strings are only decoded when accessed, so opening a column costs no more than
+    mapping its two files.
+    """
+
+    def __init__(self, prefix: str, decode: Optional[Callable[[str], object]] = None):
+        """
+        :param prefix: path prefix of the column files
+        :param decode: function applied to every string when it is accessed, e.g.
+            `json.loads`
+        """
+        self.prefix = prefix
+        self._decode = decode
+        self._ends = self._map(prefix + '.index', np.int64)
+        self._data = self._map(prefix + '.data', np.uint8)
+
+    @staticmethod
+    def _map(path: str, dtype) -> np.ndarray:
+        # empty files cannot be memory-mapped
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        start = int(self._ends[i - 1]) if i > 0 else 0
+        value = bytes(self._data[start : int(self._ends[i])]).decode('utf-8')
+        return self._decode(value) if self._decode is not None else value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+
+class ColumnSlice:
+    """A lazy view over the rows `start` to `end` of a column"""
+
+    def __init__(self, column, start: int, end: int):
+        self._column = column
+        self._start = start
+        self._end = end
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._column[self._start + i]
+
+    def __iter__(self):
+        for i in range(self._start, self._end):
+            yield self._column[i]
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+
+def find_sorted(column, order: np.ndarray, value: str) -> int:
+    """
+    Find a string in a column through its sort order, decoding only the strings
+    compared by a binary search.
+
+    :param column: the column
+    :param order: the rows of the column sorted by their string, as saved next to it
+    :param value: the string to look up
+    :return: the row of the string in the column, or -1 if it is missing
+    """
+    low, high = 0, len(order)
+    while low < high:
+        middle = (low + high) // 2
+        if column[int(order[middle])] < value:
+            low = middle + 1
+        else:
+            high = middle
+    if low < len(order) and column[int(order[low])] == value:
+        return int(order[low])
+    return -1
@@ -0,0 +1,563 @@
+import heapq
+import itertools
+import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import hnswlib
+import numpy as np
+
+from neural_search.core.columns import StringColumn, StringColumnWriter
+
+
+def fit_mask(mask: np.ndarray, size: int) -> np.ndarray:
+    """Truncate or pad with False an allow-list bitmap to `size` entries"""
+    fitted = np.zeros(size, dtype=bool)
+    fitted[: min(size, len(mask))] = mask[:size]
+    return fitted
+
+
+class ExactIndex:
+    """
+    An in-process brute force index over Document embeddings.
+
+    Normalized embeddings are kept in a contiguous matrix, so a batch of queries is
+    scored against the whole index in a single matrix product. Allow-lists are
+    applied as a boolean mask over the scores, without copying the vectors.
+    """
+
+    space = 'cosine'
+
+    def __init__(self, n_dim: int, initial_capacity: int = 1024, query_block_size: int = 256):
+        """
+        :param n_dim: dimension of the embeddings
+        :param initial_capacity: number of rows allocated up front, grown when needed
+        :param query_block_size: number of queries scored in one matrix product, which
+            bounds the memory of the score matrix of large query batches
+        """
+        self.n_dim = n_dim
+        self.query_block_size = query_block_size
+        self._vectors = np.zeros((initial_capacity, n_dim), dtype=np.float32)
+        self._alive = np.zeros(initial_capacity, dtype=bool)
+        self._rows: Dict[str, int] = {}
+        self._ids: List[Optional[str]] = []
+        self._free_rows: List[int] = []
+
+    def add(self, ids: List[str], embeddings: np.ndarray) -> None:
+        """
+        Insert embeddings, replacing the vectors of ids already in the index.
+
+        :param ids: ids of the Documents
+        :param embeddings: embeddings of the Documents, one row per id
+        """
+        if len(ids) == 0:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        rows = []
+        for _id in ids:
+            if _id in self._rows:
+                rows.append(self._rows[_id])
+                continue
+            if self._free_rows:
+                row = self._free_rows.pop()
+                self._ids[row] = _id
+            else:
+                row = len(self._ids)
+                self._ids.append(_id)
+            self._rows[_id] = row
+            rows.append(row)
+
+        if len(self._ids) > len(self._vectors):
+            capacity = max(len(self._ids), 2 * len(self._vectors))
+            self._vectors = np.concatenate(
+                [self._vectors, np.zeros((capacity - len(self._vectors), self.n_dim), dtype=np.float32)]
+            )
+            self._alive = np.concatenate(
+                [self._alive, np.zeros(capacity - len(self._alive), dtype=bool)]
+            )
+        self._vectors[rows] = vectors
+        self._alive[rows] = True
+
+    def delete(self, ids: Iterable[str]) -> None:
+        """
+        Remove ids from the index. Unknown ids are ignored.
+
+        :param ids: ids of the Documents
+        """
+        for _id in ids:
+            row = self._rows.pop(_id, None)
+            if row is None:
+                continue
+            self._alive[row] = False
+            self._ids[row] = None
+            self._free_rows.append(row)
+
+    @property
+    def mask_size(self) -> int:
+        """length of the allow-list bitmaps of the index"""
+        return len(self._ids)
+
+    def mask(self, ids: Iterable[str]) -> np.ndarray:
+        """
+        Build the allow-list bitmap of a set of ids, to be passed to `search`.
+
+        :param ids: ids of the Documents
+        :return: boolean array indexed by the rows of the index
+        """
+        mask = np.zeros(self.mask_size, dtype=bool)
+        mask[[self._rows[_id] for _id in ids if _id in self._rows]] = True
+        return mask
+
+    def search(
+        self, queries: np.ndarray, limit: int, allowed: Optional[np.ndarray] = None
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Find the nearest neighbours of a batch of query embeddings.
+
+        :param queries: query embeddings, one row per query
+        :param limit: number of neighbours to return per query
+        :param allowed: if given, an allow-list bitmap built with `mask`. Only the
+            ids set in it can be returned
+        :return: for every query, a list of (id, cosine distance) sorted by distance
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        size = len(self._ids)
+        mask = self._alive[:size].copy()
+        if allowed is not None:
+            mask &= fit_mask(allowed, size)
+        limit = min(limit, int(mask.sum()))
+        if limit <= 0:
+            return [[] for _ in range(len(queries))]
+
+        results = []
+        for start in range(0, len(queries), self.query_block_size):
+            scores = queries[start : start + self.query_block_size] @ self._vectors[:size].T
+            scores[:, ~mask] = -np.inf
+            top = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            results += [
+                [(self._ids[row], float(1.0 - score)) for row, score in zip(rows, row_scores)]
+                for rows, row_scores in zip(top, top_scores)
+            ]
+        return results
+
+    def get_embeddings(self, ids: List[str]) -> np.ndarray:
+        """Return the stored (normalized) vectors of the given ids"""
+        return self._vectors[[self._rows[_id] for _id in ids]]
+
+    def clear(self) -> None:
+        """Remove all the Documents from the index"""
+        self.__init__(self.n_dim, query_block_size=self.query_block_size)
+
+    def save(self, path: str) -> None:
+        """Write the index to a directory"""
+        os.makedirs(path, exist_ok=True)
+        size = len(self._ids)
+        np.save(os.path.join(path, 'vectors.npy'), self._vectors[:size])
+        np.save(os.path.join(path, 'alive.npy'), self._alive[:size])
+        with StringColumnWriter(os.path.join(path, 'ids')) as ids:
+            ids.extend(_id or '' for _id in self._ids)
+
+    @classmethod
+    def load(cls, path: str) -> 'ExactIndex':
+        """
+        Load an index written with `save`. The vectors are memory-mapped copy-on-write,
+        so they are read from the page cache and never written back to the snapshot.
+        """
+        vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='c')
+        index = cls(vectors.shape[1], initial_capacity=0)
+        index._vectors = vectors
+        index._alive = np.load(os.path.join(path, 'alive.npy'))
+        index._ids = [_id or None for _id in StringColumn(os.path.join(path, 'ids'))]
+        index._rows = {_id: row for row, _id in enumerate(index._ids) if _id is not None}
+        index._free_rows = [row for row, _id in enumerate(index._ids) if _id is None]
+        return index
+
+    def __contains__(self, _id: str) -> bool:
+        return _id in self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+
+class HNSWIndex:
+    """
+    An in-process approximate nearest neighbour index over Document embeddings,
+    based on a HNSW graph.
+
+    Documents are addressed by their string ids, which are mapped to the integer
+    labels used by hnswlib. Every insert is given a new label: inserting an
+    existing id deletes its previous node first, and deleted nodes are only marked
+    as deleted in the graph so that hnswlib can reuse their slots for later
+    inserts. Labels are never reused, since hnswlib still maps the label of a
+    deleted node to its slot until the slot is replaced. Instead, once the deleted
+    labels outnumber the live ones, the graph is rebuilt with consecutive labels,
+    which bounds the length of the allow-list bitmaps.
+    """
+
+    MIN_COMPACTED_LABELS = 1024
+
+    def __init__(
+        self,
+        n_dim: int,
+        space: str = 'cosine',
+        M: int = 16,
+        ef_construction: int = 200,
+        ef: int = 50,
+        max_elements: int = 100000,
+    ):
+        """
+        :param n_dim: dimension of the embeddings
+        :param space: distance used by the index, either ``'cosine'``, ``'l2'`` or
+            ``'ip'``
+        :param M: number of bi-directional links of every node of the graph
+        :param ef_construction: size of the candidate list used at build time
+        :param ef: size of the candidate list used at search time. Higher values
+            give better recall at the cost of latency
+        :param max_elements: initial capacity of the index, grown when needed
+        """
+        self.n_dim = n_dim
+        self.space = space
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self._index = hnswlib.Index(space=space, dim=n_dim)
+        self._index.init_index(
+            max_elements=max_elements,
+            ef_construction=ef_construction,
+            M=M,
+            allow_replace_deleted=True,
+        )
+        self._index.set_ef(ef)
+        self._labels: Dict[str, int] = {}
+        self._ids: Dict[int, str] = {}
+        self._next_label = 0
+
+    def add(self, ids: List[str], embeddings: np.ndarray) -> None:
+        """
+        Insert embeddings, replacing the vectors of ids already in the index.
+
+        :param ids: ids of the Documents
+        :param embeddings: embeddings of the Documents, one row per id
+        """
+        if len(ids) == 0:
+            return
+        # the last row of an id given several times wins
+        rows = list({_id: row for row, _id in enumerate(ids)}.values())
+        ids = [ids[row] for row in rows]
+        embeddings = np.asarray(embeddings, dtype=np.float32)[rows]
+        self.delete(ids)
+        self._maybe_compact()
+
+        labels = np.arange(self._next_label, self._next_label + len(ids))
+        self._next_label += len(ids)
+        for _id, label in zip(ids, labels):
+            self._labels[_id] = int(label)
+            self._ids[int(label)] = _id
+
+        # new nodes first take the slots of the deleted ones
+        needed = max(self._index.get_current_count(), len(self._labels))
+        if needed > self._index.get_max_elements():
+            self._index.resize_index(max(needed, 2 * self._index.get_max_elements()))
+        self._index.add_items(embeddings, labels, replace_deleted=True)
+
+    def delete(self, ids: Iterable[str]) -> None:
+        """
+        Remove ids from the index. Unknown ids are ignored.
+
+        :param ids: ids of the Documents
+        """
+        for _id in ids:
+            label = self._labels.pop(_id, None)
+            if label is None:
+                continue
+            del self._ids[label]
+            self._index.mark_deleted(label)
+
+    def _maybe_compact(self) -> None:
+        """Rebuild the graph with the live ids under consecutive labels, once the
+        deleted labels outnumber them"""
+        num_deleted = self._next_label - len(self._labels)
+        if num_deleted <= max(len(self._labels), self.MIN_COMPACTED_LABELS):
+            return
+        ids = list(self._labels)
+        vectors = np.asarray(
+            self._index.get_items([self._labels[_id] for _id in ids]), dtype=np.float32
+        ).reshape(len(ids), self.n_dim)
+        self.__init__(
+            self.n_dim,
+            space=self.space,
+            M=self.M,
+            ef_construction=self.ef_construction,
+            ef=self.ef,
+            max_elements=max(len(ids), 1),
+        )
+        self.add(ids, vectors)
+
+    @property
+    def mask_size(self) -> int:
+        """length of the allow-list bitmaps of the index"""
+        return self._next_label
+
+    def mask(self, ids: Iterable[str]) -> np.ndarray:
+        """
+        Build the allow-list bitmap of a set of ids, to be passed to `search`.
+
+        :param ids: ids of the Documents
+        :return: boolean array indexed by the labels of the index
+        """
+        mask = np.zeros(self.mask_size, dtype=bool)
+        labels = [self._labels[_id] for _id in ids if _id in self._labels]
+        mask[labels] = True
+        return mask
+
+    def search(
+        self, queries: np.ndarray, limit: int, allowed: Optional[np.ndarray] = None
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Find the nearest neighbours of a batch of query embeddings.
+
+        :param queries: query embeddings, one row per query
+        :param limit: number of neighbours to return per query
+        :param allowed: if given, an allow-list bitmap built with `mask`. Only the
+            ids set in it can be returned
+        :return: for every query, a list of (id, distance) sorted by distance
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        search_filter = None
+        if allowed is not None:
+            allowed = fit_mask(allowed, self._next_label)
+            limit = min(limit, int(allowed.sum()))
+            search_filter = allowed.__getitem__
+        limit = min(limit, len(self))
+        if limit <= 0:
+            return [[] for _ in range(len(queries))]
+
+        # the candidate list must be at least as long as the number of results
+        self._index.set_ef(max(self.ef, limit))
+        labels, distances = self._index.knn_query(queries, k=limit, filter=search_filter)
+        return [
+            [(self._ids[label], float(distance)) for label, distance in zip(row_labels, row_distances)]
+            for row_labels, row_distances in zip(labels, distances)
+        ]
+
+    def get_embeddings(self, ids: List[str]) -> np.ndarray:
+        """Return the stored vectors of the given ids"""
+        return np.asarray(
+            self._index.get_items([self._labels[_id] for _id in ids]), dtype=np.float32
+        )
+
+    def clear(self) -> None:
+        """Remove all the Documents from the index"""
+        self.__init__(
+            self.n_dim,
+            space=self.space,
+            M=self.M,
+            ef_construction=self.ef_construction,
+            ef=self.ef,
+        )
+
+    def save(self, path: str) -> None:
+        """Write the index to a directory"""
+        os.makedirs(path, exist_ok=True)
+        self._index.save_index(os.path.join(path, 'hnsw.bin'))
+        with StringColumnWriter(os.path.join(path, 'ids')) as ids:
+            ids.extend(self._ids.get(label, '') for label in range(self._next_label))
+        with open(os.path.join(path, 'hnsw.json'), 'w') as f:
+            json.dump({
+                'n_dim': self.n_dim,
+                'space': self.space,
+                'M': self.M,
+                'ef_construction': self.ef_construction,
+                'ef': self.ef,
+                'max_elements': self._index.get_max_elements(),
+            }, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'HNSWIndex':
+        """Load an index written with `save`"""
+        with open(os.path.join(path, 'hnsw.json'), 'r') as f:
+            params = json.load(f)
+        index = cls(
+            params['n_dim'],
+            space=params['space'],
+            M=params['M'],
+            ef_construction=params['ef_construction'],
+            ef=params['ef'],
+            max_elements=1,
+        )
+        index._index = hnswlib.Index(space=index.space, dim=index.n_dim)
+        index._index.load_index(
+            os.path.join(path, 'hnsw.bin'),
+            max_elements=params['max_elements'],
+            allow_replace_deleted=True,
+        )
+        index._index.set_ef(index.ef)
+        ids = StringColumn(os.path.join(path, 'ids'))
+        for label, _id in enumerate(ids):
+            if _id:
+                index._labels[_id] = label
+                index._ids[label] = _id
+        index._next_label = len(ids)
+        index._maybe_compact()
+        return index
+
+    def __contains__(self, _id: str) -> bool:
+        return _id in self._labels
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+
+class ShardedIndex:
+    """
+    A vector index hash-partitioned across several shards which are searched in
+    parallel threads.
+
+    Each id is assigned to a shard by a stable hash. A search runs on all shards
+    at the same time, which scales with the number of cores as numpy and hnswlib
+    release the GIL, and the per-shard results are merged with a heap. Allow-list
+    bitmaps are the concatenation of the bitmaps of the shards.
+    """
+
+    def __init__(self, shards: List):
+        """
+        :param shards: the vector indexes holding each partition
+        """
+        self.shards = shards
+        self.space = shards[0].space
+        # started by the first search, and shut down by `clear` and `close`
+        self._pool = None
+
+    def shard_of(self, _id: str) -> int:
+        """Return the shard holding an id"""
+        return zlib.crc32(_id.encode('utf-8')) % len(self.shards)
+
+    def _group(self, ids: Iterable[str]) -> List[List[int]]:
+        """Group the positions of `ids` by shard"""
+        groups = [[] for _ in self.shards]
+        for i, _id in enumerate(ids):
+            groups[self.shard_of(_id)].append(i)
+        return groups
+
+    def add(self, ids: List[str], embeddings: np.ndarray) -> None:
+        """
+        Insert embeddings in their shards.
+
+        :param ids: ids of the Documents
+        :param embeddings: embeddings of the Documents, one row per id
+        """
+        embeddings = np.asarray(embeddings)
+        for shard, positions in zip(self.shards, self._group(ids)):
+            if positions:
+                shard.add([ids[i] for i in positions], embeddings[positions])
+
+    def delete(self, ids: Iterable[str]) -> None:
+        """
+        Remove ids from their shards. Unknown ids are ignored.
+
+        :param ids: ids of the Documents
+        """
+        ids = list(ids)
+        for shard, positions in zip(self.shards, self._group(ids)):
+            if positions:
+                shard.delete([ids[i] for i in positions])
+
+    @property
+    def mask_size(self) -> int:
+        """length of the allow-list bitmaps of the index"""
+        return sum(shard.mask_size for shard in self.shards)
+
+    def mask(self, ids: Iterable[str]) -> np.ndarray:
+        """
+        Build the allow-list bitmap of a set of ids, to be passed to `search`.
+
+        :param ids: ids of the Documents
+        :return: the bitmaps of the shards, concatenated
+        """
+        ids = list(ids)
+        return np.concatenate([
+            shard.mask([ids[i] for i in positions])
+            for shard, positions in zip(self.shards, self._group(ids))
+        ])
+
+    def search(
+        self, queries: np.ndarray, limit: int, allowed: Optional[np.ndarray] = None
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Search all shards in parallel and merge their results.
+
+        :param queries: query embeddings, one row per query
+        :param limit: number of neighbours to return per query
+        :param allowed: if given, an allow-list bitmap built with `mask`
+        :return: for every query, a list of (id, distance) sorted by distance
+        """
+        shard_masks = [None] * len(self.shards)
+        if allowed is not None:
+            allowed = fit_mask(allowed, self.mask_size)
+            offset = 0
+            for i, shard in enumerate(self.shards):
+                shard_masks[i] = allowed[offset : offset + shard.mask_size]
+                offset += shard.mask_size
+
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=len(self.shards))
+        futures = [
+            self._pool.submit(shard.search, queries, limit, shard_mask)
+            for shard, shard_mask in zip(self.shards, shard_masks)
+        ]
+        shard_results = [future.result() for future in futures]
+        return [
+            heapq.nsmallest(limit, itertools.chain(*query_results), key=lambda item: item[1])
+            for query_results in zip(*shard_results)
+        ]
+
+    def get_embeddings(self, ids: List[str]) -> np.ndarray:
+        """Return the stored vectors of the given ids"""
+        return np.stack([self.shards[self.shard_of(_id)].get_embeddings([_id])[0] for _id in ids])
+
+    def clear(self) -> None:
+        """Remove all the Documents from the index"""
+        for shard in self.shards:
+            shard.clear()
+        self.close()
+
+    def close(self) -> None:
+        """Stop the search threads. They are started again by the next search"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def save(self, path: str) -> None:
+        """Write every shard to a sub-directory of `path`"""
+        os.makedirs(path, exist_ok=True)
+        for i, shard in enumerate(self.shards):
+            shard.save(os.path.join(path, f'shard_{i}'))
+        with open(os.path.join(path, 'shards.json'), 'w') as f:
+            json.dump({'num_shards': len(self.shards)}, f)
+
+    @classmethod
+    def load(cls, path: str, load_shard: Callable[[str, int], object]) -> 'ShardedIndex':
+        """
+        Load an index written with `save`.
+
+        :param path: the directory
+        :param load_shard: function loading a shard from its directory and number
+        :return: the index
+        """
+        with open(os.path.join(path, 'shards.json'), 'r') as f:
+            num_shards = json.load(f)['num_shards']
+        return cls([load_shard(os.path.join(path, f'shard_{i}'), i) for i in range(num_shards)])
+
+    def __contains__(self, _id: str) -> bool:
+        return _id in self.shards[self.shard_of(_id)]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
@@ -0,0 +1,85 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+class QueryBatcher:
+    """
+    Coalesce concurrent encode calls into a single forward pass.
+
+    Callers `await submit(texts)`. Texts are gathered until `max_batch_size` texts
+    are waiting or `max_wait_ms` milliseconds have passed since the first one
+    arrived, then they are encoded together in a worker thread and each caller
+    gets back the embeddings of its own texts. Forward passes run one at a time,
+    so requests arriving while the model is busy are batched into the next one.
+    """
+
+    def __init__(
+        self,
+        encode_fn: Callable[[List[str]], np.ndarray],
+        max_wait_ms: float = 3.0,
+        max_batch_size: int = 64,
+    ):
+        """
+        :param encode_fn: function encoding a list of texts into an array of
+            embeddings, in the same order
+        :param max_wait_ms: maximum time the first text of a batch waits for
+            other texts to arrive
+        :param max_batch_size: number of waiting texts that triggers a forward
+            pass without waiting any longer
+        """
+        self.encode_fn = encode_fn
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        self._pending_size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode texts together with the ones submitted concurrently.
+
+        :param texts: the texts to encode
+        :return: the embeddings of `texts`, in the same order
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((texts, future))
+        self._pending_size += len(texts)
+        if self._pending_size >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending, self._pending_size = self._pending, [], 0
+        if pending:
+            asyncio.get_running_loop().create_task(self._run(pending))
+
+    async def _run(self, pending: List[Tuple[List[str], asyncio.Future]]) -> None:
+        texts = [text for batch_texts, _ in pending for text in batch_texts]
+        try:
+            embeddings = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self.encode_fn, texts
+            )
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        offset = 0
+        for batch_texts, future in pending:
+            if not future.done():
+                future.set_result(embeddings[offset : offset + len(batch_texts)])
+            offset += len(batch_texts)
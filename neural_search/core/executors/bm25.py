@@ -0,0 +1,157 @@
+import json
+import math
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Split a text into lowercase word tokens, keeping numbers and symbols such as
+    tickers as tokens of their own"""
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+class BM25Index:
+    """
+    An in-process lexical inverted index over Document texts, scored with BM25.
+
+    Every Document is given a row, the postings of a term map rows to term
+    frequencies and the lengths of the Documents are kept in an array, so scoring a
+    query term is a few vectorized operations over its posting list.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        """
+        :param k1: term frequency saturation of BM25
+        :param b: document length normalization of BM25
+        """
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._doc_terms: Dict[str, Dict[str, int]] = {}
+        self._rows: Dict[str, int] = {}
+        self._ids: List[Optional[str]] = []
+        self._free_rows: List[int] = []
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._total_length = 0
+
+    def add(self, ids: List[str], texts: List[Optional[str]]) -> None:
+        """
+        Index texts, replacing the ones indexed before for the same ids.
+
+        :param ids: ids of the Documents
+        :param texts: texts of the Documents, one per id
+        """
+        self.remove(ids)
+        for _id, text in zip(ids, texts):
+            terms = {}
+            for token in tokenize(text):
+                terms[token] = terms.get(token, 0) + 1
+            self._add_terms(_id, terms)
+
+    def _add_terms(self, _id: str, terms: Dict[str, int]) -> None:
+        """Index the term frequencies of a Document not in the index"""
+        if not terms:
+            return
+        if self._free_rows:
+            row = self._free_rows.pop()
+            self._ids[row] = _id
+        else:
+            row = len(self._ids)
+            self._ids.append(_id)
+        if row >= len(self._lengths):
+            self._lengths = np.concatenate(
+                [self._lengths, np.zeros(max(1024, len(self._lengths)), dtype=np.float32)]
+            )
+        self._rows[_id] = row
+        self._lengths[row] = sum(terms.values())
+        self._total_length += int(self._lengths[row])
+        self._doc_terms[_id] = terms
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[row] = tf
+
+    def remove(self, ids: Iterable[str]) -> None:
+        """
+        Remove Documents from the index. Unknown ids are ignored.
+
+        :param ids: ids of the Documents
+        """
+        for _id in ids:
+            terms = self._doc_terms.pop(_id, None)
+            if terms is None:
+                continue
+            row = self._rows.pop(_id)
+            for term in terms:
+                postings = self._postings[term]
+                del postings[row]
+                if not postings:
+                    del self._postings[term]
+            self._total_length -= int(self._lengths[row])
+            self._lengths[row] = 0
+            self._ids[row] = None
+            self._free_rows.append(row)
+
+    def clear(self) -> None:
+        self.__init__(k1=self.k1, b=self.b)
+
+    def search(
+        self, query: str, limit: int, allowed: Optional[Iterable[str]] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Find the Documents with the highest BM25 score for a query.
+
+        :param query: the query text
+        :param limit: number of Documents to return
+        :param allowed: if given, only these ids can be returned
+        :return: a list of (id, BM25 score) sorted by decreasing score
+        """
+        num_docs = len(self._rows)
+        if num_docs == 0 or limit <= 0:
+            return []
+        size = len(self._ids)
+        average_length = self._total_length / num_docs
+        norms = self.k1 * (1 - self.b + self.b * self._lengths[:size] / average_length)
+        scores = np.zeros(size, dtype=np.float32)
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            rows = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+            tfs = np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+            scores[rows] += idf * tfs * (self.k1 + 1) / (tfs + norms[rows])
+
+        if allowed is not None:
+            mask = np.zeros(size, dtype=bool)
+            rows = [self._rows[_id] for _id in allowed if _id in self._rows]
+            mask[rows] = True
+            scores[~mask] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(self._ids[row], float(scores[row])) for row in candidates]
+
+    def save(self, path: str) -> None:
+        """Persist the index to a json file"""
+        with open(path, 'w') as f:
+            json.dump({'k1': self.k1, 'b': self.b, 'doc_terms': self._doc_terms}, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'BM25Index':
+        """Load an index persisted with `save`"""
+        with open(path, 'r') as f:
+            data = json.load(f)
+        index = cls(k1=data['k1'], b=data['b'])
+        for _id, terms in data['doc_terms'].items():
+            index._add_terms(_id, terms)
+        return index
+
+    def __contains__(self, _id: str) -> bool:
+        return _id in self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
@@ -0,0 +1,92 @@
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Encoder instance of the current worker process, created by `_init_worker`
+_worker_encoder = None
+
+
+def _init_worker(encoder_kwargs: Dict, num_threads: int) -> None:
+    import torch
+
+    torch.set_num_threads(num_threads)
+
+    from neural_search.core.executors.encoder import CustomTransformerTorchEncoder
+
+    global _worker_encoder
+    _worker_encoder = CustomTransformerTorchEncoder(**encoder_kwargs)
+
+
+def _encode_shard(
+    shm_name: str, shape: Tuple[int, int], start: int, texts: List[str], encode_kwargs: Dict
+) -> int:
+    embeddings = _worker_encoder._encode_texts(texts, **encode_kwargs)
+    shm = SharedMemory(name=shm_name)
+    try:
+        output = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        output[start : start + len(texts)] = embeddings
+        # the view must be released before the shared memory can be closed
+        del output
+    finally:
+        shm.close()
+    return len(texts)
+
+
+class BulkEncoderPool:
+    """
+    A pool of worker processes, each holding its own encoder replica with a pinned
+    number of torch threads.
+
+    Texts are split into contiguous shards which are encoded in parallel. Every
+    worker writes its embeddings straight into a shared memory buffer at the
+    offset of its shard, so the result keeps the input order and embeddings are
+    never pickled back to the parent process.
+    """
+
+    def __init__(
+        self, encoder_kwargs: Dict, dim: int, num_workers: int, threads_per_worker: int = 1
+    ):
+        """
+        :param encoder_kwargs: arguments used to build the encoder of each worker
+        :param dim: dimension of the embeddings
+        :param num_workers: number of worker processes
+        :param threads_per_worker: number of torch threads of each worker
+        """
+        self.dim = dim
+        self._pool = multiprocessing.get_context('spawn').Pool(
+            num_workers,
+            initializer=_init_worker,
+            initargs=(encoder_kwargs, threads_per_worker),
+        )
+
+    def encode(self, texts: List[str], shard_size: int, **encode_kwargs) -> np.ndarray:
+        """
+        Encode texts across the worker processes.
+
+        :param texts: the texts to encode
+        :param shard_size: number of texts sent to a worker at once
+        :param encode_kwargs: batching arguments of `_encode_texts`
+        :return: the embeddings of `texts`, in the same order
+        """
+        shape = (len(texts), self.dim)
+        shm = SharedMemory(create=True, size=max(1, shape[0] * shape[1] * 4))
+        try:
+            jobs = [
+                self._pool.apply_async(
+                    _encode_shard,
+                    (shm.name, shape, start, texts[start : start + shard_size], encode_kwargs),
+                )
+                for start in range(0, len(texts), shard_size)
+            ]
+            for job in jobs:
+                job.get()
+            return np.ndarray(shape, dtype=np.float32, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def close(self) -> None:
+        self._pool.terminate()
+        self._pool.join()
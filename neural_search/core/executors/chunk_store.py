@@ -0,0 +1,240 @@
+import json
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from neural_search.core.columns import ColumnSlice, StringColumn, StringColumnWriter, find_sorted
+
+
+class ChunkStore:
+    """
+    The position, text and tags of the chunks of every indexed Document.
+
+    Maps each chunk id to its parent id and ordinal, and keeps per parent the
+    ordered chunk ids, texts and tags, so that the context of a match is a slice
+    of its parent's chunk texts instead of a scan over the parent's chunks.
+
+    Chunks may carry their character offset in the text of their parent as their
+    `location`, in which case the text shared by overlapping chunks is only
+    included once in a context.
+
+    The Documents loaded from a saved store stay in memory-mapped columns, and
+    their ids are looked up by a binary search over the sort order saved with the
+    columns, so loading a store decodes nothing. The Documents added afterwards
+    are held in memory, and the saved ones removed or replaced are masked.
+    """
+
+    def __init__(self):
+        self._positions: Dict[str, Tuple[str, int]] = {}
+        self._parents: Dict[str, Dict] = {}
+        self._saved = None
+        self._removed_saved: set = set()
+        self._num_removed_saved_chunks = 0
+
+    def add(self, docs: Iterable) -> None:
+        """
+        Add (or replace) Documents and their chunks.
+
+        :param docs: the root Documents
+        """
+        for doc in docs:
+            self.remove([doc.id])
+            self._parents[doc.id] = {
+                'text': doc.text,
+                'chunk_ids': [c.id for c in doc.chunks],
+                'texts': [c.text for c in doc.chunks],
+                'tags': [dict(c.tags) for c in doc.chunks],
+                'offsets': [int(c.location[0]) if c.location else -1 for c in doc.chunks],
+            }
+            for i, c in enumerate(doc.chunks):
+                self._positions[c.id] = (doc.id, i)
+
+    def remove(self, parent_ids: Iterable[str]) -> List[str]:
+        """
+        Remove Documents and their chunks. Unknown ids are ignored.
+
+        :param parent_ids: ids of the root Documents
+        :return: the ids of the removed chunks
+        """
+        removed = []
+        for parent_id in parent_ids:
+            parent = self._parents.pop(parent_id, None)
+            if parent is not None:
+                for chunk_id in parent['chunk_ids']:
+                    self._positions.pop(chunk_id, None)
+                removed += list(parent['chunk_ids'])
+                continue
+            parent = self._saved_parent(parent_id)
+            if parent is not None:
+                self._removed_saved.add(parent_id)
+                self._num_removed_saved_chunks += len(parent['chunk_ids'])
+                removed += list(parent['chunk_ids'])
+        return removed
+
+    def clear(self) -> None:
+        self._positions = {}
+        self._parents = {}
+        self._saved = None
+        self._removed_saved = set()
+        self._num_removed_saved_chunks = 0
+
+    def save(self, path: str) -> None:
+        """
+        Write the store to a directory as offset-indexed binary columns, with the
+        sort order of the parent and chunk ids.
+
+        :param path: the directory
+        """
+        os.makedirs(path, exist_ok=True)
+        chunk_ends, chunk_offsets = [], []
+        all_parent_ids, all_chunk_ids = [], []
+        with StringColumnWriter(os.path.join(path, 'parent_ids')) as parent_ids, \
+                StringColumnWriter(os.path.join(path, 'parent_texts')) as parent_texts, \
+                StringColumnWriter(os.path.join(path, 'chunk_ids')) as chunk_ids, \
+                StringColumnWriter(os.path.join(path, 'chunk_texts')) as chunk_texts, \
+                StringColumnWriter(os.path.join(path, 'chunk_tags')) as chunk_tags:
+            for parent_id, parent in self._iter_parents():
+                parent_ids.append(parent_id)
+                parent_texts.append(parent['text'] or '')
+                chunk_ids.extend(parent['chunk_ids'])
+                chunk_texts.extend(text or '' for text in parent['texts'])
+                chunk_tags.extend(json.dumps(tags) for tags in parent['tags'])
+                chunk_offsets.extend(parent['offsets'])
+                chunk_ends.append((chunk_ends[-1] if chunk_ends else 0) + len(parent['chunk_ids']))
+                all_parent_ids.append(parent_id)
+                all_chunk_ids.extend(parent['chunk_ids'])
+        chunk_ends = np.array(chunk_ends, dtype=np.int64)
+        np.save(os.path.join(path, 'parent_chunk_ends.npy'), chunk_ends)
+        np.save(os.path.join(path, 'chunk_offsets.npy'), np.array(chunk_offsets, dtype=np.int64))
+        np.save(os.path.join(path, 'parent_order.npy'), self._sort_order(all_parent_ids))
+        np.save(os.path.join(path, 'chunk_order.npy'), self._sort_order(all_chunk_ids))
+        # the parent row of every chunk
+        np.save(
+            os.path.join(path, 'chunk_parents.npy'),
+            np.repeat(np.arange(len(chunk_ends)), np.diff(chunk_ends, prepend=0)),
+        )
+
+    def load(self, path: str) -> None:
+        """
+        Load a store written with `save`, replacing the current content. The ids,
+        texts and tags are memory-mapped and only decoded when accessed.
+
+        :param path: the directory
+        """
+        self.clear()
+        self._saved = {
+            'parent_ids': StringColumn(os.path.join(path, 'parent_ids')),
+            'parent_texts': StringColumn(os.path.join(path, 'parent_texts')),
+            'chunk_ids': StringColumn(os.path.join(path, 'chunk_ids')),
+            'chunk_texts': StringColumn(os.path.join(path, 'chunk_texts')),
+            'chunk_tags': StringColumn(os.path.join(path, 'chunk_tags'), decode=json.loads),
+        }
+        for name in ['parent_chunk_ends', 'chunk_offsets', 'parent_order', 'chunk_order', 'chunk_parents']:
+            self._saved[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+
+    def position(self, chunk_id: str) -> Tuple[str, int]:
+        """Return the parent id and the ordinal of a chunk"""
+        position = self._positions.get(chunk_id) or self._saved_position(chunk_id)
+        if position is None:
+            raise KeyError(chunk_id)
+        return position
+
+    def chunk(self, chunk_id: str) -> Tuple[str, Dict]:
+        """Return the text and the tags of a chunk"""
+        parent_id, i = self.position(chunk_id)
+        parent = self._parent(parent_id)
+        return parent['texts'][i], parent['tags'][i]
+
+    def chunk_ids(self, parent_id: str) -> List[str]:
+        """Return the ordered chunk ids of a Document"""
+        parent = self._parent(parent_id)
+        return list(parent['chunk_ids']) if parent is not None else []
+
+    def has_parent(self, parent_id: str) -> bool:
+        """Whether a root Document is in the store"""
+        return self._parent(parent_id) is not None
+
+    def parent_text(self, parent_id: str) -> Optional[str]:
+        return self._parent(parent_id)['text']
+
+    def context(self, chunk_id: str, context_length: int) -> str:
+        """
+        Join the texts of the chunks surrounding a chunk in its parent.
+
+        :param chunk_id: id of the chunk
+        :param context_length: number of chunks taken on each side
+        :return: the context of the chunk
+        """
+        parent_id, i = self.position(chunk_id)
+        parent = self._parent(parent_id)
+        start, end = max(0, i - context_length), i + context_length
+        texts = parent['texts'][start:end]
+        offsets = parent['offsets'][start:end]
+        if len(offsets) == 0 or min(offsets) < 0:
+            return ' '.join(texts)
+
+        # skip the beginning of a chunk already covered by the previous ones
+        pieces, covered = [], 0
+        for text, offset in zip(texts, offsets):
+            offset = int(offset)
+            piece = text[max(0, covered - offset):].lstrip() if pieces else text
+            if piece:
+                pieces.append(piece)
+            covered = max(covered, offset + len(text))
+        return ' '.join(pieces)
+
+    def _parent(self, parent_id: str) -> Optional[Dict]:
+        parent = self._parents.get(parent_id)
+        return parent if parent is not None else self._saved_parent(parent_id)
+
+    def _saved_parent(self, parent_id: str) -> Optional[Dict]:
+        """Return the columns of a saved Document, unless it was removed since"""
+        if self._saved is None or parent_id in self._removed_saved:
+            return None
+        row = find_sorted(self._saved['parent_ids'], self._saved['parent_order'], parent_id)
+        return self._saved_parent_at(row) if row >= 0 else None
+
+    def _saved_parent_at(self, row: int) -> Dict:
+        chunk_ends = self._saved['parent_chunk_ends']
+        start, end = (int(chunk_ends[row - 1]) if row > 0 else 0), int(chunk_ends[row])
+        return {
+            'text': self._saved['parent_texts'][row],
+            'chunk_ids': ColumnSlice(self._saved['chunk_ids'], start, end),
+            'texts': ColumnSlice(self._saved['chunk_texts'], start, end),
+            'tags': ColumnSlice(self._saved['chunk_tags'], start, end),
+            'offsets': ColumnSlice(self._saved['chunk_offsets'], start, end),
+        }
+
+    def _saved_position(self, chunk_id: str) -> Optional[Tuple[str, int]]:
+        """Return the parent id and the ordinal of a saved chunk, unless its parent
+        was removed since"""
+        if self._saved is None:
+            return None
+        row = find_sorted(self._saved['chunk_ids'], self._saved['chunk_order'], chunk_id)
+        if row < 0:
+            return None
+        parent_row = int(self._saved['chunk_parents'][row])
+        parent_id = self._saved['parent_ids'][parent_row]
+        if parent_id in self._removed_saved:
+            return None
+        start = int(self._saved['parent_chunk_ends'][parent_row - 1]) if parent_row > 0 else 0
+        return parent_id, row - start
+
+    def _iter_parents(self) -> Iterator[Tuple[str, Dict]]:
+        if self._saved is not None:
+            for row, parent_id in enumerate(self._saved['parent_ids']):
+                if parent_id not in self._removed_saved:
+                    yield parent_id, self._saved_parent_at(row)
+        yield from self._parents.items()
+
+    @staticmethod
+    def _sort_order(ids: List[str]) -> np.ndarray:
+        return np.array(sorted(range(len(ids)), key=ids.__getitem__), dtype=np.int64)
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self._positions or self._saved_position(chunk_id) is not None
+
+    def __len__(self) -> int:
+        num_saved = len(self._saved['chunk_ids']) - self._num_removed_saved_chunks if self._saved else 0
+        return len(self._positions) + num_saved
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import threading
+from hashlib import sha256
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    A persistent embedding cache stored in a sqlite file.
+
+    Entries are addressed by the hash of the encoder configuration and the
+    normalized text, so identical sentences are only encoded once across index
+    calls and across reports. The number of entries is bounded and the least
+    recently used ones are evicted first.
+
+    Lookups do not write to the file: the keys they use are stamped in memory and
+    the stamps are written with the next `put_many`, or once enough of them are
+    pending, in a single transaction. The number of entries is kept in memory too.
+    """
+
+    _QUERY_CHUNK_SIZE = 500
+    _MAX_PENDING_TOUCHES = 10000
+
+    def __init__(self, path: str, max_entries: int = 1000000):
+        """
+        :param path: path of the sqlite file holding the cache
+        :param max_entries: maximum number of embeddings kept in the cache
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used INTEGER NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)'
+        )
+        self._conn.commit()
+        self._clock, self._size = self._conn.execute(
+            'SELECT COALESCE(MAX(last_used), 0), COUNT(*) FROM embeddings'
+        ).fetchone()
+        self._pending_touches: Dict[str, int] = {}
+
+    @staticmethod
+    def make_key(namespace: Tuple, text: str) -> str:
+        """
+        Build the cache key of a text.
+
+        :param namespace: encoder settings the embedding depends on
+        :param text: the text to encode
+        :return: hex digest identifying the embedding
+        """
+        normalized_text = ' '.join(text.split())
+        return sha256(
+            '\x1f'.join(map(str, namespace + (normalized_text,))).encode('utf-8')
+        ).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Look up the embeddings of the given keys and mark them as recently used.
+
+        :param keys: cache keys
+        :return: dictionary with the embeddings of the keys found in the cache
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            self._clock += 1
+            for start in range(0, len(unique_keys), self._QUERY_CHUNK_SIZE):
+                chunk = unique_keys[start : start + self._QUERY_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})',
+                    chunk,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+                    self._pending_touches[key] = self._clock
+            if len(self._pending_touches) >= self._MAX_PENDING_TOUCHES:
+                self._flush_touches()
+                self._conn.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def _flush_touches(self) -> None:
+        """Write the pending last used stamps, without committing"""
+        if self._pending_touches:
+            self._conn.executemany(
+                'UPDATE embeddings SET last_used = ? WHERE key = ?',
+                [(clock, key) for key, clock in self._pending_touches.items()],
+            )
+            self._pending_touches = {}
+
+    def _count_existing(self, keys: List[str]) -> int:
+        """Count the keys already stored"""
+        count = 0
+        for start in range(0, len(keys), self._QUERY_CHUNK_SIZE):
+            chunk = keys[start : start + self._QUERY_CHUNK_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            count += self._conn.execute(
+                f'SELECT COUNT(*) FROM embeddings WHERE key IN ({placeholders})', chunk
+            ).fetchone()[0]
+        return count
+
+    def put_many(self, items: Dict[str, np.ndarray]) -> None:
+        """
+        Store embeddings and evict the least recently used entries if the cache is
+        over its size bound.
+
+        :param items: dictionary from cache key to embedding
+        """
+        if not items:
+            return
+        with self._lock:
+            self._flush_touches()
+            self._clock += 1
+            self._size += len(items) - self._count_existing(list(items))
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)',
+                [
+                    (key, np.asarray(embedding, dtype=np.float32).tobytes(), self._clock)
+                    for key, embedding in items.items()
+                ],
+            )
+            overflow = self._size - self.max_entries
+            if overflow > 0:
+                self._size -= self._conn.execute(
+                    'DELETE FROM embeddings WHERE key IN '
+                    '(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)',
+                    (overflow,),
+                ).rowcount
+            self._conn.commit()
+
+    def stats(self) -> Dict:
+        """Return the hit/miss counters and the size of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self),
+            'max_entries': self.max_entries,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touches()
+            self._conn.commit()
+            self._conn.close()
+
+    def __len__(self) -> int:
+        return self._size
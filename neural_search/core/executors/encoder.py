@@ -1,4 +1,6 @@
-from typing import Dict, Optional, Tuple
+import os
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import torch
@@ -8,6 +10,10 @@ from transformers import AutoModel, AutoTokenizer
 from jina import Executor, requests
 from docarray import DocumentArray
 
+from neural_search.core.executors.batching import QueryBatcher
+from neural_search.core.executors.bulk_encoding import BulkEncoderPool
+from neural_search.core.executors.embedding_cache import EmbeddingCache
+
 class CustomTransformerTorchEncoder(Executor):
     """The CustomTransformerTorchEncoder encodes sentences into embeddings using transformers models."""
 
@@ -22,6 +28,19 @@ class CustomTransformerTorchEncoder(Executor):
         device: str = None,
         traversal_paths: str = '@r',
         batch_size: int = 32,
+        length_bucketing: bool = False,
+        max_tokens_per_batch: int = 8192,
+        cache_path: Optional[str] = None,
+        cache_max_entries: int = 1000000,
+        backend: str = 'torch',
+        onnx_path: Optional[str] = None,
+        query_batching: bool = False,
+        query_max_wait_ms: float = 3.0,
+        query_max_batch_size: int = 64,
+        num_bulk_workers: int = 0,
+        threads_per_worker: int = 1,
+        bulk_shard_size: int = 256,
+        bulk_min_texts: int = 1024,
         *args,
         **kwargs,
     ):
@@ -41,11 +60,43 @@ class CustomTransformerTorchEncoder(Executor):
              received `DocumentArray`
         :param batch_size: Defines the batch size for inference on the loaded
             PyTorch model.
+        :param length_bucketing: If True, texts are sorted by token length before
+            batching so that each batch is padded to a similar length. Embeddings are
+            written back in the original order.
+        :param max_tokens_per_batch: Token budget (batch size x padded length) of a
+            batch when `length_bucketing` is enabled. `batch_size` is still used as an
+            upper bound on the number of texts per batch.
+        :param cache_path: Path of the sqlite file used as a persistent embedding
+            cache. Texts already in the cache are not sent through the model. By
+            default no cache is used.
+        :param cache_max_entries: Maximum number of embeddings kept in the cache. The
+            least recently used ones are evicted first.
+        :param backend: Inference backend. The allowed values are ``'torch'`` (eager
+            PyTorch), ``'torch_int8'`` (dynamic int8 quantization of the linear layers,
+            CPU only) and ``'onnx'`` (exported graph run with onnxruntime).
+        :param onnx_path: Path of the exported ONNX graph for the ``'onnx'`` backend.
+            The model is exported there if the file does not exist yet, otherwise the
+            existing file is reused. By default a temporary file is used.
+        :param query_batching: If True, the texts of concurrent `/search` requests are
+            gathered and encoded in a single forward pass.
+        :param query_max_wait_ms: Maximum time in milliseconds a query waits for
+            other queries to be batched with.
+        :param query_max_batch_size: Number of waiting query texts that triggers a
+            forward pass right away.
+        :param num_bulk_workers: Number of worker processes used to encode large
+            requests, such as bulk indexing. Each worker loads its own copy of the
+            model. By default everything is encoded in the executor process.
+        :param threads_per_worker: Number of torch threads of each bulk worker.
+        :param bulk_shard_size: Number of texts sent to a bulk worker at once.
+        :param bulk_min_texts: Minimum number of texts to encode for a request to be
+            spread across the bulk workers.
         """
         super().__init__(*args, **kwargs)
 
         self.traversal_paths = traversal_paths
         self.batch_size = batch_size
+        self.length_bucketing = length_bucketing
+        self.max_tokens_per_batch = max_tokens_per_batch
 
         base_tokenizer_model = base_tokenizer_model or pretrained_model_name_or_path
 
@@ -53,14 +104,71 @@ class CustomTransformerTorchEncoder(Executor):
         self.layer_index = layer_index
         self.max_length = max_length
 
+        self._model_kwargs = dict(
+            pretrained_model_name_or_path=pretrained_model_name_or_path,
+            base_tokenizer_model=base_tokenizer_model,
+            pooling_strategy=pooling_strategy,
+            layer_index=layer_index,
+            max_length=max_length,
+            embedding_fn_name=embedding_fn_name,
+            device=device,
+            backend=backend,
+            onnx_path=onnx_path,
+        )
+
         self.device = torch.device(device)
         self.embedding_fn_name = embedding_fn_name
+        self.pretrained_model_name_or_path = pretrained_model_name_or_path
 
         self.tokenizer = AutoTokenizer.from_pretrained(base_tokenizer_model)
         self.model = AutoModel.from_pretrained(
             pretrained_model_name_or_path, output_hidden_states=True
         )
         self.model.to(device).eval()
+        self._ensure_pad_token()
+
+        self.backend = backend
+        self._quantized_model = None
+        self._onnx_session = None
+        if backend == 'torch_int8':
+            if self.device.type != 'cpu':
+                raise ValueError('The torch_int8 backend only runs on cpu')
+            self._quantized_model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        elif backend == 'onnx':
+            self._onnx_session = self._load_onnx_session(onnx_path)
+        elif backend != 'torch':
+            raise ValueError(
+                f'backend should be one of "torch", "torch_int8" or "onnx", got "{backend}"'
+            )
+
+        self._cache = (
+            EmbeddingCache(cache_path, max_entries=cache_max_entries)
+            if cache_path
+            else None
+        )
+
+        self._query_batcher = (
+            QueryBatcher(
+                lambda texts: self._encode_texts_cached(
+                    texts,
+                    batch_size=query_max_batch_size,
+                    length_bucketing=self.length_bucketing,
+                    max_tokens_per_batch=self.max_tokens_per_batch,
+                ),
+                max_wait_ms=query_max_wait_ms,
+                max_batch_size=query_max_batch_size,
+            )
+            if query_batching
+            else None
+        )
+
+        self.num_bulk_workers = num_bulk_workers
+        self.threads_per_worker = threads_per_worker
+        self.bulk_shard_size = bulk_shard_size
+        self.bulk_min_texts = bulk_min_texts
+        self._bulk_pool = None
 
     @requests
     def encode(self, docs: DocumentArray, parameters: Dict={}, **kwargs):
@@ -68,38 +176,282 @@ class CustomTransformerTorchEncoder(Executor):
         Encode text data into a ndarray of `D` as dimension, and fill the embedding of
         each Document.
         :param docs: DocumentArray containing text
-        :param parameters: dictionary to define the `traversal_paths` and the
-            `batch_size`. For example,
+        :param parameters: dictionary to define the `traversal_paths`, the
+            `batch_size`, `length_bucketing` and `max_tokens_per_batch`. For example,
             `parameters={'traversal_paths': 'r', 'batch_size': 10}`.
         :param kwargs: Additional key value arguments.
         """
 
-        docs_batch_generator =  DocumentArray(
+        docs_to_encode = self._docs_to_encode(docs, parameters)
+        if len(docs_to_encode) == 0:
+            return
+
+        docs_to_encode.embeddings = self._encode_texts_cached(
+            docs_to_encode.texts,
+            batch_size=parameters.get('batch_size', self.batch_size),
+            length_bucketing=parameters.get('length_bucketing', self.length_bucketing),
+            max_tokens_per_batch=parameters.get(
+                'max_tokens_per_batch', self.max_tokens_per_batch
+            ),
+        )
+
+    @requests(on='/search')
+    async def search(self, docs: DocumentArray, parameters: Dict={}, **kwargs):
+        """
+        Encode query Documents. If `query_batching` is enabled, the texts of
+        concurrent requests are encoded together in a single forward pass.
+        :param docs: DocumentArray containing text
+        :param parameters: same as in `encode`
+        :param kwargs: Additional key value arguments.
+        """
+        if self._query_batcher is None:
+            return self.encode(docs, parameters)
+
+        docs_to_encode = self._docs_to_encode(docs, parameters)
+        if len(docs_to_encode) == 0:
+            return
+        docs_to_encode.embeddings = await self._query_batcher.submit(
+            docs_to_encode.texts
+        )
+
+    def _docs_to_encode(self, docs: DocumentArray, parameters: Dict) -> DocumentArray:
+        return DocumentArray(
             filter(
                 lambda x: bool(x.text),
                 docs[parameters.get('traversal_paths', self.traversal_paths)],
             )
-        ).batch(batch_size=parameters.get('batch_size', self.batch_size))
+        )
+
+    @requests(on='/cache_stats')
+    def cache_stats(self, **kwargs) -> dict:
+        """return the hit/miss counters and size of the embedding cache"""
+        return {'cache_stats': self._cache.stats() if self._cache else None}
+
+    def close(self):
+        if self._bulk_pool is not None:
+            self._bulk_pool.close()
+        if self._query_batcher is not None:
+            self._query_batcher.close()
+        if self._cache is not None:
+            self._cache.close()
+        super().close()
+
+    def _cache_namespace(self) -> Tuple:
+        """Encoder settings which identify the embeddings stored in the cache"""
+        return (
+            self.pretrained_model_name_or_path,
+            self.pooling_strategy,
+            self.layer_index,
+            self.max_length,
+            self.backend,
+        )
+
+    def _encode_texts_cached(self, texts: List[str], **kwargs) -> np.ndarray:
+        """
+        Encode texts going through the embedding cache, if any. Only the distinct
+        texts missing from the cache are sent through the model.
+        """
+        if self._cache is None:
+            return self._encode_uncached(texts, **kwargs)
+
+        namespace = self._cache_namespace()
+        keys = [EmbeddingCache.make_key(namespace, text) for text in texts]
+        cached = self._cache.get_many(keys)
 
-        for batch in docs_batch_generator:
-            texts = batch.texts
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            new_embeddings = self._encode_uncached(list(missing.values()), **kwargs)
+            new_items = dict(zip(missing.keys(), new_embeddings))
+            self._cache.put_many(new_items)
+            cached.update(new_items)
+
+        return np.stack([cached[key] for key in keys])
+
+    def _encode_uncached(self, texts: List[str], **kwargs) -> np.ndarray:
+        """Encode texts in this process, or across the bulk workers for large inputs"""
+        if self.num_bulk_workers <= 0 or len(texts) < self.bulk_min_texts:
+            return self._encode_texts(texts, **kwargs)
+
+        if self._bulk_pool is None:
+            self._bulk_pool = BulkEncoderPool(
+                self._model_kwargs,
+                dim=self.model.config.hidden_size,
+                num_workers=self.num_bulk_workers,
+                threads_per_worker=self.threads_per_worker,
+            )
+        return self._bulk_pool.encode(texts, shard_size=self.bulk_shard_size, **kwargs)
 
+    def _encode_texts(
+        self,
+        texts: List[str],
+        batch_size: int,
+        length_bucketing: bool = False,
+        max_tokens_per_batch: Optional[int] = None,
+    ) -> np.ndarray:
+        """Encode texts into an array of embeddings, in the same order as `texts`"""
+        self._ensure_pad_token()
+        embeddings = [None] * len(texts)
+
+        if length_bucketing:
+            encodings = self.tokenizer(
+                texts, max_length=self.max_length, truncation=True
+            )
+            lengths = [len(ids) for ids in encodings['input_ids']]
+            for batch_ids in self._length_bucketed_batches(
+                lengths, batch_size, max_tokens_per_batch or self.max_tokens_per_batch
+            ):
+                input_tokens = self.tokenizer.pad(
+                    {k: [v[i] for i in batch_ids] for k, v in encodings.items()},
+                    padding='longest',
+                    return_tensors='pt',
+                )
+                input_tokens = {k: v.to(self.device) for k, v in input_tokens.items()}
+                for i, embed in zip(batch_ids, self._embed_batch(input_tokens)):
+                    embeddings[i] = embed
+        else:
+            for start in range(0, len(texts), batch_size):
+                input_tokens = self._generate_input_tokens(
+                    texts[start : start + batch_size]
+                )
+                embeddings[start : start + batch_size] = list(
+                    self._embed_batch(input_tokens)
+                )
+
+        return np.stack(embeddings)
+
+    @staticmethod
+    def _length_bucketed_batches(
+        lengths: List[int], batch_size: int, max_tokens_per_batch: int
+    ) -> Iterator[List[int]]:
+        """
+        Group text positions into batches of similar token length.
+
+        Positions are visited in ascending length order, so the padded length of a
+        batch is the length of its last text. A batch is closed as soon as adding
+        the next text would exceed `max_tokens_per_batch` padded tokens or
+        `batch_size` texts. A single text longer than the budget gets its own batch.
+        """
+        batch = []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            if batch and (
+                len(batch) >= batch_size
+                or (len(batch) + 1) * lengths[i] > max_tokens_per_batch
+            ):
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    @requests(on='/backend_parity')
+    def backend_parity(self, docs: DocumentArray, parameters: Dict={}, **kwargs) -> dict:
+        """
+        Compare the embeddings of the selected backend against the fp32 eager torch
+        model on the texts of `docs`, without modifying them.
+        :param docs: DocumentArray containing the sample texts
+        :param parameters: dictionary to define the `traversal_paths` and the
+            `batch_size`.
+        :return: the cosine similarity statistics between both embeddings
+        """
+        texts = [
+            d.text
+            for d in docs[parameters.get('traversal_paths', self.traversal_paths)]
+            if d.text
+        ]
+        return {'parity': self.check_backend_parity(
+            texts, batch_size=parameters.get('batch_size', self.batch_size)
+        )}
+
+    def check_backend_parity(self, texts: List[str], batch_size: int = 32) -> Dict:
+        """
+        Report the cosine drift of the selected backend against the fp32 embeddings.
+
+        :param texts: sample texts to encode with both models
+        :param batch_size: batch size used for inference
+        :return: dictionary with the mean and minimum cosine similarity and the
+            maximum drift (1 - cosine similarity)
+        """
+        cosines = []
+        for start in range(0, len(texts), batch_size):
+            input_tokens = self._generate_input_tokens(texts[start : start + batch_size])
+            embeds = self._embed_batch(input_tokens)
             with torch.inference_mode():
-                input_tokens = self._generate_input_tokens(texts)
                 outputs = getattr(self.model, self.embedding_fn_name)(**input_tokens)
-                if isinstance(outputs, torch.Tensor):
-                    outputs = outputs.cpu().numpy()
-                hidden_states = outputs.hidden_states
-                embeds = self._compute_embedding(hidden_states, input_tokens)
-                batch.embeddings = embeds
+                reference = self._compute_embedding(
+                    outputs.hidden_states[self.layer_index], input_tokens
+                )
+            norms = np.linalg.norm(embeds, axis=1) * np.linalg.norm(reference, axis=1)
+            cosines.append((embeds * reference).sum(axis=1) / np.maximum(norms, 1e-12))
 
+        cosines = np.concatenate(cosines) if cosines else np.zeros(0)
+        return {
+            'backend': self.backend,
+            'num_texts': len(cosines),
+            'mean_cosine': float(cosines.mean()) if len(cosines) else None,
+            'min_cosine': float(cosines.min()) if len(cosines) else None,
+            'max_drift': float(1.0 - cosines.min()) if len(cosines) else None,
+        }
 
-    def _compute_embedding(
-        self, hidden_states: Tuple['torch.Tensor'], input_tokens: Dict
-    ):
+    def _load_onnx_session(self, onnx_path: Optional[str] = None):
+        """Export the model to ONNX, unless already exported, and open a session"""
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError(
+                'The onnx backend requires onnxruntime, install it with '
+                '`pip install onnxruntime`'
+            )
+
+        if onnx_path is None:
+            onnx_path = os.path.join(tempfile.mkdtemp(), 'encoder.onnx')
+        if not os.path.exists(onnx_path):
+            os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+            dummy_tokens = self._generate_input_tokens(['annual report'])
+            input_names = list(dummy_tokens.keys())
+            dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+            dynamic_axes['layer'] = {0: 'batch', 1: 'sequence'}
+            with torch.no_grad():
+                torch.onnx.export(
+                    _SelectedLayer(self.model, self.embedding_fn_name, self.layer_index, input_names),
+                    tuple(dummy_tokens[name] for name in input_names),
+                    onnx_path,
+                    input_names=input_names,
+                    output_names=['layer'],
+                    dynamic_axes=dynamic_axes,
+                    opset_version=14,
+                )
+
+        session = onnxruntime.InferenceSession(
+            onnx_path, providers=['CPUExecutionProvider']
+        )
+        self._onnx_input_names = [i.name for i in session.get_inputs()]
+        return session
+
+    def _forward_layer(self, input_tokens: Dict) -> 'torch.Tensor':
+        """Run the selected backend and return the hidden states of `layer_index`"""
+        if self._onnx_session is not None:
+            layer = self._onnx_session.run(
+                None,
+                {name: input_tokens[name].cpu().numpy() for name in self._onnx_input_names},
+            )[0]
+            return torch.from_numpy(layer).to(self.device)
+
+        model = self._quantized_model if self._quantized_model is not None else self.model
+        outputs = getattr(model, self.embedding_fn_name)(**input_tokens)
+        return outputs.hidden_states[self.layer_index]
+
+    def _embed_batch(self, input_tokens: Dict) -> np.ndarray:
+        """Run the model on a tokenized batch and pool the selected layer"""
+        with torch.inference_mode():
+            layer = self._forward_layer(input_tokens)
+            return self._compute_embedding(layer, input_tokens)
+
+    def _compute_embedding(self, layer: 'torch.Tensor', input_tokens: Dict):
         fill_vals = {'cls': 0.0, 'mean': 0.0, 'max': -np.inf, 'min': np.inf}
         fill_val = torch.tensor(fill_vals[self.pooling_strategy], device=self.device)
-        layer = hidden_states[self.layer_index]
 
         attn_mask = input_tokens['attention_mask']
 
@@ -115,11 +467,14 @@ class CustomTransformerTorchEncoder(Executor):
         embeddings = layer.sum(dim=1) / expand_attn_mask.sum(dim=1)
         return embeddings.cpu().numpy()
 
-    def _generate_input_tokens(self, texts):
+    def _ensure_pad_token(self):
         if not self.tokenizer.pad_token:
             self.tokenizer.add_special_tokens({'pad_token': '[PAD]'})
             self.model.resize_token_embeddings(len(self.tokenizer.vocab))
 
+    def _generate_input_tokens(self, texts):
+        self._ensure_pad_token()
+
         input_tokens = self.tokenizer(
             texts,
             max_length=self.max_length,
@@ -129,4 +484,21 @@ class CustomTransformerTorchEncoder(Executor):
         )
 
         input_tokens = {k: v.to(self.device) for k, v in input_tokens.items()}
-        return input_tokens
\ No newline at end of file
+        return input_tokens
+
+
+class _SelectedLayer(torch.nn.Module):
+    """Wrap a transformers model so that it only outputs the hidden states of one layer"""
+
+    def __init__(self, model, embedding_fn_name: str, layer_index: int, input_names: List[str]):
+        super().__init__()
+        self.model = model
+        self.embedding_fn_name = embedding_fn_name
+        self.layer_index = layer_index
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        outputs = getattr(self.model, self.embedding_fn_name)(
+            **dict(zip(self.input_names, inputs))
+        )
+        return outputs.hidden_states[self.layer_index]
@@ -1,7 +1,13 @@
+import hashlib
 import inspect
+import json
+import os
+import shutil
+import time
 from typing import Dict, Optional
 
-from docarray import DocumentArray
+from docarray import Document, DocumentArray
+from docarray.score import NamedScore
 from jina import Executor, requests
 from jina.logging.logger import JinaLogger
 from collections import Counter
@@ -9,6 +15,14 @@ from Levenshtein import ratio
 import numpy as np
 from torch import threshold
 
+from neural_search.core.executors.ann import ExactIndex, HNSWIndex, ShardedIndex
+from neural_search.core.executors.bm25 import BM25Index
+from neural_search.core.executors.chunk_store import ChunkStore
+from neural_search.core.executors.tag_index import TagIndex
+from neural_search.core.executors.quantization import QuantizedIndex
+from neural_search.core.executors.ranking import RANKINGS, rank_groups
+from neural_search.core.executors.result_cache import ResultCache
+
 class CustomIndexer(Executor):
     """
     A simple indexer that stores all the Document data together in a DocumentArray,
@@ -18,6 +32,7 @@ class CustomIndexer(Executor):
     """
 
     FILE_NAME = 'index.db'
+    SNAPSHOT_VERSION = 2
 
     def __init__(
         self,
@@ -26,6 +41,25 @@ class CustomIndexer(Executor):
         traversal_right: str = '@r',
         traversal_left: str = '@r',
         n_dim: int = 512,
+        storage: str = 'elasticsearch',
+        storage_config: Optional[Dict] = None,
+        vector_index: str = 'docarray',
+        hnsw_args: Optional[Dict] = None,
+        quantization_args: Optional[Dict] = None,
+        batch_size: int = 500,
+        snapshot_on_close: bool = False,
+        num_shards: int = 1,
+        result_cache_size: int = 1024,
+        result_cache_ttl: Optional[float] = 300.0,
+        lexical_index: bool = False,
+        bm25_args: Optional[Dict] = None,
+        retrieval: str = 'dense',
+        fusion: str = 'rrf',
+        fusion_weight: float = 0.5,
+        rrf_k: int = 60,
+        lexical_candidates: int = 100,
+        ranking: Optional[str] = None,
+        ranking_top_n: int = 3,
         **kwargs,
     ):
         """
@@ -38,23 +72,299 @@ class CustomIndexer(Executor):
         DocumentArray
         :param traversal_left: the default traversal path for the query
         DocumentArray
+        :param storage: the `DocumentArray` storage backend holding the Documents,
+        e.g. 'elasticsearch', 'sqlite' or 'memory'
+        :param storage_config: the config of the storage backend. For elasticsearch
+        it defaults to `index_name` and `n_dim`
+        :param vector_index: the index used for the vector similarity search. Either
+        'docarray', which matches against the storage with `DocumentArray.match`,
+        'exact', an in-process brute force index, 'hnsw', an in-process approximate
+        nearest neighbour index, or 'pq' / 'sq8',
+        compressed in-process indexes re-ranking with the exact vectors stored on disk
+        :param hnsw_args: the arguments of the 'hnsw' index: `space`, `M`,
+        `ef_construction`, `ef` and `max_elements`
+        :param quantization_args: the arguments of the 'pq' and 'sq8' indexes:
+        `n_subvectors`, `train_size`, `rerank_factor` and `vectors_path`. The full
+        vectors are stored in the workspace by default
+        :param batch_size: the default number of Documents written to or read from
+        the storage in a single bulk operation by `/update`, `/delete` and
+        `/fill_embedding`
+        :param snapshot_on_close: whether to write a snapshot of the index structures
+        to the workspace when the executor is closed. A snapshot in the workspace is
+        restored at start if no `/index`, `/update`, `/delete` or `/clear` changed the
+        storage since it was written
+        :param num_shards: the number of partitions of the in-process vector index.
+        Documents are assigned to a shard by the hash of their id, a query searches
+        all shards in parallel threads and their results are merged into the top
+        `limit`. Not used by the 'docarray' vector index
+        :param result_cache_size: the number of query results kept in memory, 0
+        disables the cache. Results are keyed by the query, the match arguments,
+        `context_length` and the tag filters, and dropped as soon as the index is
+        changed by `/index`, `/update`, `/delete`, `/clear` or `/restore`
+        :param result_cache_ttl: the number of seconds a cached result is served,
+        without expiry if None
+        :param lexical_index: whether to maintain a BM25 index over the texts of the
+        Documents of `traversal_right`, next to the vector index
+        :param bm25_args: the arguments of the BM25 index: `k1` and `b`
+        :param retrieval: the default retrieval mode, overridable per request. Either
+        'dense', the vector search only, 'hybrid', the vector and BM25 results fused
+        with `fusion`, or 'lexical_prune', where the top `lexical_candidates` BM25
+        results of each query are the only candidates scored against its embedding.
+        The last two need `lexical_index`
+        :param fusion: how 'hybrid' combines the rankings, either 'rrf', reciprocal
+        rank fusion, or 'weighted', a weighted sum of the normalized scores
+        :param fusion_weight: the weight of the vector scores in the 'weighted' fusion,
+        the BM25 scores have `1 - fusion_weight`
+        :param rrf_k: the rank offset of the reciprocal rank fusion
+        :param lexical_candidates: the number of BM25 results per query taken by
+        'hybrid' and 'lexical_prune'
+        :param ranking: the default ranking of the parent Documents of the matches,
+        overridable per request. The similarities of the chunk matches of a parent are
+        aggregated with 'max', 'mean', 'min' or 'top_n_sum'. The ranked Documents are
+        set as the 'documents' tag of the query, and the chunk matches are ordered by
+        the rank of their parent. None keeps the chunk matches as they are
+        :param ranking_top_n: the number of chunk similarities summed by 'top_n_sum'
         """
         super().__init__(**kwargs)
 
         self._match_args = match_args or {}
         self.n_dim = n_dim
-        self._index = DocumentArray(
-            storage='elasticsearch',
-            config={
+        self.batch_size = batch_size
+        storage_config = storage_config or {}
+        if storage == 'elasticsearch':
+            storage_config = {
                 'index_name': index_name,
-                'n_dim': self.n_dim
-            },
+                'n_dim': self.n_dim,
+                **storage_config,
+            }
+        self._index = DocumentArray(
+            storage=storage,
+            config=storage_config or None,
         )  # with customize config
         self.logger = JinaLogger(self.metas.name)
         self.default_traversal_right = traversal_right
         self.default_traversal_left = traversal_left
         self._index_splitted_cache = {}
 
+        if vector_index not in ['docarray', 'exact', 'hnsw', 'pq', 'sq8']:
+            raise ValueError(
+                f'vector_index should be one of "docarray", "exact", "hnsw", "pq" or "sq8", got "{vector_index}"'
+            )
+        self.vector_index = vector_index
+        self._hnsw_args = hnsw_args or {}
+        self._quantization_args = quantization_args or {}
+        if num_shards < 1:
+            raise ValueError(f'num_shards should be at least 1, got {num_shards}')
+        self.num_shards = num_shards
+        self._ann = None
+        self._chunk_store = ChunkStore()
+        # whether the chunk store only holds the Documents of the storage used so far
+        self._lazy_chunk_store = False
+        self._tag_index = TagIndex()
+        # allow-list bitmaps of the vector index, by (tag, value)
+        self._tag_mask_cache = {}
+        self.snapshot_on_close = snapshot_on_close
+        self._result_cache = ResultCache(max_entries=result_cache_size, ttl=result_cache_ttl)
+        if retrieval not in ['dense', 'hybrid', 'lexical_prune']:
+            raise ValueError(
+                f'retrieval should be one of "dense", "hybrid" or "lexical_prune", got "{retrieval}"'
+            )
+        if retrieval != 'dense' and not lexical_index:
+            raise ValueError(f'retrieval "{retrieval}" needs lexical_index to be enabled')
+        if fusion not in ['rrf', 'weighted']:
+            raise ValueError(f'fusion should be either "rrf" or "weighted", got "{fusion}"')
+        self.lexical_index = lexical_index
+        self._bm25_args = bm25_args or {}
+        self._bm25 = BM25Index(**self._bm25_args) if lexical_index else None
+        self.retrieval = retrieval
+        self.fusion = fusion
+        self.fusion_weight = fusion_weight
+        self.rrf_k = rrf_k
+        self.lexical_candidates = lexical_candidates
+        if ranking is not None and ranking not in RANKINGS:
+            raise ValueError(f'ranking should be one of {RANKINGS} or None, got "{ranking}"')
+        self.ranking = ranking
+        self.ranking_top_n = ranking_top_n
+        self._generation = self._load_generation()
+        if self._restore_snapshot() is None and len(self._index) > 0:
+            tags_loaded = self._load_tag_index()
+            # the chunk store is filled per parent when needed, unless another derived
+            # structure has to scan the storage anyway
+            if tags_loaded and self.vector_index == 'docarray' and not self.lexical_index:
+                self._lazy_chunk_store = True
+            else:
+                self._add_to_derived(self._index, index_tags=not tags_loaded)
+
+    @property
+    def _generation_path(self) -> Optional[str]:
+        return os.path.join(self.workspace, 'generation.json') if self.workspace else None
+
+    def _load_generation(self) -> int:
+        """Read the number of changes made to the storage, persisted in the workspace"""
+        path = self._generation_path
+        if path is None or not os.path.exists(path):
+            return 0
+        with open(path, 'r') as f:
+            return json.load(f)['generation']
+
+    def _bump_generation(self):
+        """Count a change of the storage, before it is made, so that the snapshots and
+        the tag index persisted before it are not loaded after a crash during it"""
+        self._generation += 1
+        path = self._generation_path
+        if path is None:
+            return
+        os.makedirs(self.workspace, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'generation': self._generation}, f)
+        os.replace(path + '.tmp', path)
+
+    @property
+    def _tag_index_path(self) -> Optional[str]:
+        return os.path.join(self.workspace, 'tag_index.json') if self.workspace else None
+
+    def _load_tag_index(self) -> bool:
+        """Load the tag index persisted in the workspace, if it matches the storage"""
+        path = self._tag_index_path
+        if path is None or not os.path.exists(path):
+            return False
+        metadata = self._tag_index.load(path)
+        if metadata.get('generation') != self._generation or metadata.get('num_docs') != len(self._index):
+            self.logger.warning('The persisted tag index is out of date, rebuilding it')
+            self._tag_index.clear()
+            return False
+        return True
+
+    def close(self):
+        if self._tag_index_path is not None:
+            os.makedirs(self.workspace, exist_ok=True)
+            self._tag_index.save(
+                self._tag_index_path, num_docs=len(self._index), generation=self._generation
+            )
+        if self.snapshot_on_close:
+            self.snapshot()
+        self._close_ann()
+        super().close()
+
+    def _close_ann(self):
+        """Stop the search threads of a sharded vector index"""
+        if isinstance(self._ann, ShardedIndex):
+            self._ann.close()
+
+    @property
+    def _snapshot_path(self) -> Optional[str]:
+        return os.path.join(self.workspace, 'snapshot') if self.workspace else None
+
+    @requests(on='/snapshot')
+    def snapshot(self, **kwargs) -> dict:
+        """write the chunk positions, texts and tags, the tag index and the vector
+        index to the workspace. The chunk store is memory-mapped when restored, with
+        its ids looked up in their saved sort order, and the full vectors of the
+        compressed indexes are shared with the snapshot. The tag and BM25 indexes,
+        and the id maps of the vector indexes, are rebuilt in memory when restored
+
+        The snapshot is written next to the previous one and swapped in once complete
+        """
+        path = self._snapshot_path
+        if path is None:
+            self.logger.warning('Cannot write a snapshot without a workspace')
+            return {'snapshot': None}
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        self._chunk_store.save(os.path.join(tmp_path, 'chunks'))
+        self._tag_index.save(os.path.join(tmp_path, 'tag_index.json'))
+        if self._ann is not None:
+            self._ann.save(os.path.join(tmp_path, 'vectors'))
+        if self._bm25 is not None:
+            self._bm25.save(os.path.join(tmp_path, 'bm25.json'))
+        manifest = {
+            'version': self.SNAPSHOT_VERSION,
+            'num_docs': len(self._index),
+            'generation': self._generation,
+            'vector_index': self.vector_index,
+            'num_shards': self.num_shards,
+            'lexical_index': self.lexical_index,
+            'has_vectors': self._ann is not None,
+            'lazy_chunk_store': self._lazy_chunk_store,
+            'created_at': time.time(),
+        }
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        if os.path.exists(path):
+            os.rename(path, path + '.old')
+        os.rename(tmp_path, path)
+        shutil.rmtree(path + '.old', ignore_errors=True)
+        return {'snapshot': manifest}
+
+    @requests(on='/restore')
+    def restore(self, **kwargs) -> dict:
+        """replace the index structures with the snapshot in the workspace"""
+        return {'snapshot': self._restore_snapshot()}
+
+    def _restore_snapshot(self) -> Optional[Dict]:
+        """Load the snapshot of the workspace if the storage did not change since it
+        was written and it matches the configured vector index, returning its manifest.
+        A snapshot is never restored over an empty storage"""
+        path = self._snapshot_path
+        if path is None or not os.path.exists(os.path.join(path, 'manifest.json')):
+            return None
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != self.SNAPSHOT_VERSION:
+            self.logger.warning(f'Unsupported snapshot version {manifest.get("version")}, ignoring it')
+            return None
+        num_docs = len(self._index)
+        if (
+            num_docs == 0
+            or num_docs != manifest['num_docs']
+            or manifest.get('generation') != self._generation
+            or manifest['vector_index'] != self.vector_index
+            or manifest.get('num_shards', 1) != self.num_shards
+            or manifest.get('lexical_index', False) != self.lexical_index
+        ):
+            self.logger.warning('The snapshot does not match the index, ignoring it')
+            return None
+
+        self._chunk_store.load(os.path.join(path, 'chunks'))
+        self._lazy_chunk_store = manifest.get('lazy_chunk_store', False)
+        self._tag_index.load(os.path.join(path, 'tag_index.json'))
+        self._close_ann()
+        self._ann = None
+        if manifest['has_vectors']:
+            vectors_path = os.path.join(path, 'vectors')
+            if self.num_shards > 1:
+                self._ann = ShardedIndex.load(vectors_path, self._load_ann_shard)
+            else:
+                self._ann = self._load_ann_shard(vectors_path, None)
+        if self.lexical_index:
+            self._bm25 = BM25Index.load(os.path.join(path, 'bm25.json'))
+        self._index_splitted_cache = {}
+        self._tag_mask_cache = {}
+        self._result_cache.invalidate()
+        return manifest
+
+    def _load_ann_shard(self, path: str, shard: Optional[int]):
+        """Load a snapshot of the vector index, or of one of its shards"""
+        if self.vector_index == 'exact':
+            return ExactIndex.load(path)
+        if self.vector_index == 'hnsw':
+            return HNSWIndex.load(path)
+        return QuantizedIndex.load(path, vectors_path=self._shard_vectors_path(shard))
+
+    @property
+    def _vectors_path(self) -> Optional[str]:
+        """the default file of the full vectors of the compressed vector indexes"""
+        return os.path.join(self.workspace, 'vectors.f32') if self.workspace else None
+
+    def _shard_vectors_path(self, shard: Optional[int]) -> Optional[str]:
+        """the file of the full vectors of a shard of the compressed vector indexes"""
+        vectors_path = self._quantization_args.get('vectors_path', self._vectors_path)
+        if shard is None or vectors_path is None:
+            return vectors_path
+        root, ext = os.path.splitext(vectors_path)
+        return f'{root}_{shard}{ext}'
+
     @property
     def table_name(self) -> str:
         return self._index._table_name
@@ -69,8 +379,11 @@ class CustomIndexer(Executor):
         :param docs: the docs to add
         """
         if docs:
+            self._bump_generation()
+            self._load_parents(docs[:, 'id'])
             self._index.extend(docs)
             self._index_splitted_cache = {}
+            self._add_to_derived(docs)
 
     @requests(on='/search')
     def search(
@@ -106,28 +419,134 @@ class CustomIndexer(Executor):
         )
         traversal_left = parameters.get('traversal_left', self.default_traversal_left)
         match_args = CustomIndexer._filter_match_params(docs, match_args)
+        context_length = int(parameters.get('context_length', 5))
 
-        _index_filtered = self._filter_by_tags(filter_by_tags, filter_by_tags_method, traversal_right)
+        retrieval_args = {
+            key: parameters.get(key, getattr(self, key))
+            for key in ['retrieval', 'fusion', 'fusion_weight', 'rrf_k', 'lexical_candidates']
+        }
+        if retrieval_args['retrieval'] != 'dense' and self._bm25 is None:
+            self.logger.warning(
+                f'retrieval "{retrieval_args["retrieval"]}" needs lexical_index, defaulting to "dense"'
+            )
+            retrieval_args['retrieval'] = 'dense'
+
+        # queries answered before on the same generation of the index are not searched
+        generation = self._result_cache.generation
+        queries = docs[traversal_left]
+        keys = [
+            self._result_key(
+                q, {**match_args, **retrieval_args}, context_length,
+                filter_by_tags, filter_by_tags_method, traversal_right
+            )
+            for q in queries
+        ]
+        misses, miss_keys = DocumentArray(), []
+        for q, key in zip(queries, keys):
+            cached = self._result_cache.get(key)
+            if cached is None:
+                misses.append(q)
+                miss_keys.append(key)
+            else:
+                q.matches = DocumentArray(Document(m, copy=True) for m in cached)
+        if len(misses) > 0:
+            limit = int(match_args.get('limit', 20))
+            lexical_candidates = int(retrieval_args['lexical_candidates'])
+            allowed_ids = None
+            if retrieval_args['retrieval'] != 'dense':
+                allowed_ids = self._filter_ids_by_tags(filter_by_tags, filter_by_tags_method, traversal_right)
+            if retrieval_args['retrieval'] == 'lexical_prune':
+                self._search_lexical_prune(misses, limit, lexical_candidates, allowed_ids)
+            else:
+                depth = limit if retrieval_args['retrieval'] == 'dense' else max(limit, lexical_candidates)
+                if self.vector_index != 'docarray':
+                    allowed = self._filter_mask_by_tags(filter_by_tags, filter_by_tags_method, traversal_right)
+                    self._search_ann(misses, depth, allowed)
+                else:
+                    _index_filtered = self._filter_by_tags(filter_by_tags, filter_by_tags_method, traversal_right)
+                    misses.match(_index_filtered, **{**match_args, 'limit': depth})
+                if retrieval_args['retrieval'] == 'hybrid':
+                    self._fuse_lexical(misses, limit, lexical_candidates, allowed_ids, retrieval_args)
+            self._add_context([m for d in misses for m in d.matches], context_length)
+            for q, key in zip(misses, miss_keys):
+                self._result_cache.put(
+                    key, DocumentArray(Document(m, copy=True) for m in q.matches), generation
+                )
 
-        docs[traversal_left].match(_index_filtered, **match_args)
-        context_length = int(parameters.get('context_length', 5))
-        for d in docs[traversal_left]:
-            for m in d.matches:
-                parent_doc = self._index[m.parent_id]
-                current_doc_id = m.id
-                context = ""
-                for i, c in enumerate(parent_doc.chunks):
-                    if c.id == current_doc_id:
-                        surrounding_chunks = parent_doc.chunks[max(0, i - context_length) : i + context_length]
-                        context = " ".join([c.text for c in surrounding_chunks])
-                        break
-                m.tags.update({
-                    'parent_text': parent_doc.text,
-                    'context': context
-                    })
+        ranking = parameters.get('ranking', self.ranking)
+        if ranking is not None:
+            self._rank_documents(queries, ranking, int(parameters.get('ranking_top_n', self.ranking_top_n)))
+
+    def _rank_documents(self, queries: DocumentArray, ranking: str, top_n: int):
+        """Rank the parent Documents of the matches of every query and order the
+        matches by the rank of their parent"""
+        for q in queries:
+            matches = [m for m in q.matches if m.scores]
+            if len(matches) == 0:
+                q.tags['documents'] = []
+                continue
+            # the matches carry a distance, lower is better
+            similarities = np.array([1.0 - list(m.scores.values())[0].value for m in matches])
+            parent_ids = [m.parent_id or m.id for m in matches]
+            documents, scores, positions = rank_groups(parent_ids, similarities, ranking, top_n)
+            chunk_ids = [[] for _ in documents]
+            for m, position in zip(matches, positions):
+                chunk_ids[position].append(m.id)
+                m.tags['document_rank'] = int(position)
+                m.tags['document_score'] = float(scores[position])
+            q.tags['documents'] = [
+                {'doc_id': doc_id, 'score': float(score), 'chunk_ids': ids}
+                for doc_id, score, ids in zip(documents, scores, chunk_ids)
+            ]
+            order = np.lexsort((-similarities, positions))
+            q.matches = DocumentArray([matches[i] for i in order])
 
-    def _filter_by_tags(self, filter_by_tags, filter_by_tags_method, traversal_right):
-        """Filter the index by tags"""
+    @staticmethod
+    def _result_key(query, match_args, context_length, filter_by_tags, filter_by_tags_method, traversal_right):
+        """Build the result cache key of a query. The tag filters are normalized so
+        that their order and the default threshold do not matter"""
+        filters = sorted(
+            json.dumps({'threshold': 0.5, **filter_dict}, sort_keys=True, default=str)
+            for filter_dict in filter_by_tags
+        )
+        if query.text:
+            query_key = query.text
+        else:
+            query_key = hashlib.sha256(np.asarray(query.embedding, dtype=np.float32).tobytes()).hexdigest()
+        return ResultCache.make_key(
+            query=query_key,
+            match_args=match_args,
+            context_length=context_length,
+            filters=filters,
+            filter_method=filter_by_tags_method if filters else None,
+            traversal_right=traversal_right,
+        )
+
+    def _add_context(self, matches, context_length: int):
+        """Set the parent text and the surrounding chunks of every match. Chunks and
+        parents matched by several queries of the batch are looked up once"""
+        # Documents indexed before the chunk store was built are loaded in one lookup
+        missing_parent_ids = list({
+            m.parent_id for m in matches if m.parent_id and m.id not in self._chunk_store
+        })
+        if missing_parent_ids:
+            self._chunk_store.add(self._index[missing_parent_ids])
+        contexts = {}
+        for m in matches:
+            if m.id not in contexts:
+                if m.id not in self._chunk_store:
+                    contexts[m.id] = None
+                    continue
+                parent_id, _ = self._chunk_store.position(m.id)
+                contexts[m.id] = {
+                    'parent_text': self._chunk_store.parent_text(parent_id),
+                    'context': self._chunk_store.context(m.id, context_length),
+                }
+            if contexts[m.id] is not None:
+                m.tags.update(contexts[m.id])
+
+    def _filter_ids_by_tags(self, filter_by_tags, filter_by_tags_method, traversal_right):
+        """Get the ids of the Documents matching the tag filters, or None if there are no filters"""
         
         def match_tags(tags, value, threshold=0.5):
             ratios = np.array(list(map(lambda x: ratio(value, x), tags)))
@@ -136,39 +555,281 @@ class CustomIndexer(Executor):
             match_id = np.argmax(ratios)
             return tags[match_id] if ratios[match_id] > threshold else None
 
-        if len(filter_by_tags) > 0:
-            filtered_id_docs = []
-            for filter_dict in filter_by_tags:
-                tag = filter_dict.get('tag')
-                tag_value = filter_dict.get('tag_value')
-                if tag is None or tag_value is None:
-                    continue
-                threshold = filter_dict.get('threshold', 0.5)
-                if tag not in self._index_splitted_cache:
-                    self._index_splitted_cache[tag] = self._index[traversal_right].split_by_tag(tag=tag)
-                matched_tag = match_tags(list(self._index_splitted_cache[tag].keys()), tag_value, threshold)
+        if len(filter_by_tags) == 0:
+            return None
+
+        filtered_id_docs = []
+        for filter_dict in filter_by_tags:
+            tag = filter_dict.get('tag')
+            tag_value = filter_dict.get('tag_value')
+            if tag is None or tag_value is None:
+                continue
+            threshold = filter_dict.get('threshold', 0.5)
+            if traversal_right == self.default_traversal_right:
+                matched_tag = self._tag_index.match_value(tag, tag_value, threshold)
                 if matched_tag is not None:
-                    filtered_id_docs += [[doc.id for doc in self._index_splitted_cache[tag][matched_tag]]]
-
-            _index_filtered = DocumentArray()
-            if filter_by_tags_method == 'OR':
-                unique_doc_ids = list(set([id for docarray in filtered_id_docs for id in docarray]))
-                if len(unique_doc_ids) == 0:
-                    self.logger.warning(f"No tags were found for the tags: {filter_by_tags}")
-                    _index_filtered = DocumentArray()
-                else:
-                    _index_filtered = self._index[traversal_right][unique_doc_ids]
-            elif filter_by_tags_method == 'AND' and len(filtered_id_docs) > 0:
-                intersection_doc_ids = list(set.intersection(*map(set, filtered_id_docs)))
-                if len(intersection_doc_ids) == 0:
-                    self.logger.warning(f"No tags were found for the tags: {filter_by_tags}")
-                    _index_filtered = DocumentArray()
+                    filtered_id_docs += [list(self._tag_index.ids(tag, matched_tag))]
+                continue
+            if tag not in self._index_splitted_cache:
+                self._index_splitted_cache[tag] = self._index[traversal_right].split_by_tag(tag=tag)
+            matched_tag = match_tags(list(self._index_splitted_cache[tag].keys()), tag_value, threshold)
+            if matched_tag is not None:
+                filtered_id_docs += [[doc.id for doc in self._index_splitted_cache[tag][matched_tag]]]
+
+        filtered_ids = []
+        if filter_by_tags_method == 'OR':
+            filtered_ids = list(set([id for docarray in filtered_id_docs for id in docarray]))
+        elif filter_by_tags_method == 'AND' and len(filtered_id_docs) > 0:
+            filtered_ids = list(set.intersection(*map(set, filtered_id_docs)))
+        if len(filtered_ids) == 0:
+            self.logger.warning(f"No tags were found for the tags: {filter_by_tags}")
+        return filtered_ids
+
+    def _filter_mask_by_tags(self, filter_by_tags, filter_by_tags_method, traversal_right):
+        """
+        Get the allow-list bitmap of the vector index matching the tag filters, or None
+        if there are no filters. The bitmap of every (tag, value) is cached until the
+        index changes, so OR / AND filters are a few vectorized boolean operations.
+        """
+        if len(filter_by_tags) == 0 or self._ann is None:
+            return None
+        if traversal_right != self.default_traversal_right:
+            return self._ann.mask(
+                self._filter_ids_by_tags(filter_by_tags, filter_by_tags_method, traversal_right)
+            )
+
+        masks = []
+        for filter_dict in filter_by_tags:
+            tag = filter_dict.get('tag')
+            tag_value = filter_dict.get('tag_value')
+            if tag is None or tag_value is None:
+                continue
+            matched_tag = self._tag_index.match_value(tag, tag_value, filter_dict.get('threshold', 0.5))
+            if matched_tag is None:
+                continue
+            if (tag, matched_tag) not in self._tag_mask_cache:
+                self._tag_mask_cache[(tag, matched_tag)] = self._ann.mask(
+                    self._tag_index.ids(tag, matched_tag)
+                )
+            masks.append(self._tag_mask_cache[(tag, matched_tag)])
+
+        mask = np.zeros(0, dtype=bool)
+        if filter_by_tags_method == 'OR' and len(masks) > 0:
+            mask = np.logical_or.reduce(masks)
+        elif filter_by_tags_method == 'AND' and len(masks) > 0:
+            mask = np.logical_and.reduce(masks)
+        if not mask.any():
+            self.logger.warning(f"No tags were found for the tags: {filter_by_tags}")
+        return mask
+
+    def _filter_by_tags(self, filter_by_tags, filter_by_tags_method, traversal_right):
+        """Filter the index by tags"""
+        filtered_ids = self._filter_ids_by_tags(filter_by_tags, filter_by_tags_method, traversal_right)
+        if filtered_ids is None:
+            return self._index[traversal_right]
+        if len(filtered_ids) == 0:
+            return DocumentArray()
+        return self._get_docs(filtered_ids, traversal_right)
+
+    def _get_docs(self, ids, traversal_right):
+        """Read Documents of `traversal_right` by id. Chunks are looked up in the chunk
+        store, so only their parents are read from the storage, in one lookup"""
+        if traversal_right == '@r':
+            return self._index[ids]
+        if traversal_right != self.default_traversal_right:
+            return self._index[traversal_right][ids]
+        if self._lazy_chunk_store and any(_id not in self._chunk_store for _id in ids):
+            self.logger.info('Loading the chunk positions of all the Documents of the storage')
+            self._chunk_store.add(self._index)
+            self._lazy_chunk_store = False
+        parent_ids = list(dict.fromkeys(
+            self._chunk_store.position(_id)[0] for _id in ids if _id in self._chunk_store
+        ))
+        docs = {d.id: d for d in self._index[parent_ids][traversal_right]} if parent_ids else {}
+        return DocumentArray(docs[_id] for _id in ids if _id in docs)
+
+    def _add_to_derived(self, docs: DocumentArray, index_tags: bool = True):
+        """Add root Documents to the structures derived from the index, removing the
+        chunks of the Documents they replace first"""
+        replaced_ids = [d.id for d in docs if self._chunk_store.has_parent(d.id)]
+        if replaced_ids:
+            self._remove_from_derived(replaced_ids)
+        self._chunk_store.add(docs)
+        if index_tags:
+            for d in docs[self.default_traversal_right]:
+                self._tag_index.add(d.id, d.tags)
+        if self._bm25 is not None:
+            lexical_docs = docs[self.default_traversal_right]
+            self._bm25.add(lexical_docs[:, 'id'], lexical_docs[:, 'text'])
+        self._add_to_ann(docs)
+        self._tag_mask_cache = {}
+        self._result_cache.invalidate()
+
+    def _load_parents(self, doc_ids):
+        """Add the Documents of the storage missing from a lazily filled chunk store,
+        so that the ids of their chunks are known before they are replaced or removed"""
+        if not self._lazy_chunk_store:
+            return
+        missing_ids = [
+            _id for _id in doc_ids if not self._chunk_store.has_parent(_id) and _id in self._index
+        ]
+        if missing_ids:
+            self._chunk_store.add(self._index[missing_ids])
+
+    def _remove_from_derived(self, doc_ids):
+        """Remove root Documents from the structures derived from the index"""
+        chunk_ids = self._chunk_store.remove(doc_ids)
+        self._tag_index.remove(list(doc_ids) + chunk_ids)
+        self._index_splitted_cache = {}
+        self._tag_mask_cache = {}
+        self._result_cache.invalidate()
+        if self._bm25 is not None:
+            self._bm25.remove(list(doc_ids) + chunk_ids)
+        if self._ann is not None:
+            self._ann.delete(list(doc_ids) + chunk_ids)
+
+    def _add_to_ann(self, docs: DocumentArray):
+        """Add the embeddings of the chunks of `docs` to the ANN index"""
+        if self.vector_index == 'docarray':
+            return
+        chunks = DocumentArray(
+            d for d in docs[self.default_traversal_right] if d.embedding is not None
+        )
+        if len(chunks) == 0:
+            return
+        embeddings = chunks.embeddings
+        if self._ann is None:
+            self._ann = self._create_ann(embeddings.shape[1])
+        self._ann.add(chunks[:, 'id'], embeddings)
+
+    def _create_ann(self, n_dim: int):
+        """Create the in-process vector index selected by `vector_index`, sharded if
+        `num_shards` is above 1"""
+        if self.num_shards > 1:
+            return ShardedIndex([self._create_ann_shard(n_dim, i) for i in range(self.num_shards)])
+        return self._create_ann_shard(n_dim, None)
+
+    def _create_ann_shard(self, n_dim: int, shard: Optional[int]):
+        """Create the vector index, or one of its shards"""
+        if self.vector_index == 'exact':
+            return ExactIndex(n_dim)
+        if self.vector_index == 'hnsw':
+            return HNSWIndex(n_dim, **self._hnsw_args)
+        quantization_args = {**self._quantization_args, 'vectors_path': self._shard_vectors_path(shard)}
+        return QuantizedIndex(n_dim, method=self.vector_index, **quantization_args)
+
+    def _search_ann(self, docs: DocumentArray, limit: int, allowed=None):
+        """Fill the matches of `docs` using the in-process vector index"""
+        if self._ann is None or len(docs) == 0:
+            return
+        results = self._ann.search(docs.embeddings, limit, allowed=allowed)
+        for d, matches in zip(docs, self._build_matches(results, self._ann.space)):
+            d.matches = matches
+
+    def _build_matches(self, results, score_name: str):
+        """Build the matches of every query from lists of (id, distance)"""
+        # root Documents (indexed with traversal_right '@r') are read from the storage
+        root_ids = list({
+            _id for result in results for _id, _ in result if _id not in self._chunk_store
+        })
+        root_docs = {d.id: d for d in (self._index[root_ids] if root_ids else [])}
+        # the chunks matched by several queries are read from the chunk store once
+        chunks = {}
+        for _id in {_id for result in results for _id, _ in result}:
+            if _id in self._chunk_store:
+                text, tags = self._chunk_store.chunk(_id)
+                chunks[_id] = (text, tags, self._chunk_store.position(_id)[0])
+        all_matches = []
+        for result in results:
+            matches = DocumentArray()
+            for _id, distance in result:
+                if _id in chunks:
+                    text, tags, parent_id = chunks[_id]
+                    m = Document(id=_id, text=text, tags=dict(tags), parent_id=parent_id)
                 else:
-                    _index_filtered = self._index[traversal_right][intersection_doc_ids]
-        else:
-            _index_filtered = self._index[traversal_right]
+                    m = Document(root_docs[_id], copy=True)
+                m.scores[score_name] = NamedScore(value=distance)
+                matches.append(m)
+            all_matches.append(matches)
+        return all_matches
+
+    def _search_lexical_prune(self, docs: DocumentArray, limit: int, lexical_candidates: int, allowed_ids=None):
+        """Fill the matches of `docs` by scoring only the top BM25 candidates of each
+        query against its embedding"""
+        results = []
+        for d in docs:
+            ids = [_id for _id, _ in self._bm25.search(d.text, lexical_candidates, allowed=allowed_ids)]
+            if self._ann is not None:
+                ids = [_id for _id in ids if _id in self._ann]
+            if len(ids) == 0 or d.embedding is None:
+                results.append([])
+                continue
+            if self._ann is not None:
+                embeddings = self._ann.get_embeddings(ids)
+            else:
+                embeddings = self._get_docs(ids, self.default_traversal_right).embeddings
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+            query = d.embedding / max(np.linalg.norm(d.embedding), 1e-12)
+            distances = 1.0 - embeddings @ query
+            order = np.argsort(distances, kind='stable')[:limit]
+            results.append([(ids[i], float(distances[i])) for i in order])
+        for d, matches in zip(docs, self._build_matches(results, 'cosine')):
+            d.matches = matches
+
+    def _fuse_lexical(self, docs: DocumentArray, limit: int, lexical_candidates: int, allowed_ids, retrieval_args):
+        """
+        Fuse the vector matches of `docs` with their BM25 results. The fused score
+        replaces the distance of the vector index, as a distance in [0, 1], while the
+        original ones are kept as the 'vector' and 'bm25' scores
+        """
+        score_name = self._ann.space if self._ann is not None else self._match_args.get('metric', 'cosine')
+        rrf_k = float(retrieval_args['rrf_k'])
+        weight = float(retrieval_args['fusion_weight'])
+        for d in docs:
+            dense = {m.id: m for m in d.matches}
+            lexical = dict(self._bm25.search(d.text, lexical_candidates, allowed=allowed_ids))
+            distances = {
+                m.id: list(m.scores.values())[0].value for m in d.matches if m.scores
+            }
+            if retrieval_args['fusion'] == 'rrf':
+                fused = {}
+                for ranking in [list(distances), list(lexical)]:
+                    for rank, _id in enumerate(ranking):
+                        fused[_id] = fused.get(_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+                # normalized by the score of an id ranked first by both
+                fused = {_id: score * (rrf_k + 1) / 2 for _id, score in fused.items()}
+            else:
+                dense_scores = self._normalize_scores({_id: -dist for _id, dist in distances.items()})
+                lexical_scores = self._normalize_scores(lexical)
+                fused = {
+                    _id: weight * dense_scores.get(_id, 0.0) + (1 - weight) * lexical_scores.get(_id, 0.0)
+                    for _id in set(dense_scores) | set(lexical_scores)
+                }
+
+            top = sorted(fused.items(), key=lambda item: -item[1])[:limit]
+            lexical_only = [[(_id, 1.0 - score) for _id, score in top if _id not in dense]]
+            new_matches = {m.id: m for m in self._build_matches(lexical_only, score_name)[0]}
+            matches = DocumentArray()
+            for _id, score in top:
+                m = dense[_id] if _id in dense else new_matches[_id]
+                if _id in distances:
+                    m.scores['vector'] = NamedScore(value=distances[_id])
+                if _id in lexical:
+                    m.scores['bm25'] = NamedScore(value=lexical[_id])
+                m.scores[score_name] = NamedScore(value=1.0 - score)
+                matches.append(m)
+            d.matches = matches
 
-        return _index_filtered
+    @staticmethod
+    def _normalize_scores(scores: Dict[str, float]) -> Dict[str, float]:
+        """Min-max normalize scores to [0, 1]"""
+        if not scores:
+            return {}
+        values = np.fromiter(scores.values(), dtype=np.float64, count=len(scores))
+        low, high = values.min(), values.max()
+        if high - low <= 0:
+            return {_id: 1.0 for _id in scores}
+        return {_id: float((value - low) / (high - low)) for _id, value in scores.items()}
 
     @staticmethod
     def _filter_match_params(docs, match_args):
@@ -182,71 +843,154 @@ class CustomIndexer(Executor):
     def delete(self, parameters: Dict, **kwargs):
         """Delete entries from the index by id
 
-        :param parameters: parameters to the request
+        :param parameters: parameters to the request. `batch_size` sets the number
+        of ids deleted per bulk operation
         """
         deleted_ids = parameters.get('ids', [])
         if len(deleted_ids) == 0:
             return
-        del self._index[deleted_ids]
+        batch_size = int(parameters.get('batch_size', self.batch_size))
+        self._bump_generation()
+        for start in range(0, len(deleted_ids), batch_size):
+            batch_ids = deleted_ids[start : start + batch_size]
+            self._load_parents(batch_ids)
+            del self._index[batch_ids]
+            self._remove_from_derived(batch_ids)
 
     @requests(on='/update')
-    def update(self, docs: DocumentArray, **kwargs):
-        """Update doc with the same id, if not present, append into storage
+    def update(self, docs: DocumentArray, parameters: Dict = {}, **kwargs):
+        """Update doc with the same id, if not present, append into storage when
+        `upsert` is set, otherwise skip it
 
         :param docs: the documents to update
+        :param parameters: parameters to the request. `batch_size` sets the number
+        of Documents written per bulk operation and `upsert` whether Documents not in
+        the storage are appended
         """
-
-        for doc in docs:
-            try:
-                self._index[doc.id] = doc
-            except IndexError:
+        batch_size = int(parameters.get('batch_size', self.batch_size))
+        upsert = parameters.get('upsert', False)
+        if len(docs) > 0:
+            self._bump_generation()
+        for batch in docs.batch(batch_size=batch_size):
+            self._load_parents(batch[:, 'id'])
+            existing = DocumentArray(d for d in batch if self._chunk_store.has_parent(d.id))
+            missing = DocumentArray(d for d in batch if not self._chunk_store.has_parent(d.id))
+            if len(existing) > 0:
+                self._index[existing[:, 'id']] = existing
+                self._add_to_derived(existing)
+            if len(missing) == 0:
+                continue
+            if upsert:
+                self._index.extend(missing)
+                self._add_to_derived(missing)
+            else:
                 self.logger.warning(
-                    f'cannot update doc {doc.id} as it does not exist in storage'
+                    f'cannot update docs {missing[:, "id"]} as they do not exist in storage'
                 )
 
     @requests(on='/fill_embedding')
-    def fill_embedding(self, docs: DocumentArray, **kwargs):
+    def fill_embedding(self, docs: DocumentArray, parameters: Dict = {}, **kwargs):
         """retrieve embedding of Documents by id
 
         :param docs: DocumentArray to search with
+        :param parameters: parameters to the request. `batch_size` sets the number
+        of Documents read per bulk operation
         """
-        for doc in docs:
-            doc.embedding = self._index[doc.id].embedding
+        batch_size = int(parameters.get('batch_size', self.batch_size))
+        for batch in docs.batch(batch_size=batch_size):
+            stored = self._index[batch[:, 'id']]
+            for doc, stored_doc in zip(batch, stored):
+                doc.embedding = stored_doc.embedding
 
     @requests(on='/tags')
     def tags(self, parameters: Dict, **kwargs):
-        """retrieve tags of Documents by id if provided, otherwise all tags
+        """retrieve tags of Documents by id if provided, otherwise all tags. The counts
+        of all tags are maintained incrementally as Documents are indexed, updated
+        and deleted
 
-        :param parameters: parameters to the request
+        :param parameters: parameters to the request. `top_n` limits the values
+        returned per tag to the most frequent ones
         """
         ids = parameters.get('doc_ids', [])
+        top_n = parameters.get('top_n')
         traversal_right = parameters.get('traversal_right', self.default_traversal_right)
-        index_traversal = self._index[traversal_right]
 
         def count_tags_func(tags):
             count_tags = {}
             for tag_dict in tags:
                 for key, value in tag_dict.items():
+                    # the merged tags of a chunk may hold several values
+                    values = list(dict.fromkeys(value)) if isinstance(value, list) else [value]
                     if key in count_tags:
-                        count_tags[key] += [value]
+                        count_tags[key] += values
                     else:
-                        count_tags[key] = [value]
+                        count_tags[key] = values
             count_tags = {key: dict(Counter(value)) for key, value in count_tags.items()}
             return count_tags
 
-        if len(ids) == 0:
-            tags =  [d.tags for d in index_traversal if d.tags != {}]
+        if traversal_right == self.default_traversal_right:
+            if len(ids) == 0:
+                return {'tags': self._tag_index.counts(top_n=top_n)}
+            tags = [self._tag_index.tags(id) for id in ids]
         else:
-            tags = [index_traversal[id].tags for id in ids]
+            index_traversal = self._index[traversal_right]
+            if len(ids) == 0:
+                tags =  [d.tags for d in index_traversal if d.tags != {}]
+            else:
+                tags = [index_traversal[id].tags for id in ids]
 
         count_tags = count_tags_func(tags)
+        if top_n is not None:
+            count_tags = {
+                key: dict(Counter(value).most_common(top_n)) for key, value in count_tags.items()
+            }
         return {'tags': count_tags}
 
 
+    @requests(on='/vector_index_stats')
+    def vector_index_stats(self, parameters: Dict = {}, **kwargs) -> dict:
+        """return the size of the vector index and, for compressed indexes, the bytes
+        per vector and the recall@k measured on a sample of the indexed vectors
+
+        :param parameters: `sample_size` and `limit` of the recall measurement
+        """
+        if self._ann is None:
+            return {'vector_index_stats': {'vector_index': self.vector_index}}
+        stats = {'vector_index': self.vector_index, 'num_vectors': len(self._ann)}
+        shards = self._ann.shards if isinstance(self._ann, ShardedIndex) else [self._ann]
+        if len(shards) > 1:
+            stats['shard_sizes'] = [len(shard) for shard in shards]
+        if isinstance(shards[0], QuantizedIndex):
+            shard_stats = [
+                shard.stats(
+                    sample_size=int(parameters.get('sample_size', 100)),
+                    limit=int(parameters.get('limit', 10)),
+                )
+                for shard in shards
+            ]
+            stats.update(shard_stats[0] if len(shards) == 1 else {'shards': shard_stats})
+        return {'vector_index_stats': stats}
+
+    @requests(on='/result_cache_stats')
+    def result_cache_stats(self, **kwargs) -> dict:
+        """return the size, generation and hit count of the query result cache"""
+        return {'result_cache_stats': self._result_cache.stats()}
+
     @requests(on='/clear')
     def clear(self, **kwargs):
         """clear the database"""
+        self._bump_generation()
         self._index.clear()
+        if self._ann is not None:
+            self._ann.clear()
+        self._chunk_store.clear()
+        self._lazy_chunk_store = False
+        self._tag_index.clear()
+        if self._bm25 is not None:
+            self._bm25.clear()
+        self._index_splitted_cache = {}
+        self._tag_mask_cache = {}
+        self._result_cache.invalidate()
 
     @requests(on='/length')
     def length(self, **kwargs) -> dict:
@@ -0,0 +1,413 @@
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from neural_search.core.columns import StringColumn, StringColumnWriter
+from neural_search.core.executors.ann import fit_mask
+
+
+def _kmeans(data: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    """Lloyd's k-means, returning the centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        distances = (
+            (data ** 2).sum(axis=1, keepdims=True)
+            - 2 * data @ centroids.T
+            + (centroids ** 2).sum(axis=1)
+        )
+        assignment = distances.argmin(axis=1)
+        for c in range(n_clusters):
+            members = data[assignment == c]
+            if len(members) > 0:
+                centroids[c] = members.mean(axis=0)
+    return centroids
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class QuantizedIndex:
+    """
+    A compressed vector index with exact re-ranking.
+
+    Vectors are L2-normalized and kept in memory only as compact codes, either
+    product quantized (`'pq'`, one byte per sub-vector) or int8 scalar quantized
+    (`'sq8'`, one byte per dimension). A search scores all codes with asymmetric
+    distances, then re-ranks the best `rerank_factor * limit` candidates with the
+    full float32 vectors, which are appended to a file on disk and read through a
+    memory map.
+
+    Until `train_size` vectors have been added, the quantizer is not trained and
+    searches are exact.
+
+    Deleted rows are only marked as dead, since the vectors file is only appended
+    to. Once they outnumber the live rows, the live rows are rewritten to a new
+    vectors file and the codes and ids are compacted.
+    """
+
+    space = 'cosine'
+    MIN_COMPACTED_ROWS = 1024
+    _COMPACT_BLOCK_ROWS = 65536
+
+    def __init__(
+        self,
+        n_dim: int,
+        method: str = 'pq',
+        n_subvectors: int = 8,
+        train_size: int = 10000,
+        rerank_factor: int = 10,
+        vectors_path: Optional[str] = None,
+    ):
+        """
+        :param n_dim: dimension of the embeddings
+        :param method: either ``'pq'`` (product quantization) or ``'sq8'`` (int8
+            scalar quantization)
+        :param n_subvectors: number of sub-vectors of the product quantizer. It must
+            divide `n_dim`
+        :param train_size: number of vectors needed to train the quantizer
+        :param rerank_factor: number of candidates re-ranked with exact vectors, as
+            a multiple of the number of results
+        :param vectors_path: file where the full vectors are stored. By default a
+            temporary file is used
+        """
+        if method not in ['pq', 'sq8']:
+            raise ValueError(f'method should be either "pq" or "sq8", got "{method}"')
+        if method == 'pq' and n_dim % n_subvectors != 0:
+            raise ValueError(f'n_subvectors ({n_subvectors}) should divide n_dim ({n_dim})')
+        self.n_dim = n_dim
+        self.method = method
+        self.n_subvectors = n_subvectors
+        self.train_size = train_size
+        self.rerank_factor = rerank_factor
+        if vectors_path is None:
+            vectors_path = os.path.join(tempfile.mkdtemp(), 'vectors.f32')
+        os.makedirs(os.path.dirname(os.path.abspath(vectors_path)), exist_ok=True)
+        self.vectors_path = vectors_path
+        # the file may be hard-linked to a snapshot, so it is replaced, not truncated
+        if os.path.exists(self.vectors_path):
+            os.remove(self.vectors_path)
+        open(self.vectors_path, 'wb').close()
+        self._vectors = None
+        self._num_rows = 0
+
+        self._rows: Dict[str, int] = {}
+        self._ids: List[Optional[str]] = []
+        self._alive = np.zeros(0, dtype=bool)
+        self._codes = None
+        # pq: (n_subvectors, 256, sub_dim) codebooks, sq8: per dimension offset and scale
+        self._codebooks = None
+        self._sq_offset = None
+        self._sq_scale = None
+
+    @property
+    def trained(self) -> bool:
+        return self._codes is not None
+
+    def add(self, ids: List[str], embeddings: np.ndarray) -> None:
+        """
+        Insert embeddings, replacing the vectors of ids already in the index.
+
+        :param ids: ids of the Documents
+        :param embeddings: embeddings of the Documents, one row per id
+        """
+        if len(ids) == 0:
+            return
+        vectors = self._normalize(np.asarray(embeddings, dtype=np.float32))
+        self.delete(ids)
+        self._maybe_compact()
+
+        start = self._num_rows
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+        self._num_rows += len(vectors)
+        self._vectors = None
+        for offset, _id in enumerate(ids):
+            self._rows[_id] = start + offset
+        self._ids.extend(ids)
+        self._alive = np.concatenate([self._alive, np.ones(len(ids), dtype=bool)])
+
+        if self.trained:
+            self._codes = np.concatenate([self._codes, self._encode(vectors)])
+        elif len(self) >= self.train_size:
+            self._train()
+
+    def delete(self, ids: Iterable[str]) -> None:
+        """
+        Remove ids from the index. Unknown ids are ignored.
+
+        :param ids: ids of the Documents
+        """
+        for _id in ids:
+            row = self._rows.pop(_id, None)
+            if row is not None:
+                self._alive[row] = False
+                self._ids[row] = None
+
+    def _maybe_compact(self) -> None:
+        """Drop the dead rows once they outnumber the live ones"""
+        num_dead = self._num_rows - len(self._rows)
+        if num_dead <= max(len(self._rows), self.MIN_COMPACTED_ROWS):
+            return
+        rows = np.flatnonzero(self._alive)
+        # the file may be hard-linked to a snapshot, so it is replaced, not rewritten
+        tmp_path = self.vectors_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for start in range(0, len(rows), self._COMPACT_BLOCK_ROWS):
+                f.write(self._read_vectors(rows[start : start + self._COMPACT_BLOCK_ROWS]).tobytes())
+        self._vectors = None
+        os.replace(tmp_path, self.vectors_path)
+        self._ids = [self._ids[row] for row in rows]
+        self._rows = {_id: row for row, _id in enumerate(self._ids)}
+        self._alive = np.ones(len(rows), dtype=bool)
+        if self.trained:
+            self._codes = self._codes[rows]
+        self._num_rows = len(rows)
+
+    @property
+    def mask_size(self) -> int:
+        """length of the allow-list bitmaps of the index"""
+        return self._num_rows
+
+    def mask(self, ids: Iterable[str]) -> np.ndarray:
+        """
+        Build the allow-list bitmap of a set of ids, to be passed to `search`.
+
+        :param ids: ids of the Documents
+        :return: boolean array indexed by the rows of the index
+        """
+        mask = np.zeros(self.mask_size, dtype=bool)
+        mask[[self._rows[_id] for _id in ids if _id in self._rows]] = True
+        return mask
+
+    def search(
+        self, queries: np.ndarray, limit: int, allowed: Optional[np.ndarray] = None
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Find the nearest neighbours of a batch of query embeddings.
+
+        :param queries: query embeddings, one row per query
+        :param limit: number of neighbours to return per query
+        :param allowed: if given, an allow-list bitmap built with `mask`. Only the
+            ids set in it can be returned
+        :return: for every query, a list of (id, cosine distance) sorted by distance
+        """
+        queries = self._normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        mask = self._alive
+        if allowed is not None:
+            mask = mask & fit_mask(allowed, self._num_rows)
+        rows = np.flatnonzero(mask)
+        limit = min(limit, len(rows))
+        if limit <= 0:
+            return [[] for _ in range(len(queries))]
+
+        results = []
+        for query in queries:
+            candidates = rows
+            n_candidates = limit * self.rerank_factor
+            if self.trained and n_candidates < len(rows):
+                approx_scores = self._approximate_scores(query, rows)
+                top = np.argpartition(-approx_scores, n_candidates - 1)[:n_candidates]
+                candidates = np.sort(rows[top])
+            scores = self._read_vectors(candidates) @ query
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            top = top[np.argsort(-scores[top])]
+            results.append(
+                [(self._ids[candidates[i]], float(1.0 - scores[i])) for i in top]
+            )
+        return results
+
+    def get_embeddings(self, ids: List[str]) -> np.ndarray:
+        """Return the stored (normalized) vectors of the given ids"""
+        return self._read_vectors(np.array([self._rows[_id] for _id in ids], dtype=np.int64))
+
+    def clear(self) -> None:
+        """Remove all the Documents from the index"""
+        self.__init__(
+            self.n_dim,
+            method=self.method,
+            n_subvectors=self.n_subvectors,
+            train_size=self.train_size,
+            rerank_factor=self.rerank_factor,
+            vectors_path=self.vectors_path,
+        )
+
+    def save(self, path: str) -> None:
+        """
+        Write the index to a directory. The full vectors file is hard-linked when
+        possible: it is only ever appended to, and the number of rows it had is
+        stored with the snapshot.
+        """
+        os.makedirs(path, exist_ok=True)
+        _link_or_copy(self.vectors_path, os.path.join(path, 'vectors.f32'))
+        np.save(os.path.join(path, 'alive.npy'), self._alive)
+        if self.trained:
+            np.save(os.path.join(path, 'codes.npy'), self._codes)
+            if self.method == 'pq':
+                np.save(os.path.join(path, 'codebooks.npy'), self._codebooks)
+            else:
+                np.save(os.path.join(path, 'sq_offset.npy'), self._sq_offset)
+                np.save(os.path.join(path, 'sq_scale.npy'), self._sq_scale)
+        with StringColumnWriter(os.path.join(path, 'ids')) as ids:
+            ids.extend(_id or '' for _id in self._ids)
+        with open(os.path.join(path, 'quantization.json'), 'w') as f:
+            json.dump({
+                'n_dim': self.n_dim,
+                'method': self.method,
+                'n_subvectors': self.n_subvectors,
+                'train_size': self.train_size,
+                'rerank_factor': self.rerank_factor,
+                'num_rows': self._num_rows,
+                'trained': self.trained,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, vectors_path: Optional[str] = None) -> 'QuantizedIndex':
+        """
+        Load an index written with `save`.
+
+        :param path: the directory
+        :param vectors_path: file where the full vectors are stored from now on. It
+            is hard-linked to the vectors of the snapshot when possible
+        :return: the index
+        """
+        with open(os.path.join(path, 'quantization.json'), 'r') as f:
+            params = json.load(f)
+        index = cls(
+            params['n_dim'],
+            method=params['method'],
+            n_subvectors=params['n_subvectors'],
+            train_size=params['train_size'],
+            rerank_factor=params['rerank_factor'],
+            vectors_path=vectors_path,
+        )
+        # the snapshot file may have grown since it was taken, as it shares its
+        # content with the vectors file of the index it was saved from. It is only
+        # shared again if it did not, otherwise the rows of the snapshot are copied
+        snapshot_vectors_path = os.path.join(path, 'vectors.f32')
+        size = params['num_rows'] * params['n_dim'] * 4
+        if os.path.getsize(snapshot_vectors_path) == size:
+            _link_or_copy(snapshot_vectors_path, index.vectors_path)
+        else:
+            with open(snapshot_vectors_path, 'rb') as src, open(index.vectors_path, 'wb') as dst:
+                remaining = size
+                while remaining > 0:
+                    block = src.read(min(remaining, 1 << 24))
+                    if not block:
+                        break
+                    dst.write(block)
+                    remaining -= len(block)
+        index._num_rows = params['num_rows']
+        index._alive = np.load(os.path.join(path, 'alive.npy'))
+        index._ids = [_id or None for _id in StringColumn(os.path.join(path, 'ids'))]
+        index._rows = {_id: row for row, _id in enumerate(index._ids) if _id is not None}
+        if params['trained']:
+            index._codes = np.load(os.path.join(path, 'codes.npy'))
+            if index.method == 'pq':
+                index._codebooks = np.load(os.path.join(path, 'codebooks.npy'))
+            else:
+                index._sq_offset = np.load(os.path.join(path, 'sq_offset.npy'))
+                index._sq_scale = np.load(os.path.join(path, 'sq_scale.npy'))
+        return index
+
+    def stats(self, sample_size: int = 100, limit: int = 10) -> Dict:
+        """
+        Report the memory used per vector and the recall of the compressed search.
+
+        Recall@limit is measured with `sample_size` stored vectors as queries,
+        comparing the re-ranked results with an exact search over the full vectors.
+
+        :param sample_size: number of stored vectors used as queries
+        :param limit: number of results per query
+        :return: dictionary with the statistics
+        """
+        code_bytes = self.n_subvectors if self.method == 'pq' else self.n_dim
+        stats = {
+            'method': self.method,
+            'trained': self.trained,
+            'num_vectors': len(self),
+            'bytes_per_vector': code_bytes if self.trained else 4 * self.n_dim,
+            'raw_bytes_per_vector': 4 * self.n_dim,
+            'recall': None,
+        }
+        rows = np.flatnonzero(self._alive)
+        if not self.trained or len(rows) == 0:
+            return stats
+
+        rng = np.random.default_rng(0)
+        sample = rng.choice(rows, min(sample_size, len(rows)), replace=False)
+        all_vectors = self._read_vectors(rows)
+        queries = self._read_vectors(np.sort(sample))
+        recalls = []
+        for query, result in zip(queries, self.search(queries, limit)):
+            exact = rows[np.argsort(-(all_vectors @ query))[:limit]]
+            found = {self._rows[_id] for _id, _ in result}
+            recalls.append(len(found.intersection(exact)) / len(exact))
+        stats['recall'] = float(np.mean(recalls))
+        return stats
+
+    def __contains__(self, _id: str) -> bool:
+        return _id in self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _read_vectors(self, rows: np.ndarray) -> np.ndarray:
+        if self._vectors is None:
+            self._vectors = np.memmap(
+                self.vectors_path, dtype=np.float32, mode='r', shape=(self._num_rows, self.n_dim)
+            )
+        return np.asarray(self._vectors[rows])
+
+    def _train(self) -> None:
+        rows = np.flatnonzero(self._alive)
+        sample = self._read_vectors(rows[: self.train_size])
+        if self.method == 'pq':
+            sub_dim = self.n_dim // self.n_subvectors
+            n_centroids = min(256, len(sample))
+            self._codebooks = np.stack([
+                _kmeans(sample[:, i * sub_dim : (i + 1) * sub_dim], n_centroids)
+                for i in range(self.n_subvectors)
+            ])
+        else:
+            self._sq_offset = sample.min(axis=0)
+            self._sq_scale = np.maximum(sample.max(axis=0) - self._sq_offset, 1e-12) / 255
+        self._codes = self._encode(self._read_vectors(np.arange(self._num_rows)))
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.method == 'pq':
+            sub_dim = self.n_dim // self.n_subvectors
+            codes = np.empty((len(vectors), self.n_subvectors), dtype=np.uint8)
+            for i, codebook in enumerate(self._codebooks):
+                sub_vectors = vectors[:, i * sub_dim : (i + 1) * sub_dim]
+                distances = -2 * sub_vectors @ codebook.T + (codebook ** 2).sum(axis=1)
+                codes[:, i] = distances.argmin(axis=1)
+            return codes
+        return np.clip(np.rint((vectors - self._sq_offset) / self._sq_scale), 0, 255).astype(np.uint8)
+
+    def _approximate_scores(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Asymmetric inner products between a raw query and the codes of `rows`"""
+        codes = self._codes[rows]
+        if self.method == 'pq':
+            sub_dim = self.n_dim // self.n_subvectors
+            # table[i, c] is the inner product of the i-th sub-query with centroid c
+            table = np.einsum(
+                'ikd,id->ik', self._codebooks, query.reshape(self.n_subvectors, sub_dim)
+            )
+            return table[np.arange(self.n_subvectors), codes].sum(axis=1)
+        return codes.astype(np.float32) @ (query * self._sq_scale) + query @ self._sq_offset
@@ -0,0 +1,52 @@
+from typing import List, Tuple
+
+import numpy as np
+
+RANKINGS = ['max', 'mean', 'min', 'top_n_sum']
+
+
+def rank_groups(
+    group_ids: List[str], scores: np.ndarray, ranking: str = 'max', top_n: int = 3
+) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    Aggregate the scores of matches per group, e.g. the chunks of a Document, and
+    rank the groups.
+
+    :param group_ids: the group of every match
+    :param scores: the score of every match, higher is better
+    :param ranking: how the scores of a group are aggregated: 'max', 'mean', 'min'
+        or 'top_n_sum', the sum of the `top_n` highest scores
+    :param top_n: the number of scores summed by 'top_n_sum'
+    :return: the groups sorted by decreasing aggregated score, their scores, and the
+        position of the group of every match in the sorted groups
+    """
+    if ranking not in RANKINGS:
+        raise ValueError(f'ranking should be one of {RANKINGS}, got "{ranking}"')
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(scores) == 0:
+        return [], np.zeros(0), np.zeros(0, dtype=np.int64)
+    groups, inverse = np.unique(np.asarray(group_ids, dtype=object), return_inverse=True)
+    num_groups = len(groups)
+
+    if ranking == 'max':
+        group_scores = np.full(num_groups, -np.inf)
+        np.maximum.at(group_scores, inverse, scores)
+    elif ranking == 'min':
+        group_scores = np.full(num_groups, np.inf)
+        np.minimum.at(group_scores, inverse, scores)
+    elif ranking == 'mean':
+        group_scores = np.bincount(inverse, weights=scores, minlength=num_groups)
+        group_scores /= np.bincount(inverse, minlength=num_groups)
+    else:
+        # rank of every match in its group, by decreasing score
+        order = np.lexsort((-scores, inverse))
+        starts = np.searchsorted(inverse[order], np.arange(num_groups))
+        ranks = np.empty(len(scores), dtype=np.int64)
+        ranks[order] = np.arange(len(scores)) - starts[inverse[order]]
+        kept = ranks < top_n
+        group_scores = np.bincount(inverse[kept], weights=scores[kept], minlength=num_groups)
+
+    group_order = np.argsort(-group_scores, kind='stable')
+    positions = np.empty(num_groups, dtype=np.int64)
+    positions[group_order] = np.arange(num_groups)
+    return [groups[i] for i in group_order], group_scores[group_order], positions[inverse]
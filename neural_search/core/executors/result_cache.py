@@ -0,0 +1,87 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class ResultCache:
+    """
+    An in-memory LRU cache of search results with a time to live.
+
+    Entries are stamped with the generation of the index they were computed on.
+    The owner of the index bumps the generation whenever the index changes, which
+    makes every older entry stale at once without scanning the cache.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None):
+        """
+        :param max_entries: maximum number of cached results, the least recently
+            used ones are evicted first
+        :param ttl: number of seconds after which a result expires, never if None
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        """Hash json serializable key parts into a cache key"""
+        encoded = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up a result.
+
+        :param key: the cache key
+        :return: the cached result, or None if it is missing, expired or stale
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            generation, created_at, value = entry
+            expired = self.ttl is not None and time.monotonic() - created_at > self.ttl
+            if generation == self.generation and not expired:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return value
+            del self._entries[key]
+        self._misses += 1
+        return None
+
+    def put(self, key: str, value: Any, generation: Optional[int] = None) -> None:
+        """
+        Cache a result.
+
+        :param key: the cache key
+        :param value: the result
+        :param generation: the generation the result was computed on, read before
+            the computation started. The result is dropped if the index changed
+            meanwhile. Defaults to the current generation
+        """
+        generation = self.generation if generation is None else generation
+        if self.max_entries <= 0 or generation != self.generation:
+            return
+        self._entries[key] = (generation, time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        """Make all the cached results stale, to be called when the index changes"""
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'generation': self.generation,
+            'hits': self._hits,
+            'misses': self._misses,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,182 @@
+import json
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set
+
+from Levenshtein import ratio
+
+
+class TagIndex:
+    """
+    An inverted index from tag to tag value to the ids of the Documents having it.
+
+    Tag values are also indexed by their character n-grams, so a fuzzy lookup only
+    computes the Levenshtein ratio against the values sharing the most n-grams with
+    the query value, instead of against every distinct value of the tag.
+
+    A tag whose value is a list, e.g. the merged tags of a multi-sentence chunk,
+    indexes the Document under each of the values.
+    """
+
+    def __init__(self, ngram_size: int = 2, max_candidates: int = 50):
+        """
+        :param ngram_size: size of the character n-grams indexing the tag values
+        :param max_candidates: maximum number of values compared with the
+            Levenshtein ratio in a fuzzy lookup
+        """
+        self.ngram_size = ngram_size
+        self.max_candidates = max_candidates
+        self._postings: Dict[str, Dict[str, Set[str]]] = {}
+        self._ngrams: Dict[str, Dict[str, Set[str]]] = {}
+        self._doc_tags: Dict[str, Dict] = {}
+        # values of each tag sorted by count, rebuilt when the tag changes
+        self._sorted_counts: Dict[str, List] = {}
+
+    def add(self, _id: str, tags: Dict) -> None:
+        """
+        Index the tags of a Document, replacing the ones indexed before for its id.
+
+        :param _id: id of the Document
+        :param tags: tags of the Document
+        """
+        self.remove([_id])
+        if not tags:
+            return
+        self._doc_tags[_id] = dict(tags)
+        for tag, tag_values in tags.items():
+            self._sorted_counts.pop(tag, None)
+            values = self._postings.setdefault(tag, {})
+            for value in self._split(tag_values):
+                if value not in values:
+                    values[value] = set()
+                    for gram in self._grams(value):
+                        self._ngrams.setdefault(tag, {}).setdefault(gram, set()).add(value)
+                values[value].add(_id)
+
+    def remove(self, ids: Iterable[str]) -> None:
+        """
+        Remove the tags of Documents. Unknown ids are ignored.
+
+        :param ids: ids of the Documents
+        """
+        for _id in ids:
+            tags = self._doc_tags.pop(_id, None)
+            if tags is None:
+                continue
+            for tag, tag_values in tags.items():
+                self._sorted_counts.pop(tag, None)
+                values = self._postings[tag]
+                for value in self._split(tag_values):
+                    values[value].discard(_id)
+                    if values[value]:
+                        continue
+                    del values[value]
+                    for gram in self._grams(value):
+                        gram_values = self._ngrams[tag][gram]
+                        gram_values.discard(value)
+                        if not gram_values:
+                            del self._ngrams[tag][gram]
+                if not values:
+                    del self._postings[tag]
+                    self._ngrams.pop(tag, None)
+
+    def clear(self) -> None:
+        self._postings = {}
+        self._ngrams = {}
+        self._doc_tags = {}
+        self._sorted_counts = {}
+
+    def tags(self, _id: str) -> Dict:
+        """Return the indexed tags of a Document"""
+        return dict(self._doc_tags.get(_id, {}))
+
+    def counts(self, top_n: Optional[int] = None) -> Dict[str, Dict]:
+        """
+        Count the Documents having each value of each tag.
+
+        :param top_n: if given, only the `top_n` most frequent values of each tag
+            are returned
+        :return: dictionary from tag to a dictionary from value to count, sorted by
+            decreasing count
+        """
+        counts = {}
+        for tag, values in self._postings.items():
+            if tag not in self._sorted_counts:
+                self._sorted_counts[tag] = sorted(
+                    ((value, len(ids)) for value, ids in values.items()),
+                    key=lambda item: -item[1],
+                )
+            counts[tag] = dict(self._sorted_counts[tag][:top_n])
+        return counts
+
+    def save(self, path: str, **metadata) -> None:
+        """
+        Persist the index to a json file.
+
+        :param path: path of the json file
+        :param metadata: additional json serializable values stored with the index
+        """
+        with open(path, 'w') as f:
+            json.dump({'metadata': metadata, 'doc_tags': self._doc_tags}, f)
+
+    def load(self, path: str) -> Dict:
+        """
+        Load an index persisted with `save`, replacing the current content.
+
+        :param path: path of the json file
+        :return: the metadata stored with the index
+        """
+        with open(path, 'r') as f:
+            data = json.load(f)
+        self.clear()
+        for _id, tags in data['doc_tags'].items():
+            self.add(_id, tags)
+        return data.get('metadata', {})
+
+    def __len__(self) -> int:
+        return len(self._doc_tags)
+
+    def ids(self, tag: str, value) -> Set[str]:
+        """Return the ids of the Documents whose `tag` is, or includes, `value`"""
+        return self._postings.get(tag, {}).get(value, set())
+
+    def values(self, tag: str) -> List:
+        """Return the distinct values of a tag"""
+        return list(self._postings.get(tag, {}).keys())
+
+    def match_value(self, tag: str, value: str, threshold: float = 0.5):
+        """
+        Find the indexed value of a tag closest to `value`.
+
+        :param tag: the tag
+        :param value: the value to look up
+        :param threshold: minimum Levenshtein ratio of the returned value
+        :return: the closest value if its ratio is above `threshold`, else None
+        """
+        values = self._postings.get(tag)
+        if not values:
+            return None
+        if value in values and threshold < 1.0:
+            return value
+
+        grams = self._ngrams.get(tag, {})
+        overlaps = Counter(
+            candidate for gram in self._grams(value) for candidate in grams.get(gram, ())
+        )
+        best_value, best_ratio = None, threshold
+        for candidate, _ in overlaps.most_common(self.max_candidates):
+            candidate_ratio = ratio(value, str(candidate))
+            if candidate_ratio > best_ratio:
+                best_value, best_ratio = candidate, candidate_ratio
+        return best_value
+
+    @staticmethod
+    def _split(value) -> List:
+        """Return the distinct values of a tag value which may be a list"""
+        return list(dict.fromkeys(value)) if isinstance(value, list) else [value]
+
+    def _grams(self, value) -> Set[str]:
+        padded = f' {str(value).lower()} '
+        return {
+            padded[i : i + self.ngram_size]
+            for i in range(max(1, len(padded) - self.ngram_size + 1))
+        }
@@ -0,0 +1,211 @@
+import json
+import os
+import shutil
+from typing import Dict, Iterable, Iterator, Optional
+
+import numpy as np
+
+from neural_search.core.columns import StringColumn, StringColumnWriter
+
+
+def _read_array(path: str, dtype) -> np.ndarray:
+    """Memory-map a raw binary array, empty if the file is missing or empty"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def _truncate_column(prefix: str, length: Optional[int] = None) -> None:
+    """Truncate a string column to its first `length` strings, by default all the
+    strings whose end offset was written, dropping the data written after them"""
+    ends = _read_array(prefix + '.index', np.int64)
+    length = len(ends) if length is None else min(length, len(ends))
+    data_end = int(ends[length - 1]) if length > 0 else 0
+    del ends
+    with open(prefix + '.index', 'r+b') as f:
+        f.truncate(length * 8)
+    with open(prefix + '.data', 'r+b') as f:
+        f.truncate(data_end)
+
+
+class PreprocessedDocs:
+    """
+    A columnar, append-only store of preprocessed documents.
+
+    The sentences of all the documents are concatenated in one string column. Tags
+    are stored once in a tag dictionary, each sentence having the int32 code of its
+    tags, and every document is the range of sentences up to its end offset. The
+    tags are decoded per sentence when accessed, and the code of every tag set is
+    only looked up once the store is appended to. The
+    character offset of every sentence (or chunk) in its document is stored too.
+    The files are memory-mapped, so a document is only decoded when it is accessed
+    and iterating over the store holds one document at a time.
+
+    Documents are identified by a key, e.g. the hash of their content. A document
+    is complete once its end offset is written, which is done last, so a store
+    interrupted during an append is truncated back to its last complete document
+    when it is opened again.
+
+    Appending a key again supersedes its previous document without reclaiming its
+    space: `compact` rewrites the store with only the latest document of the keys
+    still needed.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: the directory of the store, created if needed
+        """
+        self.path = path
+        # a compaction interrupted between its two renames
+        if not os.path.exists(path) and os.path.exists(self._compact_path):
+            os.rename(self._compact_path, path)
+        os.makedirs(path, exist_ok=True)
+        for name in ['sentences', 'keys', 'tag_dict']:
+            for ext in ['.data', '.index']:
+                open(self._file(name + ext), 'ab').close()
+        self._repair()
+        self._open()
+
+    @property
+    def _compact_path(self) -> str:
+        return self.path.rstrip(os.sep) + '.compact'
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _repair(self) -> None:
+        """Drop the sentences and keys of an interrupted append"""
+        doc_ends = _read_array(self._file('doc_ends.i64'), np.int64)
+        num_docs = len(doc_ends)
+        num_sentences = int(doc_ends[-1]) if num_docs > 0 else 0
+        del doc_ends
+        _truncate_column(self._file('sentences'), num_sentences)
+        _truncate_column(self._file('keys'), num_docs)
+        _truncate_column(self._file('tag_dict'))
+        for name, itemsize in [('tag_codes.i32', 4), ('offsets.i64', 8)]:
+            if os.path.exists(self._file(name)):
+                with open(self._file(name), 'r+b') as f:
+                    f.truncate(min(num_sentences * itemsize, os.path.getsize(self._file(name))))
+
+    def _open(self) -> None:
+        """Map the files of the store and load its keys"""
+        # built by the first append
+        self._tag_codes_by_json = None
+        self._rows = {key: row for row, key in enumerate(StringColumn(self._file('keys')))}
+        self._map()
+
+    def _map(self) -> None:
+        """Map the files of the store, after they were appended to"""
+        self._sentences = StringColumn(self._file('sentences'))
+        self._tag_dict = StringColumn(self._file('tag_dict'), decode=json.loads)
+        self._tag_codes = _read_array(self._file('tag_codes.i32'), np.int32)
+        self._offsets = _read_array(self._file('offsets.i64'), np.int64)
+        self._doc_ends = _read_array(self._file('doc_ends.i64'), np.int64)
+
+    def append(self, key: str, doc: Dict) -> None:
+        """
+        Append a preprocessed document.
+
+        :param key: the key of the document
+        :param doc: dictionary with the `sentences` of the document, their `tags`
+            and optionally their `offsets`, by default the offsets of the sentences
+            joined with spaces
+        """
+        self.extend([(key, doc)])
+
+    def extend(self, docs: Iterable) -> None:
+        """
+        Append preprocessed documents.
+
+        :param docs: iterable of (key, document) tuples
+        """
+        num_docs = len(self._doc_ends)
+        num_sentences = int(self._doc_ends[-1]) if num_docs > 0 else 0
+        if self._tag_codes_by_json is None:
+            # the tags are written as sorted json, so the strings are the keys
+            self._tag_codes_by_json = {
+                encoded: code for code, encoded in enumerate(StringColumn(self._file('tag_dict')))
+            }
+        with StringColumnWriter(self._file('sentences'), append=True) as sentences, \
+                StringColumnWriter(self._file('keys'), append=True) as keys, \
+                StringColumnWriter(self._file('tag_dict'), append=True) as tag_dict, \
+                open(self._file('tag_codes.i32'), 'ab') as tag_codes, \
+                open(self._file('offsets.i64'), 'ab') as offsets, \
+                open(self._file('doc_ends.i64'), 'ab') as doc_ends:
+            for key, doc in docs:
+                codes = []
+                for tags in doc['tags']:
+                    encoded = json.dumps(tags, sort_keys=True)
+                    if encoded not in self._tag_codes_by_json:
+                        self._tag_codes_by_json[encoded] = len(self._tag_codes_by_json)
+                        tag_dict.append(encoded)
+                    codes.append(self._tag_codes_by_json[encoded])
+                sentences.extend(doc['sentences'])
+                tag_codes.write(np.asarray(codes, dtype=np.int32).tobytes())
+                doc_offsets = doc.get('offsets')
+                if doc_offsets is None:
+                    lengths = np.array([len(s) + 1 for s in doc['sentences']], dtype=np.int64)
+                    doc_offsets = np.cumsum(lengths) - lengths
+                offsets.write(np.asarray(doc_offsets, dtype=np.int64).tobytes())
+                keys.append(key)
+                num_sentences += len(doc['sentences'])
+                # flushed before the end offset, which completes the document
+                for f in [sentences, keys, tag_dict, tag_codes, offsets]:
+                    f.flush()
+                doc_ends.write(np.int64(num_sentences).tobytes())
+                doc_ends.flush()
+                # a key appended again points to its latest document
+                self._rows[key] = num_docs
+                num_docs += 1
+        self._map()
+
+    def compact(self, keys: Optional[Iterable[str]] = None) -> None:
+        """
+        Rewrite the store with only the latest document of every key, dropping the
+        superseded ones. The compacted store is written next to this one and swapped
+        in once complete.
+
+        :param keys: if given, only the documents of these keys are kept
+        """
+        if keys is None:
+            kept = self._rows
+        else:
+            kept = {key: self._rows[key] for key in keys if key in self._rows}
+        shutil.rmtree(self._compact_path, ignore_errors=True)
+        compacted = PreprocessedDocs(self._compact_path)
+        compacted.extend(
+            (key, self[row]) for key, row in sorted(kept.items(), key=lambda item: item[1])
+        )
+        del compacted
+        old_path = self.path.rstrip(os.sep) + '.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(self.path, old_path)
+        os.rename(self._compact_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        self._open()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return the document of a key, or None if it is not in the store"""
+        row = self._rows.get(key)
+        return self[row] if row is not None else None
+
+    def __getitem__(self, row: int) -> Dict:
+        if row < 0:
+            row += len(self)
+        start = int(self._doc_ends[row - 1]) if row > 0 else 0
+        end = int(self._doc_ends[row])
+        return {
+            'sentences': self._sentences[start:end],
+            'tags': [self._tag_dict[int(code)] for code in self._tag_codes[start:end]],
+            'offsets': [int(offset) for offset in self._offsets[start:end]],
+        }
+
+    def __iter__(self) -> Iterator[Dict]:
+        for row in range(len(self)):
+            yield self[row]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._rows
+
+    def __len__(self) -> int:
+        return len(self._doc_ends)
@@ -1,12 +1,58 @@
 from jina import Flow, Client
 from docarray import Document, DocumentArray
 import os
-from typing import List
-from neural_search.core.utils import DataHandler
+import queue
+import threading
+from typing import Iterable, Iterator, List, Optional, Union
+from neural_search.core.utils import DataHandler, ZipFiles
 from tqdm import tqdm
 
 FLOW_PATH = os.environ.get('FLOW_PATH', 'flows/index_query.yml')
 
+
+def prefetch(iterable: Iterable, max_pending: int) -> Iterator:
+    """
+    Iterate over `iterable` in a background thread, keeping at most `max_pending`
+    items ahead of the consumer, so that producing the next items overlaps with
+    consuming the current one while the producer is blocked when it gets too far
+    ahead.
+    """
+    done = object()
+    items = queue.Queue(maxsize=max(1, max_pending))
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
 class Search:
 
     def __init__(self, data_handler: DataHandler):
@@ -20,6 +66,10 @@ class Search:
         self.flow = Flow.load_config(FLOW_PATH)
         self.flow.expose_endpoint('/clear')
         self.flow.expose_endpoint('/length')
+        self.flow.expose_endpoint('/snapshot')
+        self.flow.expose_endpoint('/restore')
+        self.flow.expose_endpoint('/update')
+        self.flow.expose_endpoint('/delete')
         self.flow.start()
         self.client = Client(port=self.flow.port)
 
@@ -33,6 +83,20 @@ class Search:
         """
         self.client.post('/clear', target_executor='CustomIndexer')
 
+    def snapshot(self) -> dict:
+        """
+        Write a snapshot of the index structures calling the endpoint /snapshot
+        """
+        response = self.client.post('/snapshot', target_executor='CustomIndexer', return_responses=True)
+        results = response[0].parameters['__results__']
+        return results[list(results.keys())[0]]['snapshot']
+
+    def _delete(self, doc_ids: List[str]) -> None:
+        """
+        Delete documents by id calling the endpoint /delete
+        """
+        self.client.post('/delete', parameters={'ids': doc_ids}, target_executor='CustomIndexer')
+
     def _get_length(self) -> int:
         """
         Get length of index.
@@ -41,61 +105,114 @@ class Search:
         results = response[0].parameters['__results__']
         return int(results[list(results.keys())[0]]['length'])
 
-    def to_document_array(self, list_docs: List[dict]) -> DocumentArray:
+    @staticmethod
+    def _to_document(docs: dict, text: str, doc_id: Optional[str] = None) -> Document:
         """
-        Convert list of list of strings to list of documents.
-
-        Args:
-            list_docs: list of list of strings
+        Convert the chunks and tags of a preprocessed document to a root document
+        with a chunk per chunk of text.
+        """
+        inner_docs = DocumentArray()
+        offsets = docs.get('offsets') or [None] * len(docs['sentences'])
+        for doc, tags, offset in zip(docs['sentences'], docs['tags'], offsets):
+            document = Document(
+                text=doc,
+                tags=tags
+            )
+            if offset is not None:
+                # character span of the chunk in the text of the document
+                document.location = [offset, offset + len(doc)]
+            inner_docs.append(document)
+        root_document = Document(
+            text=text,
+            chunks=inner_docs)
+        if doc_id is not None:
+            root_document.id = doc_id
+        return root_document
 
-        Returns:
-            list of documents
+    def _iter_document_batches(self,
+                               files: Iterable[tuple],
+                               batch_size: int,
+                               batch_bytes: int) -> Iterator[DocumentArray]:
         """
-        jina_docs = []
-        current_num_docs = self._get_length()
-        print('{} previously indexed documents'.format(current_num_docs))
-        for i, docs in enumerate(tqdm(list_docs, desc='Converting to documents')):
-            inner_docs = DocumentArray()
-            for doc, tags in zip(docs['sentences'], docs['tags']):
-                document = Document(
-                    text=doc,
-                    tags=tags
-                )
-                inner_docs.append(document)
-            root_document = Document(
-                text='Document {}'.format(int(i + current_num_docs)),
-                chunks=inner_docs)
-            jina_docs.append(root_document)
-        return DocumentArray(jina_docs)
+        Convert preprocessed files to batches of root documents, whose id is the
+        stable id of their file. A batch is cut once it holds `batch_size` documents
+        or `batch_bytes` bytes of text.
+        """
+        batch, size = DocumentArray(), 0
+        for file, docs in files:
+            batch.append(self._to_document(docs, file['name'], file['doc_id']))
+            size += sum(len(sentence) for sentence in docs['sentences'])
+            if len(batch) >= batch_size or size >= batch_bytes:
+                yield batch
+                batch, size = DocumentArray(), 0
+        if len(batch) > 0:
+            yield batch
 
     def index(self,
-              docs: List[tuple],
+              docs: Union[List[tuple], ZipFiles],
               reload: bool = False,
               reload_persisted: bool = False,
-              tag: bool = True) -> None:
+              tag: bool = True,
+              batch_size: int = 16,
+              memory_ceiling_mb: int = 512,
+              max_pending_batches: int = 2,
+              delete_missing: bool = False) -> None:
         """
         Index documents.
-        """
-        # Check if hash of docs name exists
-        exists, path, docs = self.data_handler.hash_docs_name_exists(docs)
-        if exists and not reload_persisted:
-            print('Data already exists. Loading persisted data...')
-            # Load
-            docs = self.data_handler.load_persisted_docs(path)
-        else:
-            # Preprocess
-            docs = self.data_handler.preprocess_docs(docs, tag)
-            # Persist
-            self.data_handler.persist_preprocessed_docs(docs, path)
 
+        Indexing is incremental: a manifest maps every indexed file to the hash of
+        its content, to a fingerprint of the preprocessing settings (tagging, tagger
+        and chunking) and to the stable id of its document. Only new files and files
+        whose content or settings changed are preprocessed, encoded and upserted
+        (every given file if `reload_persisted` is set), and the documents of the
+        files which are no longer given are deleted if `delete_missing` is set,
+        otherwise they are kept. Preprocessed files are persisted by content hash and
+        settings, so a renamed file is not preprocessed again, and the store is
+        compacted once most of it holds files which are no longer indexed.
+
+        Preprocessing, conversion to documents and indexing run as a pipeline over
+        batches of documents: the next batches are prepared in a background thread
+        while the current one is encoded and indexed by the flow, and at most
+        `max_pending_batches` batches wait to be indexed. The text held by the
+        pipeline is bounded by `memory_ceiling_mb`, whatever the size of the corpus.
+
+        Args:
+            docs: list of (text, file name) tuples, or the files of a zip archive
+            reload: whether to clear the index first
+            reload_persisted: whether to preprocess the documents again even if they
+                were persisted
+            tag: whether to tag the sentences
+            batch_size: maximum number of documents per indexing request
+            memory_ceiling_mb: approximate bound on the text buffered by the pipeline
+            max_pending_batches: number of batches prepared ahead of the flow
+            delete_missing: whether to delete the documents of the indexed files
+                which are not in `docs`
+        """
         # Clear documents
         if reload:
             self._clear_index()
+        current_num_docs = self._get_length()
+        print('{} previously indexed documents'.format(current_num_docs))
 
-        # Convert to documents
-        docs = self.to_document_array(docs)
-
-        self.flow.index(docs, parameters={'traversal_paths': '@c'}, show_progress=True)
+        # Compare the files with the manifest of the indexed files, an empty index
+        # is rebuilt whatever the manifest
+        changed, removed, manifest = self.data_handler.plan_incremental_index(
+            docs, reload or current_num_docs == 0, delete_missing, tag, reload_persisted)
+        print('{} new or changed files, {} removed files'.format(len(changed), len(removed)))
+        if removed:
+            self._delete(removed)
+        # Preprocess, or load the persisted preprocessed files
+        files = self.data_handler.iter_preprocess_files(changed, tag, reload_persisted, manifest)
+        # the pending batches, the one being indexed and the one being built
+        batch_bytes = memory_ceiling_mb * 2 ** 20 // (max_pending_batches + 2)
+        batches = self._iter_document_batches(files, batch_size, batch_bytes)
+        for batch in tqdm(prefetch(batches, max_pending_batches), desc='Indexing'):
+            self.client.post(
+                '/update',
+                inputs=batch,
+                parameters={'traversal_paths': '@c', 'upsert': True})
+        self.data_handler.save_manifest(manifest)
+        self.data_handler.compact_preprocessed_files(manifest, tag)
 
         # Print number of documents indexed in total
         print('{} documents indexed in total'.format(self._get_length()))
@@ -109,10 +226,35 @@ class Search:
         """
         Query documents.
         """
-        query = Document(text=query)
+        return self.query_batch(
+            [query],
+            top_k=top_k,
+            context_length=context_length,
+            filter_by_tags=filter_by_tags,
+            filter_by_tags_method=filter_by_tags_method)[0]
+
+    def query_batch(self,
+                    queries: List[str],
+                    top_k : int = 5,
+                    context_length : int = 5,
+                    filter_by_tags : List[dict] = [],
+                    filter_by_tags_method : str = 'OR',
+                    request_size : int = 256) -> List[List[dict]]:
+        """
+        Query documents with a batch of queries.
+
+        The queries are encoded and matched in blocks of `request_size`, so the
+        indexer scores a whole block against the index at once and looks up the
+        context of chunks matched by several queries only once.
+
+        Returns:
+            the top k matches of every query, in the order of the queries
+        """
+        inputs = DocumentArray([Document(text=query) for query in queries])
         response = self.flow.search(
-            inputs=query,
+            inputs=inputs,
             return_results=True,
+            request_size=request_size,
             parameters={
                 'limit': top_k,
                 'context_length': context_length,
@@ -120,9 +262,10 @@ class Search:
                 'filter_by_tags_method': filter_by_tags_method
             },
         )
-        # Get top k matches
-        top_k_matches = []
+        # Get top k matches, reordered as the responses of the blocks may not be
+        results = {}
         for r in response:
+            top_k_matches = []
             for match in r.matches:
                 score = list(match.scores.values())[0].value
                 top_k_matches.append({
@@ -131,15 +274,16 @@ class Search:
                     'score': round(1.0 - score, 2),
                     'tags': match.tags
                 })
-        return top_k_matches
+            results[r.id] = top_k_matches
+        return [results.get(d.id, []) for d in inputs]
 
-    def get_tags(self, doc_ids: List[str]) -> List[str]:
+    def get_tags(self, doc_ids: List[str], top_n: Optional[int] = None) -> List[str]:
         """
         Get tags.
         """
         response = self.client.post(
             '/tags',
-            parameters={'doc_ids': doc_ids, 'traversal_right': '@c'},
+            parameters={'doc_ids': doc_ids, 'traversal_right': '@c', 'top_n': top_n},
             target_executor='CustomIndexer',
             return_responses=True)
         results = response[0].parameters['__results__']
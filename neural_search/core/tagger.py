@@ -1,3 +1,5 @@
+import re
+
 from transformers import pipeline
 
 class NERTagger:
@@ -6,6 +8,7 @@ class NERTagger:
                  model_name="wolfrage89/company_segment_ner",
                  entity_map={}):
         print("Loading NER model...")
+        self.model_name = model_name
         self.model = pipeline('ner', model_name)
         self.entity_map = {
             "B-ORG":"ORG",
@@ -14,11 +17,27 @@ class NERTagger:
         } if entity_map == {} else entity_map
         print("NER model loaded.")
 
+    def config(self):
+        """Settings the tags depend on"""
+        return {'tagger': 'ner', 'model_name': self.model_name, 'entity_map': self.entity_map}
+
     # TODO: Take real advantage of NER tags
     def predict(self, sentence):
-        results = {}
-        model_output = self.model(sentence)
+        return self._decode(self.model(sentence))
+
+    def predict_batch(self, sentences, batch_size=32):
+        """
+        Tag many sentences, running the model on padded batches of `batch_size`.
 
+        Returns the tags of every sentence, in order.
+        """
+        if len(sentences) == 0:
+            return []
+        model_outputs = self.model(list(sentences), batch_size=batch_size)
+        return [self._decode(model_output) for model_output in model_outputs]
+
+    def _decode(self, model_output):
+        results = {}
         accumulate = ""
         current_class = None
         # start = 0
@@ -66,23 +85,74 @@ class QuestionAnswerTagger:
     def __init__(self,
                  model_name="deepset/roberta-base-squad2",
                  questions=None,
-                 tagging_confidence=0.5):
+                 tagging_confidence=0.5,
+                 batch_size=32,
+                 skip_unanswerable=False):
+        """
+        A question may set an `answer_pattern`, a regular expression which any
+        answer to it matches, e.g. a year for "What year was the document
+        written?". With `skip_unanswerable`, which is off by default, the question
+        is not asked about the sentences in which the pattern does not appear.
+        """
         print("Loading QA model...")
+        self.model_name = model_name
         self.model = pipeline('question-answering', model_name)
         self.questions = questions if questions is not None else {}
         self.tagging_confidence = tagging_confidence
+        self.batch_size = batch_size
+        self.skip_unanswerable = skip_unanswerable
         print("QA model loaded.")
 
+    def config(self):
+        """Settings the tags depend on"""
+        return {
+            'tagger': 'question_answering',
+            'model_name': self.model_name,
+            'questions': self.questions,
+            'tagging_confidence': self.tagging_confidence,
+            'skip_unanswerable': self.skip_unanswerable,
+        }
+
     def predict(self, sentence):
-        results = {}
-        for question_dict in self.questions:
-            tag = question_dict["tag"]
-            question = question_dict["question"]
-            if 'confidence' in question_dict:
-                confidence = question_dict["confidence"]
-            else:
-                confidence = self.tagging_confidence
-            model_output = self.model(question=question, context=sentence)
-            if model_output['score'] > confidence:
-                results[tag] = model_output['answer']
+        return self.predict_batch([sentence])[0]
+
+    def predict_batch(self, sentences, batch_size=None):
+        """
+        Tag many sentences at once.
+
+        All the (question, sentence) pairs are run through the model in padded
+        batches of `batch_size`, sorted by length so that the pairs of a batch have
+        similar lengths. Returns the tags of every sentence, in order.
+        """
+        batch_size = batch_size if batch_size is not None else self.batch_size
+        pairs = []
+        for j, question_dict in enumerate(self.questions):
+            pattern = question_dict.get('answer_pattern')
+            pattern = re.compile(pattern) if pattern and self.skip_unanswerable else None
+            for i, sentence in enumerate(sentences):
+                if pattern is None or pattern.search(sentence):
+                    pairs.append((i, j))
+
+        results = [{} for _ in sentences]
+        if len(pairs) == 0:
+            return results
+        pairs.sort(key=lambda pair: len(self.questions[pair[1]]["question"]) + len(sentences[pair[0]]))
+        model_outputs = self.model(
+            [{'question': self.questions[j]["question"], 'context': sentences[i]} for i, j in pairs],
+            batch_size=batch_size)
+        # a single pair is not returned in a list
+        if isinstance(model_outputs, dict):
+            model_outputs = [model_outputs]
+
+        # the pairs are sorted by length, the questions of a sentence are applied in
+        # their original order
+        answers = dict(zip(pairs, model_outputs))
+        for i in range(len(sentences)):
+            for j, question_dict in enumerate(self.questions):
+                model_output = answers.get((i, j))
+                if model_output is None:
+                    continue
+                confidence = question_dict.get("confidence", self.tagging_confidence)
+                if model_output['score'] > confidence:
+                    results[i][question_dict["tag"]] = model_output['answer']
         return results
\ No newline at end of file
@@ -1,24 +1,137 @@
+import collections
 import os
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import zipfile
 import io
+import codecs
 from spacy.lang.en import English
-from hashlib import sha512
+from hashlib import sha256
 import json
-from tqdm import tqdm
+from neural_search.core.chunking import CHUNKING_STRATEGIES, chunk_sentences
+from neural_search.core.preprocessed import PreprocessedDocs
 from neural_search.core.tagger import NERTagger
 
 # Local data path
 DATA_PATH = os.environ.get('DATA_PATH', 'data/')
 INIT_TAGGER = eval(os.environ.get('INIT_TAGGER', True))
 
+class ZipFiles:
+    """
+    Lazy view over the text files of a zip archive on disk.
+
+    Members are only read when hashed or read, in chunks, so the archive is never
+    held in memory. Directories and members which are not utf-8 text are skipped.
+    Only the head of a member is checked up front, so reading a member may still
+    fail with a UnicodeDecodeError.
+    """
+
+    CHUNK_SIZE = 1 << 20
+    SNIFF_SIZE = 1 << 13
+
+    def __init__(self, path: str):
+        self.path = path
+        self._zip = zipfile.ZipFile(path)
+        self.names = []
+        for info in self._zip.infolist():
+            if info.is_dir():
+                continue
+            if self._is_text(info.filename):
+                self.names.append(info.filename)
+            else:
+                print('Skipping non-text file: ', info.filename)
+
+    def _is_text(self, name: str) -> bool:
+        with self._zip.open(name) as f:
+            head = f.read(self.SNIFF_SIZE)
+        if b'\x00' in head:
+            return False
+        try:
+            # a multi-byte character may be cut at the end of the sniffed bytes
+            codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        except UnicodeDecodeError:
+            return False
+        return True
+
+    def content_hash(self, name: str) -> str:
+        """
+        Hash the content of a member, streaming it in chunks.
+        """
+        _hash = sha256()
+        with self._zip.open(name) as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                _hash.update(chunk)
+        return _hash.hexdigest()
+
+    def read_text(self, name: str) -> str:
+        """
+        Decode a member incrementally into text.
+        """
+        with self._zip.open(name) as f:
+            return io.TextIOWrapper(f, encoding='utf-8').read()
+
+    def __iter__(self) -> Iterator[tuple]:
+        for name in self.names:
+            try:
+                text = self.read_text(name)
+            except UnicodeDecodeError as e:
+                print('Skipping non-text file: ', name, e)
+                continue
+            yield text, name
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def close(self) -> None:
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class DataHandler:
 
-    def __init__(self, ner_tagger: NERTagger):
+    def __init__(self,
+                 ner_tagger: NERTagger,
+                 num_workers: int = int(os.environ.get('PREPROCESS_WORKERS', 1)),
+                 preprocess_batch_size: int = 16,
+                 tag_batch_size: int = 256,
+                 chunking: str = os.environ.get('CHUNKING', 'sentence'),
+                 chunk_size: int = 5,
+                 chunk_overlap: int = 1,
+                 chunk_max_tokens: int = 128):
+        """
+        Args:
+            ner_tagger: tagger of the sentences
+            num_workers: number of processes splitting documents into sentences
+            preprocess_batch_size: number of documents sent to a process at once
+            tag_batch_size: number of sentences, across documents, tagged at once
+            chunking: how sentences are grouped into the indexed chunks, either
+                'sentence', a chunk per sentence, 'window', windows of `chunk_size`
+                sentences, or 'tokens', windows of at most `chunk_max_tokens`
+                whitespace separated tokens. Consecutive windows share
+                `chunk_overlap` sentences, and a chunk has the tags of its sentences
+            chunk_size: number of sentences of a 'window' chunk
+            chunk_overlap: number of sentences shared by consecutive windows
+            chunk_max_tokens: token budget of a 'tokens' chunk
+        """
+        if chunking not in CHUNKING_STRATEGIES:
+            raise ValueError(f'chunking should be one of {CHUNKING_STRATEGIES}, got "{chunking}"')
+        self.chunking = chunking
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.chunk_max_tokens = chunk_max_tokens
+        self.num_workers = num_workers
+        self.preprocess_batch_size = preprocess_batch_size
+        self.tag_batch_size = tag_batch_size
         self.nlp = English()
         self.nlp.add_pipe("sentencizer")
         self.nlp.max_length = 10000000
         self.persist_path = os.path.join(DATA_PATH, 'persist')
+        self.manifest_path = os.path.join(self.persist_path, 'manifest.json')
+        self._preprocessed_files = {}
         self.ner_tagger = ner_tagger
         if self.ner_tagger is None and INIT_TAGGER:
             self.ner_tagger = NERTagger()
@@ -39,94 +152,286 @@ class DataHandler:
         text = ' '.join(text.split())
         return text.strip()
 
-    def preprocess_docs(self, docs: List[str], tag: bool = False) -> List[List[str]]:
+    def iter_preprocess_docs(self, docs: Iterable[str], tag: bool = False) -> Iterator[dict]:
         """
-        Preprocess documents.
+        Preprocess documents lazily, in the order of `docs`.
+
+        Sentence splitting runs in `num_workers` processes, and the sentences of
+        consecutive documents are tagged together in batches of at least
+        `tag_batch_size` sentences. The tagged sentences are then grouped into
+        chunks with the `chunking` strategy.
 
         Args:
-            docs: list of strings
+            docs: iterable of strings
 
         Returns:
-            list of list of strings
+            iterator of dictionaries with the chunks of every document as
+            `sentences`, their `tags` and their character `offsets`
+        """
+        for doc in self._iter_tagged_sentences(docs, tag):
+            texts, tags, offsets = chunk_sentences(
+                doc['sentences'],
+                doc['tags'],
+                strategy=self.chunking,
+                size=self.chunk_size,
+                overlap=self.chunk_overlap,
+                max_tokens=self.chunk_max_tokens)
+            yield {
+                'sentences': texts,
+                'tags': tags,
+                'offsets': offsets
+            }
+
+    def _iter_tagged_sentences(self, docs: Iterable[str], tag: bool = False) -> Iterator[dict]:
+        """
+        Split documents into sentences and tag them, in the order of `docs`.
+        """
+        docs_sentences = self._split_sentences(docs)
+        if not tag:
+            for sentences in docs_sentences:
+                yield {
+                    'sentences': sentences,
+                    'tags': [{}] * len(sentences)
+                }
+            return
+
+        pending, num_sentences = [], 0
+        for sentences in docs_sentences:
+            pending.append(sentences)
+            num_sentences += len(sentences)
+            if num_sentences >= self.tag_batch_size:
+                yield from self._tag_docs(pending)
+                pending, num_sentences = [], 0
+        yield from self._tag_docs(pending)
+
+    def _split_sentences(self, docs: Iterable[str]) -> Iterator[List[str]]:
+        """
+        Split documents into clean sentences.
+
+        Args:
+            docs: iterable of strings
+
+        Returns:
+            iterator of the sentences of every document
         """
         # Tokenize into sentences
-        docs_sentences = []
-        total_len = len(docs)/1000 if len(docs) > 1000 else len(docs)
-        for doc in tqdm(self.nlp.pipe(docs, batch_size=1000), desc='Preprocessing', total=total_len):
+        for doc in self.nlp.pipe(docs, batch_size=self.preprocess_batch_size, n_process=self.num_workers):
             # Get sentences
             sentences = [sent.text for sent in doc.sents]
             # Clean sentences
             sentences = list(map(self._clean_text, sentences))
             # Remove empty strings
             sentences = list(filter(lambda x: x != '', sentences))
-            # # Group sentences in chunks and join them
-            # sentences = [' '.join(sentences[i:i+5]) for i in range(0, len(sentences), 5)]
-            # Tag sentences
-            tags = []
-            if tag:
-                for s in sentences:
-                    predicted_tags = self.ner_tagger.predict(s)
-                    # Filter out keys with None
-                    predicted_tags = dict(filter(lambda x: x[0] is not None, predicted_tags.items()))
-                    tags.append(predicted_tags)
-            else:
-                tags = [{}] * len(sentences)
-            # Add to docs
-            docs_sentences.append({
-                'sentences': sentences,
-                'tags': tags
-            })
-        return docs_sentences
+            yield sentences
 
-    def hash_docs_name_exists(self, docs: List[tuple]) -> Tuple[bool, str]:
+    def _tag_docs(self, docs_sentences: List[List[str]]) -> Iterator[dict]:
         """
-        Check if hash of docs name exists.
+        Tag the sentences of several documents in a single batch.
 
         Args:
-            docs: list of strings
+            docs_sentences: the sentences of every document
+
+        Returns:
+            iterator of dictionaries with the sentences and tags of every document
+        """
+        sentences = [s for doc_sentences in docs_sentences for s in doc_sentences]
+        if hasattr(self.ner_tagger, 'predict_batch'):
+            predicted = self.ner_tagger.predict_batch(sentences)
+        else:
+            predicted = [self.ner_tagger.predict(s) for s in sentences]
+        # Filter out keys with None
+        tags = [dict(filter(lambda x: x[0] is not None, p.items())) for p in predicted]
+        start = 0
+        for doc_sentences in docs_sentences:
+            yield {
+                'sentences': doc_sentences,
+                'tags': tags[start:start + len(doc_sentences)]
+            }
+            start += len(doc_sentences)
+
+    @staticmethod
+    def document_id(file_name: str) -> str:
+        """
+        Stable id of the root document of a file, derived from its name.
+        """
+        return sha256(file_name.encode('utf-8')).hexdigest()[:32]
+
+    def load_manifest(self) -> Dict[str, dict]:
+        """
+        Load the manifest of the indexed files.
 
         Returns:
-            Tuple[bool, str]:
+            dictionary from file name to its content hash and document id
+        """
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, 'r') as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest: Dict[str, dict]) -> None:
+        """
+        Save the manifest of the indexed files.
+
+        Args:
+            manifest: dictionary from file name to its content hash and document id
         """
-        # Create folder if it doesn't exist
         os.makedirs(self.persist_path, exist_ok=True)
-        # Compute hash of docs
-        name = ''.join([doc[1] for doc in docs])
-        _hash = sha512(name.encode('utf-8')).hexdigest()
-        # Check if _hash exists
-        path = os.path.join(self.persist_path, _hash + '.json')
-        # Return docs without filenames
-        docs = [doc[0] for doc in docs]
-        return os.path.exists(path), path, docs
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def preprocessing_config(self, tag: bool = False) -> str:
+        """
+        Fingerprint of the settings the preprocessed documents depend on: the
+        chunking and, when tagging, the tagger.
+
+        Args:
+            tag: whether the sentences are tagged
+
+        Returns:
+            hex digest of the settings
+        """
+        config = {
+            'tag': tag,
+            'chunking': self.chunking,
+            'chunk_size': self.chunk_size,
+            'chunk_overlap': self.chunk_overlap,
+            'chunk_max_tokens': self.chunk_max_tokens,
+        }
+        if tag and self.ner_tagger is not None:
+            config['tagger'] = self.ner_tagger.config()
+        return sha256(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def _preprocessed_key(entry: dict) -> str:
+        """Key of the preprocessed document of a file in the store"""
+        return '{}_{}'.format(entry['hash'], entry.get('config'))
 
-    def persist_preprocessed_docs(self, docs: List[dict], path: str) -> None:
+    def plan_incremental_index(self, docs: List[tuple], reload: bool = False, delete_missing: bool = False,
+                               tag: bool = False, reload_persisted: bool = False) -> Tuple[List[dict], List[str], Dict[str, dict]]:
         """
-        Persist preprocessed documents.
+        Compare files with the manifest of the indexed files by content hash and
+        preprocessing settings.
 
         Args:
-            docs: list of list of strings
+            docs: list of (text, file name) tuples, or the files of a zip archive
+            reload: whether the index is rebuilt, in which case every file is new
+            delete_missing: whether the indexed files which are not in `docs` are
+                removed, otherwise they are kept in the manifest
+            tag: whether the sentences are tagged. Files indexed with other
+                preprocessing settings, e.g. another tagger, are changed
+            reload_persisted: whether every file given is preprocessed again, in
+                which case they are all changed
 
         Returns:
-            None
+            Tuple[List[dict], List[str], Dict[str, dict]]: the new or changed files
+            with their name, a function reading their text, their content hash and
+            document id, the document ids
+            of the files which were removed, and the manifest once indexed
         """
-        # Save to file
-        with open(path, 'w') as f:
-            json.dump(docs, f)
+        previous = {} if reload else self.load_manifest()
+        manifest = {}
+        changed = []
+        if isinstance(docs, ZipFiles):
+            # the members are hashed without being decoded, and only read again
+            # when they are preprocessed
+            files = (
+                (docs.content_hash(name), name, lambda name=name: docs.read_text(name))
+                for name in docs.names
+            )
+        else:
+            files = (
+                (sha256(text.encode('utf-8')).hexdigest(), file_name, lambda text=text: text)
+                for text, file_name in docs
+            )
+        config = self.preprocessing_config(tag)
+        for content_hash, file_name, read in files:
+            entry = {'hash': content_hash, 'doc_id': self.document_id(file_name), 'config': config}
+            manifest[file_name] = entry
+            if reload_persisted or previous.get(file_name) != entry:
+                changed.append({'name': file_name, 'read': read, **entry})
+        missing = {file_name: entry for file_name, entry in previous.items() if file_name not in manifest}
+        if not delete_missing:
+            manifest.update(missing)
+            missing = {}
+        return changed, [entry['doc_id'] for entry in missing.values()], manifest
 
-    def load_persisted_docs(self, path: str) -> List[dict]:
+    def iter_preprocess_files(self, files: List[dict], tag: bool = False, reload_persisted: bool = False,
+                              manifest: Optional[Dict[str, dict]] = None) -> Iterator[Tuple[dict, dict]]:
         """
-        Load persisted docs.
+        Preprocess files lazily, reusing the preprocessed documents persisted for
+        the same content. Files which cannot be decoded are skipped.
 
         Args:
-            path: path to persisted docs
+            files: files as returned by `plan_incremental_index`
+            tag: whether to tag the sentences
+            reload_persisted: whether to preprocess the files again even if they
+                were persisted
+            manifest: the manifest once indexed, in which the hash of the skipped
+                files is cleared, so that they are read again by the next index
 
         Returns:
-            list of list of strings
+            iterator of (file, preprocessed document) tuples
+        """
+        store = self._preprocessed_files_store(tag)
+        to_preprocess = []
+        for file in files:
+            if self._preprocessed_key(file) in store and not reload_persisted:
+                yield file, store.get(self._preprocessed_key(file))
+            else:
+                to_preprocess.append(file)
+        # the files read so far, in the order of their preprocessed documents
+        read_files = collections.deque()
+
+        def read_texts():
+            for file in to_preprocess:
+                try:
+                    text = file['read']()
+                except UnicodeDecodeError as e:
+                    print('Skipping non-text file: ', file['name'], e)
+                    if manifest is not None and file['name'] in manifest:
+                        manifest[file['name']]['hash'] = None
+                    continue
+                read_files.append(file)
+                yield text
+
+        for doc in self.iter_preprocess_docs(read_texts(), tag):
+            file = read_files.popleft()
+            store.append(self._preprocessed_key(file), doc)
+            yield file, doc
+
+    def _preprocessed_files_store(self, tag: bool) -> PreprocessedDocs:
+        """
+        Columnar store of the preprocessed files, keyed by content hash and
+        preprocessing settings.
         """
-        # Load data from file
-        with open(path, 'r') as f:
-            data = json.load(f)
-        return data
+        if tag not in self._preprocessed_files:
+            # the chunks depend on the chunking configuration
+            name = 'preprocessed{}_{}'.format('_tagged' if tag else '', self.chunking)
+            if self.chunking == 'window':
+                name += '_{}_{}'.format(self.chunk_size, self.chunk_overlap)
+            elif self.chunking == 'tokens':
+                name += '_{}_{}'.format(self.chunk_max_tokens, self.chunk_overlap)
+            self._preprocessed_files[tag] = PreprocessedDocs(os.path.join(self.persist_path, name))
+        return self._preprocessed_files[tag]
+
+    def compact_preprocessed_files(self, manifest: Dict[str, dict], tag: bool = False) -> None:
+        """
+        Drop the preprocessed documents of the files which are no longer indexed, and
+        the ones superseded by a new preprocessing, once they take most of the store.
+
+        Args:
+            manifest: the manifest of the indexed files
+            tag: whether the store of the tagged documents is compacted
+        """
+        store = self._preprocessed_files_store(tag)
+        needed = [
+            self._preprocessed_key(entry) for entry in manifest.values()
+            if self._preprocessed_key(entry) in store
+        ]
+        if len(store) > 2 * len(needed):
+            store.compact(needed)
 
     def _handle_data(self, data: io.BytesIO = None) -> List[tuple]:
         """
@@ -160,6 +465,18 @@ class DataHandler:
                 docs.append((data, file))
         return docs
 
+    def open_zip(self, path: str) -> ZipFiles:
+        """
+        Open a zip file spooled to disk, without reading its members.
+
+        Args:
+            path: path of the zip file
+
+        Returns:
+            lazy view over the text files of the archive
+        """
+        return ZipFiles(path)
+
     def data_to_list(self, data: io.BytesIO = None) -> List[str]:
         """
         Convert data to list of Strings.
@@ -0,0 +1,76 @@
+import random
+
+import numpy as np
+
+from neural_search.core.executors.ann import ExactIndex, HNSWIndex, ShardedIndex
+
+
+def test_hnsw_interleaved_add_and_delete():
+    rng = random.Random(0)
+    vectors = np.random.default_rng(0).normal(size=(20, 8)).astype(np.float32)
+    index = HNSWIndex(8, max_elements=4)
+    live = set()
+    for _ in range(500):
+        ids = rng.sample([f'd{i}' for i in range(20)], rng.randint(1, 5))
+        if rng.random() < 0.5:
+            index.add(ids, vectors[[int(_id[1:]) for _id in ids]])
+            live.update(ids)
+        else:
+            index.delete(ids)
+            live.difference_update(ids)
+        assert len(index) == len(live)
+
+        if live:
+            results = index.search(vectors[:1], limit=len(live))[0]
+            returned = [_id for _id, _ in results]
+            assert len(returned) == len(set(returned))
+            assert set(returned) <= live
+
+
+def test_hnsw_readd_replaces_vector():
+    index = HNSWIndex(2, space='l2')
+    index.add(['a', 'b'], np.array([[0, 0], [5, 5]], dtype=np.float32))
+    index.delete(['a'])
+    index.add(['b', 'b'], np.array([[1, 1], [0, 0]], dtype=np.float32))
+    assert index.search(np.zeros((1, 2)), limit=5) == [[('b', 0.0)]]
+
+
+def test_hnsw_compacts_deleted_labels(tmp_path):
+    vectors = np.random.default_rng(1).normal(size=(10, 4)).astype(np.float32)
+    ids = [f'd{i}' for i in range(10)]
+    index = HNSWIndex(4, space='l2')
+    index.MIN_COMPACTED_LABELS = 5
+    for _ in range(20):
+        index.add(ids, vectors)
+        assert index.mask_size <= 2 * len(ids) + index.MIN_COMPACTED_LABELS + len(ids)
+    assert len(index) == 10
+    results = index.search(vectors[3:4], limit=1, allowed=index.mask(['d3', 'd4']))
+    assert results[0][0][0] == 'd3'
+
+    index.save(str(tmp_path))
+    loaded = HNSWIndex.load(str(tmp_path))
+    assert loaded.search(vectors[:1], limit=1)[0][0][0] == 'd0'
+
+
+def test_sharded_index_matches_exact_and_stops_its_threads(tmp_path):
+    vectors = np.random.default_rng(2).normal(size=(50, 8)).astype(np.float32)
+    ids = [f'd{i}' for i in range(50)]
+    exact = ExactIndex(8)
+    sharded = ShardedIndex([ExactIndex(8) for _ in range(3)])
+    exact.add(ids, vectors)
+    sharded.add(ids, vectors)
+    allowed = ids[10:30]
+    assert [[_id for _id, _ in r] for r in sharded.search(vectors[:3], 5, sharded.mask(allowed))] == \
+        [[_id for _id, _ in r] for r in exact.search(vectors[:3], 5, exact.mask(allowed))]
+
+    sharded.save(str(tmp_path))
+    loaded = ShardedIndex.load(str(tmp_path), lambda path, shard: ExactIndex.load(path))
+    assert loaded.search(vectors[:1], 1)[0][0][0] == 'd0'
+    loaded.close()
+
+    sharded.clear()
+    assert sharded._pool is None and len(sharded) == 0
+    sharded.add(ids[:2], vectors[:2])
+    assert sharded.search(vectors[1:2], 1)[0][0][0] == 'd1'
+    sharded.close()
+    assert sharded._pool is None
@@ -0,0 +1,28 @@
+from neural_search.core.executors.bm25 import BM25Index, tokenize
+
+
+def test_tokenize():
+    assert tokenize('Revenue of ACME, FY2019: 12%') == ['revenue', 'of', 'acme', 'fy2019', '12']
+    assert tokenize(None) == []
+
+
+def test_search_remove_and_allowed():
+    index = BM25Index()
+    index.add(['a', 'b', 'c'], ['revenue grew strongly', 'costs grew', 'nothing here'])
+    assert [_id for _id, _ in index.search('revenue grew', 3)] == ['a', 'b']
+    assert [_id for _id, _ in index.search('grew', 3, allowed=['b'])] == ['b']
+    index.remove(['a', 'unknown'])
+    assert 'a' not in index and len(index) == 2
+    assert [_id for _id, _ in index.search('revenue', 3)] == []
+    # a freed row is reused, and a replaced text drops its old terms
+    index.add(['d', 'b'], ['revenue again', 'profit'])
+    assert [_id for _id, _ in index.search('revenue grew', 3)] == ['d']
+
+
+def test_save_load(tmp_path):
+    index = BM25Index(k1=1.2, b=0.5)
+    index.add(['a', 'b'], ['alpha beta', 'beta gamma gamma'])
+    index.save(str(tmp_path / 'bm25.json'))
+    loaded = BM25Index.load(str(tmp_path / 'bm25.json'))
+    assert (loaded.k1, loaded.b) == (1.2, 0.5)
+    assert loaded.search('gamma beta', 2) == index.search('gamma beta', 2)
@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+from neural_search.core.executors.chunk_store import ChunkStore
+
+
+def make_doc(parent_id, num_chunks, step=6):
+    chunks = [
+        SimpleNamespace(
+            id=f'{parent_id}-{i}', text=f'{parent_id} s{i}', tags={'i': i},
+            location=[i * step, i * step + len(f'{parent_id} s{i}')],
+        )
+        for i in range(num_chunks)
+    ]
+    return SimpleNamespace(id=parent_id, text=f'text of {parent_id}', chunks=chunks)
+
+
+def test_add_remove_and_context():
+    store = ChunkStore()
+    store.add([make_doc('a', 3), make_doc('b', 2)])
+    assert len(store) == 5
+    assert store.position('a-2') == ('a', 2)
+    assert store.chunk('b-1') == ('b s1', {'i': 1})
+    assert store.context('a-1', 1) == 'a s0 a s1'
+    assert sorted(store.remove(['a', 'unknown'])) == ['a-0', 'a-1', 'a-2']
+    assert 'a-0' not in store and not store.has_parent('a')
+    assert len(store) == 2
+
+
+def test_overlapping_chunks_are_joined_once():
+    chunk_a = SimpleNamespace(id='c0', text='one two', tags={}, location=[0, 7])
+    chunk_b = SimpleNamespace(id='c1', text='two three', tags={}, location=[4, 13])
+    store = ChunkStore()
+    store.add([SimpleNamespace(id='p', text='one two three', chunks=[chunk_a, chunk_b])])
+    assert store.context('c1', 1) == 'one two three'
+
+
+def test_save_load_overlay(tmp_path):
+    store = ChunkStore()
+    store.add([make_doc(f'p{i}', 3) for i in range(10)])
+    store.save(str(tmp_path / 'first'))
+
+    loaded = ChunkStore()
+    loaded.load(str(tmp_path / 'first'))
+    assert len(loaded) == 30
+    assert loaded.position('p7-2') == ('p7', 2)
+    assert loaded.chunk('p3-1') == ('p3 s1', {'i': 1})
+    assert loaded.parent_text('p4') == 'text of p4'
+    assert loaded.context('p5-1', 1) == 'p5 s0 p5 s1'
+    assert 'missing' not in loaded and not loaded.has_parent('p10')
+
+    # saved parents removed or replaced are masked, new ones are held in memory
+    assert loaded.remove(['p5']) == ['p5-0', 'p5-1', 'p5-2']
+    loaded.add([make_doc('p6', 1), make_doc('new', 2)])
+    assert 'p5-0' not in loaded and not loaded.has_parent('p5')
+    assert 'p6-2' not in loaded and loaded.chunk_ids('p6') == ['p6-0']
+    assert loaded.position('new-1') == ('new', 1)
+    assert len(loaded) == 30 - 3 - 3 + 1 + 2
+
+    loaded.save(str(tmp_path / 'second'))
+    reloaded = ChunkStore()
+    reloaded.load(str(tmp_path / 'second'))
+    assert len(reloaded) == len(loaded)
+    assert not reloaded.has_parent('p5')
+    assert reloaded.chunk_ids('p6') == ['p6-0']
+    assert reloaded.chunk('new-0') == ('new s0', {'i': 0})
+
+
+def test_empty_store_round_trip(tmp_path):
+    ChunkStore().save(str(tmp_path))
+    store = ChunkStore()
+    store.load(str(tmp_path))
+    assert len(store) == 0 and 'x' not in store
@@ -0,0 +1,49 @@
+import pytest
+
+from neural_search.core.chunking import chunk_sentences, merge_tags
+
+SENTENCES = ['One two.', 'Three.', 'Four five six.', 'Seven.']
+TAGS = [{'year': '2019'}, {}, {'year': '2020'}, {'who': 'ACME'}]
+
+
+def test_sentence_chunks():
+    texts, tags, offsets = chunk_sentences(SENTENCES, TAGS)
+    assert texts == SENTENCES
+    assert tags == TAGS
+    assert offsets == [0, 9, 16, 31]
+
+
+def test_window_chunks_overlap():
+    texts, tags, offsets = chunk_sentences(SENTENCES, TAGS, 'window', size=2, overlap=1)
+    assert texts == ['One two. Three.', 'Three. Four five six.', 'Four five six. Seven.']
+    assert offsets == [0, 9, 16]
+    joined = ' '.join(SENTENCES)
+    assert all(joined[offset:offset + len(text)] == text for text, offset in zip(texts, offsets))
+    assert tags[2] == {'year': '2020', 'who': 'ACME'}
+
+
+def test_token_chunks_respect_budget():
+    texts, _, _ = chunk_sentences(SENTENCES, TAGS, 'tokens', overlap=0, max_tokens=3)
+    assert texts == ['One two. Three.', 'Four five six.', 'Seven.']
+
+
+def test_token_chunks_overlap_without_subset_chunks():
+    sentences = ['a b', 'c', 'd e f', 'g']
+    texts, _, offsets = chunk_sentences(sentences, [{}] * 4, 'tokens', overlap=1, max_tokens=3)
+    # the window starting at 'c' cannot get past 'd e f', so it is skipped
+    assert texts == ['a b c', 'd e f', 'g']
+    assert offsets == [0, 6, 12]
+    texts, _, _ = chunk_sentences(['a', 'b', 'c', 'd'], [{}] * 4, 'tokens', overlap=1, max_tokens=2)
+    assert texts == ['a b', 'b c', 'c d']
+
+
+def test_merge_tags_keeps_every_value():
+    assert merge_tags([{'year': '2020'}, {'year': '2019', 'who': 'A'}, {'year': '2020'}]) == {
+        'year': ['2020', '2019'], 'who': 'A'
+    }
+    assert merge_tags([{'year': '2020'}, {'year': '2020'}]) == {'year': '2020'}
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        chunk_sentences(SENTENCES, TAGS, 'paragraph')
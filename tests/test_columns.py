@@ -0,0 +1,35 @@
+import numpy as np
+
+from neural_search.core.columns import ColumnSlice, StringColumn, StringColumnWriter, find_sorted
+
+
+def test_string_column_round_trip_and_append(tmp_path):
+    prefix = str(tmp_path / 'col')
+    with StringColumnWriter(prefix) as writer:
+        writer.extend(['a', '', 'ünïcode'])
+    with StringColumnWriter(prefix, append=True) as writer:
+        writer.append('d')
+    column = StringColumn(prefix)
+    assert list(column) == ['a', '', 'ünïcode', 'd']
+    assert column[-1] == 'd'
+    assert column[1:3] == ['', 'ünïcode']
+    assert list(ColumnSlice(column, 1, 3)) == ['', 'ünïcode']
+
+
+def test_empty_column(tmp_path):
+    prefix = str(tmp_path / 'empty')
+    StringColumnWriter(prefix).close()
+    assert len(StringColumn(prefix)) == 0
+
+
+def test_find_sorted(tmp_path):
+    values = ['pear', 'apple', 'fig', 'kiwi']
+    prefix = str(tmp_path / 'col')
+    with StringColumnWriter(prefix) as writer:
+        writer.extend(values)
+    column = StringColumn(prefix)
+    order = np.array(sorted(range(len(values)), key=values.__getitem__))
+    for row, value in enumerate(values):
+        assert find_sorted(column, order, value) == row
+    assert find_sorted(column, order, 'banana') == -1
+    assert find_sorted(column, order, 'zzz') == -1
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('jina')
+docarray = pytest.importorskip('docarray')
+
+from docarray import Document, DocumentArray  # noqa: E402
+
+from neural_search.core.executors.indexer import CustomIndexer  # noqa: E402
+
+N_DIM = 4
+# the unit vector of every chunk text
+AXES = {'alpha': 0, 'beta': 1, 'gamma': 2, 'delta': 0}
+
+
+def make_indexer(tmp_path, **kwargs):
+    return CustomIndexer(
+        storage='sqlite',
+        storage_config={'connection': str(tmp_path / 'index.db'), 'table_name': 'docs'},
+        vector_index='exact',
+        traversal_right='@c',
+        traversal_left='@r',
+        n_dim=N_DIM,
+        metas={'workspace': str(tmp_path / 'workspace')},
+        **kwargs,
+    )
+
+
+def make_doc(parent_id, texts):
+    chunks = [
+        Document(
+            id=f'{parent_id}-{text}', text=text, tags={'word': text},
+            embedding=np.eye(N_DIM, dtype=np.float32)[AXES[text]],
+        )
+        for text in texts
+    ]
+    return Document(id=parent_id, text=' '.join(texts), chunks=chunks)
+
+
+def search_ids(indexer, vector):
+    queries = DocumentArray([Document(embedding=np.asarray(vector, dtype=np.float32))])
+    indexer.search(queries, parameters={'limit': 1})
+    return [m.id for m in queries[0].matches]
+
+
+def test_snapshot_restored_for_its_generation_only(tmp_path):
+    first = make_indexer(tmp_path, snapshot_on_close=True)
+    first.index(DocumentArray([make_doc('p0', ['alpha', 'beta']), make_doc('p1', ['gamma'])]))
+    first.close()
+
+    second = make_indexer(tmp_path)
+    assert second.restore()['snapshot'] is not None
+    assert search_ids(second, [1, 0, 0, 0]) == ['p0-alpha']
+    # an upsert keeps the number of Documents but makes the snapshot stale
+    second.update(DocumentArray([make_doc('p0', ['delta'])]), parameters={'upsert': True})
+    second.close()
+
+    third = make_indexer(tmp_path)
+    assert third.restore()['snapshot'] is None
+    assert search_ids(third, [1, 0, 0, 0]) == ['p0-delta']
+    third.close()
+
+
+def test_snapshot_not_restored_over_empty_storage(tmp_path):
+    indexer = make_indexer(tmp_path)
+    indexer.index(DocumentArray([make_doc('p0', ['alpha'])]))
+    assert indexer.snapshot()['snapshot']['num_docs'] == 1
+    indexer.clear()
+    assert indexer.restore()['snapshot'] is None
+    indexer.close()
+
+
+def test_index_replacing_a_parent_drops_its_chunks(tmp_path):
+    indexer = make_indexer(tmp_path)
+    indexer.index(DocumentArray([make_doc('p0', ['alpha', 'beta'])]))
+    indexer.index(DocumentArray([make_doc('p0', ['gamma'])]))
+    assert search_ids(indexer, [1, 0, 0, 0]) == ['p0-gamma']
+    assert 'p0-alpha' not in indexer._ann
+    indexer.close()
@@ -0,0 +1,71 @@
+import os
+
+from neural_search.core.preprocessed import PreprocessedDocs
+
+
+def make_doc(name, num_sentences=2):
+    return {
+        'sentences': [f'{name} sentence {i}.' for i in range(num_sentences)],
+        'tags': [{'name': name}] + [{}] * (num_sentences - 1),
+    }
+
+
+def test_append_get_and_reopen(tmp_path):
+    store = PreprocessedDocs(str(tmp_path))
+    store.extend([('a', make_doc('a')), ('b', make_doc('b', 3))])
+    store.append('a', make_doc('a2'))
+    assert len(store) == 3
+    assert store.get('a')['sentences'] == ['a2 sentence 0.', 'a2 sentence 1.']
+    assert store.get('b')['tags'] == [{'name': 'b'}, {}, {}]
+    # offsets default to the sentences joined with spaces
+    assert store.get('b')['offsets'] == [0, 14, 28]
+    assert store.get('missing') is None
+
+    reopened = PreprocessedDocs(str(tmp_path))
+    assert len(reopened) == 3 and 'b' in reopened
+    assert reopened.get('a') == store.get('a')
+    assert [doc['sentences'][0] for doc in reopened] == ['a sentence 0.', 'b sentence 0.', 'a2 sentence 0.']
+
+
+def test_interrupted_append_is_repaired(tmp_path):
+    store = PreprocessedDocs(str(tmp_path))
+    store.append('a', make_doc('a'))
+    # an append interrupted before its end offset was written
+    with open(os.path.join(str(tmp_path), 'sentences.data'), 'ab') as f:
+        f.write(b'partial')
+    with open(os.path.join(str(tmp_path), 'keys.data'), 'ab') as f:
+        f.write(b'b')
+    repaired = PreprocessedDocs(str(tmp_path))
+    assert len(repaired) == 1 and 'b' not in repaired
+    repaired.append('b', make_doc('b'))
+    assert PreprocessedDocs(str(tmp_path)).get('b')['sentences'][0] == 'b sentence 0.'
+
+
+def test_compact_keeps_latest_documents_of_given_keys(tmp_path):
+    path = str(tmp_path / 'store')
+    store = PreprocessedDocs(path)
+    store.extend([('a', make_doc('a')), ('b', make_doc('b')), ('a', make_doc('a2')), ('c', make_doc('c'))])
+    store.compact(['a', 'c', 'unknown'])
+    assert len(store) == 2
+    assert store.get('a')['sentences'][0] == 'a2 sentence 0.'
+    assert store.get('b') is None
+    assert sorted(os.listdir(str(tmp_path))) == ['store']
+    assert PreprocessedDocs(path).get('c')['tags'][0] == {'name': 'c'}
+
+
+def test_interrupted_compaction_is_completed(tmp_path):
+    path = str(tmp_path / 'store')
+    PreprocessedDocs(path).append('a', make_doc('a'))
+    os.rename(path, path + '.compact')
+    assert PreprocessedDocs(path).get('a') is not None
+
+
+def test_reopened_store_reuses_tag_codes(tmp_path):
+    PreprocessedDocs(str(tmp_path)).extend([('a', make_doc('a')), ('b', make_doc('b'))])
+    reopened = PreprocessedDocs(str(tmp_path))
+    assert reopened.get('a')['tags'] == [{'name': 'a'}, {}]
+    reopened.extend([('b2', make_doc('b')), ('c', make_doc('c'))])
+    # {'name': 'b'} and {} were already in the tag dictionary
+    assert len(reopened._tag_dict) == 4
+    assert reopened.get('b2')['tags'] == [{'name': 'b'}, {}]
+    assert PreprocessedDocs(str(tmp_path)).get('c')['tags'] == [{'name': 'c'}, {}]
@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+import pytest
+
+from neural_search.core.executors.quantization import QuantizedIndex
+
+
+@pytest.mark.parametrize('method', ['pq', 'sq8'])
+def test_quantized_search_and_reload(tmp_path, method):
+    vectors = np.random.default_rng(0).normal(size=(200, 16)).astype(np.float32)
+    ids = [f'd{i}' for i in range(200)]
+    index = QuantizedIndex(16, method=method, n_subvectors=4, train_size=100,
+                           vectors_path=str(tmp_path / 'vectors.f32'))
+    index.add(ids, vectors)
+    assert index.trained
+    assert index.search(vectors[5:6], limit=1)[0][0][0] == 'd5'
+    assert index.search(vectors[5:6], limit=3, allowed=index.mask(['d7']))[0][0][0] == 'd7'
+
+    index.save(str(tmp_path / 'snapshot'))
+    loaded = QuantizedIndex.load(str(tmp_path / 'snapshot'), vectors_path=str(tmp_path / 'restored.f32'))
+    assert len(loaded) == 200
+    assert loaded.search(vectors[9:10], limit=1)[0][0][0] == 'd9'
+
+
+def test_quantized_upserts_compact_dead_rows(tmp_path):
+    vectors = np.random.default_rng(1).normal(size=(20, 8)).astype(np.float32)
+    ids = [f'd{i}' for i in range(20)]
+    index = QuantizedIndex(8, method='sq8', train_size=10, vectors_path=str(tmp_path / 'vectors.f32'))
+    index.MIN_COMPACTED_ROWS = 10
+    index.save(str(tmp_path / 'snapshot'))
+    for _ in range(10):
+        index.add(ids, vectors)
+    assert len(index) == 20
+    assert index.mask_size <= 2 * len(ids) + index.MIN_COMPACTED_ROWS + len(ids)
+    assert os.path.getsize(tmp_path / 'vectors.f32') == index.mask_size * 8 * 4
+    assert index.search(vectors[3:4], limit=1)[0][0][0] == 'd3'
+    np.testing.assert_allclose(index.get_embeddings(['d4'])[0], vectors[4] / np.linalg.norm(vectors[4]), rtol=1e-5)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from neural_search.core.executors.ranking import rank_groups
+
+
+GROUPS = ['a', 'b', 'a', 'b', 'b']
+SCORES = [0.9, 0.6, 0.1, 0.5, 0.5]
+
+
+@pytest.mark.parametrize('ranking, expected_order, expected_scores', [
+    ('max', ['a', 'b'], [0.9, 0.6]),
+    ('min', ['b', 'a'], [0.5, 0.1]),
+    ('mean', ['b', 'a'], [1.6 / 3, 0.5]),
+    ('top_n_sum', ['b', 'a'], [1.1, 1.0]),
+])
+def test_rank_groups(ranking, expected_order, expected_scores):
+    groups, scores, positions = rank_groups(GROUPS, SCORES, ranking, top_n=2)
+    assert groups == expected_order
+    np.testing.assert_allclose(scores, expected_scores)
+    assert [groups[p] for p in positions] == GROUPS
+
+
+def test_rank_groups_empty_and_invalid():
+    groups, scores, positions = rank_groups([], [], 'max')
+    assert groups == [] and len(scores) == 0 and len(positions) == 0
+    with pytest.raises(ValueError):
+        rank_groups(['a'], [1.0], 'median')
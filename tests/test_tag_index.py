@@ -0,0 +1,24 @@
+from neural_search.core.executors.tag_index import TagIndex
+
+
+def test_fuzzy_match_counts_and_lists():
+    index = TagIndex()
+    index.add('c1', {'year': ['2020', '2019'], 'who': 'ACME Corp'})
+    index.add('c2', {'year': '2019'})
+    assert index.ids('year', '2020') == {'c1'}
+    assert index.ids('year', '2019') == {'c1', 'c2'}
+    assert index.match_value('who', 'ACME Corp.', threshold=0.5) == 'ACME Corp'
+    assert index.match_value('who', 'zzz', threshold=0.9) is None
+    assert index.counts() == {'year': {'2019': 2, '2020': 1}, 'who': {'ACME Corp': 1}}
+    index.remove(['c1'])
+    assert index.counts() == {'year': {'2019': 1}}
+
+
+def test_save_load(tmp_path):
+    index = TagIndex()
+    index.add('c1', {'year': ['2020', '2019']})
+    index.save(str(tmp_path / 'tags.json'), num_docs=1, generation=3)
+    loaded = TagIndex()
+    assert loaded.load(str(tmp_path / 'tags.json')) == {'num_docs': 1, 'generation': 3}
+    assert loaded.tags('c1') == {'year': ['2020', '2019']}
+    assert loaded.ids('year', '2019') == {'c1'}